@@ -6,3 +6,9 @@ curl ftp://ftp.wwpdb.org/pub/pdb/derived_data/index/entries.idx > entries.idx
 # Insert new proteins into PKPDB
 python3 read_entry_type.py
 python3 read_entries.py
+
+# Queue the new proteins for simulation
+python3 ../../src/sim_queue.py enqueue
+
+# Order the queue by longest expected job first, including the new proteins
+python3 ../../src/cost_model.py
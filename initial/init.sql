@@ -39,28 +39,68 @@ CREATE TABLE structure_validation (
 
 CREATE TABLE PDB(
     pid         INT,
-    pdb_file    JSON NOT NULL,
+    pdb_file    JSON,
     pdb_file_Hs JSON,
+    pdb_file_z    BYTEA,
+    pdb_file_hs_z BYTEA,
     FOREIGN KEY (pid) REFERENCES Protein (pid),
     PRIMARY KEY (pid)
 );
 
+/* Already compressed, TOAST should not try again */
+ALTER TABLE pdb ALTER COLUMN pdb_file_z SET STORAGE EXTERNAL;
+ALTER TABLE pdb ALTER COLUMN pdb_file_hs_z SET STORAGE EXTERNAL;
+
 /* include titratable Hs*/
 
 /* 532G JSON -> XXXG REAL[]
 */
 CREATE TABLE contact_map(
     pid         INT,
-    distances   REAL[] NOT NULL,
+    distances   REAL[],
     anumbs      INT[] NOT NULL,
     anames      VARCHAR(4)[] NOT NULL,
     chains      CHAR(1)[] NOT NULL,
     resnumbs    INT[] NOT NULL,
     resnames    VARCHAR(4)[] NOT NULL,
+    cutoff      REAL,
+    atom1       INT[],
+    atom2       INT[],
+    layout      VARCHAR(8),
+    dtype       VARCHAR(8),
+    distances_oid OID,
+    pairs_oid   OID,
+    offsets_oid OID,
     FOREIGN KEY (pid) REFERENCES Protein (pid),
     PRIMARY KEY (pid)
 );
 
+COMMENT ON COLUMN contact_map.distances IS
+    'no longer written, the distances are in the large object distances_oid';
+COMMENT ON COLUMN contact_map.atom1 IS 'no longer written, see pairs_oid';
+COMMENT ON COLUMN contact_map.atom2 IS 'no longer written, see pairs_oid';
+COMMENT ON COLUMN contact_map.layout IS
+    'dense, pairs, csr (pairs from both atoms) or csr_triu (pairs i < j from atom i)';
+
+/* The large objects of a contact map are removed with its row */
+CREATE FUNCTION contact_map_unlink() RETURNS trigger AS $$
+BEGIN
+    IF OLD.distances_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.distances_oid);
+    END IF;
+    IF OLD.pairs_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.pairs_oid);
+    END IF;
+    IF OLD.offsets_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.offsets_oid);
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contact_map_unlink BEFORE DELETE ON contact_map
+    FOR EACH ROW EXECUTE FUNCTION contact_map_unlink();
+
 
 CREATE TABLE FASTA(
     pid         INT,
@@ -78,6 +118,16 @@ CREATE TABLE similarity(
     PRIMARY KEY (similid)    
 );
 
+CREATE TABLE similarity_cluster(
+    pid                INT,
+    seqid              REAL NOT NULL,
+    cluster_id         INT NOT NULL,
+    is_representative  BOOLEAN NOT NULL,
+    similid            INT,
+    FOREIGN KEY (pid) REFERENCES Protein (pid),
+    PRIMARY KEY (pid, seqid)
+);
+
 CREATE TABLE residue(
     resid          SERIAL,
     pid            INTEGER NOT NULL,
@@ -124,7 +174,9 @@ CREATE TABLE sim_settings (
     pypka_params   JSON NOT NULL,
     delphi_params  JSON NOT NULL,
     mc_params      JSON NOT NULL,
-    PRIMARY KEY (settid)    
+    params_hash    CHAR(64),
+    PRIMARY KEY (settid),
+    UNIQUE (params_hash)
 );
 
 CREATE TABLE pK_sim (
@@ -137,6 +189,8 @@ CREATE TABLE pK_sim (
     sim_time           TIME,
     settid             INT,
     error_description  TEXT,
+    wall_time          REAL,
+    ncpus              INT,
     PRIMARY KEY (pksimid),
     FOREIGN KEY (pid) REFERENCES Protein (pid),
     FOREIGN KEY (settid) REFERENCES sim_settings (settid),
@@ -158,7 +212,25 @@ CREATE TABLE pK (
     UNIQUE (resid, pksimid)
 );
 
+CREATE TABLE sim_queue (
+    pid         INT,
+    nres        INT,
+    priority    REAL NOT NULL DEFAULT random(),
+    expected_time REAL,
+    status      VARCHAR(10) NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    claim_date  TIMESTAMP,
+    heartbeat_date TIMESTAMP,
+    lease_expires  TIMESTAMP,
+    FOREIGN KEY (pid) REFERENCES Protein (pid),
+    PRIMARY KEY (pid)
+);
+
+CREATE INDEX sim_queue_pending_index ON sim_queue (priority) WHERE status = 'pending';
+CREATE INDEX sim_queue_lease_index ON sim_queue (lease_expires) WHERE status = 'claimed';
+
 CREATE INDEX pk_dpks_index ON pk (resid, pksimid, pk, dpk);
+CREATE INDEX similarity_cluster_index ON similarity_cluster (seqid, cluster_id);
 ALTER TABLE pk SET (
    autovacuum_analyze_scale_factor = 0.02,
    autovacuum_vacuum_scale_factor = 0.01
@@ -0,0 +1,18 @@
+CREATE TABLE sim_queue (
+    pid         INT,
+    nres        INT,
+    priority    REAL NOT NULL DEFAULT random(),
+    status      VARCHAR(10) NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    claim_date  TIMESTAMP,
+    FOREIGN KEY (pid) REFERENCES Protein (pid),
+    PRIMARY KEY (pid)
+);
+
+CREATE INDEX sim_queue_pending_index ON sim_queue (priority) WHERE status = 'pending';
+
+INSERT INTO sim_queue(pid, nres)
+SELECT protein.pid, protein.nres
+FROM protein
+WHERE protein.protein_type = 'prot'
+  AND NOT EXISTS (SELECT 1 FROM pk_sim WHERE pk_sim.pid = protein.pid);
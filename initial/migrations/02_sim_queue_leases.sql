@@ -0,0 +1,17 @@
+ALTER TABLE sim_queue ADD COLUMN heartbeat_date TIMESTAMP;
+ALTER TABLE sim_queue ADD COLUMN lease_expires TIMESTAMP;
+
+CREATE INDEX sim_queue_lease_index ON sim_queue (lease_expires) WHERE status = 'claimed';
+
+/* Claims made without a lease are reclaimed by the next worker */
+UPDATE sim_queue SET lease_expires = now() WHERE status = 'claimed';
+
+/* Simulations abandoned before the leases existed go back to the queue.
+   Stop every worker before running this migration. */
+INSERT INTO sim_queue(pid, nres)
+SELECT protein.pid, protein.nres
+FROM protein, pk_sim
+WHERE protein.pid = pk_sim.pid
+  AND pk_sim.tit_curve IS NULL
+  AND pk_sim.error_description IS NULL
+ON CONFLICT (pid) DO UPDATE SET status = 'pending';
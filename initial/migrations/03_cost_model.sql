@@ -0,0 +1,4 @@
+ALTER TABLE pk_sim ADD COLUMN wall_time REAL;
+ALTER TABLE pk_sim ADD COLUMN ncpus INT;
+
+ALTER TABLE sim_queue ADD COLUMN expected_time REAL;
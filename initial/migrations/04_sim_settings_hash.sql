@@ -0,0 +1,2 @@
+ALTER TABLE sim_settings ADD COLUMN params_hash CHAR(64);
+ALTER TABLE sim_settings ADD CONSTRAINT sim_settings_params_hash_key UNIQUE (params_hash);
@@ -0,0 +1,9 @@
+ALTER TABLE pdb ALTER COLUMN pdb_file DROP NOT NULL;
+ALTER TABLE pdb ADD COLUMN pdb_file_z BYTEA;
+ALTER TABLE pdb ADD COLUMN pdb_file_hs_z BYTEA;
+
+/* Already compressed, TOAST should not try again */
+ALTER TABLE pdb ALTER COLUMN pdb_file_z SET STORAGE EXTERNAL;
+ALTER TABLE pdb ALTER COLUMN pdb_file_hs_z SET STORAGE EXTERNAL;
+
+/* Existing rows are compressed with: python3 src/compress_pdb.py */
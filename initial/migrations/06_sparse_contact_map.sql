@@ -0,0 +1,7 @@
+/* Sparse contact maps: distances[i] is the distance between the atoms
+   at positions atom1[i] and atom2[i] of anumbs (0-based), for the pairs
+   closer than cutoff. Dense maps have a NULL cutoff and keep the
+   condensed distance matrix. */
+ALTER TABLE contact_map ADD COLUMN cutoff REAL;
+ALTER TABLE contact_map ADD COLUMN atom1 INT[];
+ALTER TABLE contact_map ADD COLUMN atom2 INT[];
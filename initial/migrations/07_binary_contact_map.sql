@@ -0,0 +1,23 @@
+/* Contact map distances are stored as binary arrays in large objects,
+   dtype is the numpy type string of the distances (eg. <f4) and the
+   atom pairs of sparse maps are (npairs, 2) little-endian int32 */
+ALTER TABLE contact_map ALTER COLUMN distances DROP NOT NULL;
+ALTER TABLE contact_map ADD COLUMN dtype VARCHAR(8);
+ALTER TABLE contact_map ADD COLUMN distances_oid OID;
+ALTER TABLE contact_map ADD COLUMN pairs_oid OID;
+
+/* The large objects of a contact map are removed with its row */
+CREATE FUNCTION contact_map_unlink() RETURNS trigger AS $$
+BEGIN
+    IF OLD.distances_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.distances_oid);
+    END IF;
+    IF OLD.pairs_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.pairs_oid);
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contact_map_unlink BEFORE DELETE ON contact_map
+    FOR EACH ROW EXECUTE FUNCTION contact_map_unlink();
@@ -0,0 +1,25 @@
+/* Layout of the stored contact maps:
+   dense  distances is the condensed distance matrix
+   pairs  distances[i] is the distance between the atoms pairs[i, 0] < pairs[i, 1]
+   csr    the neighbours of atom a closer than cutoff are pairs[offsets[a]:offsets[a + 1]]
+          at distances[offsets[a]:offsets[a + 1]], every pair is stored from both atoms
+   Atoms are positions in anumbs, offsets is little-endian int64 */
+ALTER TABLE contact_map ADD COLUMN layout VARCHAR(8);
+ALTER TABLE contact_map ADD COLUMN offsets_oid OID;
+
+UPDATE contact_map SET layout = CASE WHEN cutoff IS NULL THEN 'dense' ELSE 'pairs' END;
+
+CREATE OR REPLACE FUNCTION contact_map_unlink() RETURNS trigger AS $$
+BEGIN
+    IF OLD.distances_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.distances_oid);
+    END IF;
+    IF OLD.pairs_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.pairs_oid);
+    END IF;
+    IF OLD.offsets_oid IS NOT NULL THEN
+        PERFORM lo_unlink(OLD.offsets_oid);
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,14 @@
+/* Connected components of the similarity clusters at each seqid
+   similid is the similarity row of pid already included, NULL if pid
+   was only found in the clusters of other proteins */
+CREATE TABLE similarity_cluster(
+    pid                INT,
+    seqid              REAL NOT NULL,
+    cluster_id         INT NOT NULL,
+    is_representative  BOOLEAN NOT NULL,
+    similid            INT,
+    FOREIGN KEY (pid) REFERENCES Protein (pid),
+    PRIMARY KEY (pid, seqid)
+);
+
+CREATE INDEX similarity_cluster_index ON similarity_cluster (seqid, cluster_id);
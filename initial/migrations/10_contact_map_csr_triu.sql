@@ -0,0 +1,8 @@
+/* Sparse contact maps are stored in the csr_triu layout, which keeps each
+   pair once, from its first atom: the neighbours j > a of atom a closer than
+   cutoff are pairs[offsets[a]:offsets[a + 1]] at distances[offsets[a]:offsets[a + 1]].
+   Maps of the csr layout, with every pair stored from both atoms, are still
+   read. Dense maps are the default again, sparse maps are stored when
+   contact_cutoff is set. */
+COMMENT ON COLUMN contact_map.layout IS
+    'dense, pairs, csr (pairs from both atoms) or csr_triu (pairs i < j from atom i)';
@@ -0,0 +1,16 @@
+/* BREAKING: the distances, atom1 and atom2 arrays of contact_map are no
+   longer written. Every map keeps its distances in the large object
+   distances_oid (a little-endian array of dtype) and its atom pairs in
+   pairs_oid and offsets_oid, see 08_contact_map_csr.sql and
+   10_contact_map_csr_triu.sql. SQL readers get the raw bytes with
+   lo_get(distances_oid), and Python readers an array from
+   contact_map.load_contact_map(pid).
+
+   The maps saved in the arrays are moved to large objects, and the arrays
+   emptied, by
+
+       python3 src/extra_properties/contact_map.py --migrate */
+COMMENT ON COLUMN contact_map.distances IS
+    'no longer written, the distances are in the large object distances_oid';
+COMMENT ON COLUMN contact_map.atom1 IS 'no longer written, see pairs_oid';
+COMMENT ON COLUMN contact_map.atom2 IS 'no longer written, see pairs_oid';
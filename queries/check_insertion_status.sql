@@ -39,23 +39,38 @@ from
     (
         select count(*) as a from protein where nres < 500 and protein_type = 'prot' and pid not in 
         (
-            select pid from pk_sim where tit_curve is not null or error_description is not null or sim_date >= '2021-03-13'
+            select pid from pk_sim where tit_curve is not null or error_description is not null
+            union
+            select pid from sim_queue where status = 'claimed' and lease_expires >= now()
         )
     ) as small,
     (
         select count(*) as a from protein where nres >= 500 and nres < 750 and protein_type = 'prot' and pid not in 
         (
-            select pid from pk_sim where tit_curve is not null or error_description is not null or sim_date >= '2021-03-13'
+            select pid from pk_sim where tit_curve is not null or error_description is not null
+            union
+            select pid from sim_queue where status = 'claimed' and lease_expires >= now()
         )
     ) as medium,
         (
         select count(*) as a from protein where nres >= 750 and nres < 1000 and protein_type = 'prot' and pid not in 
         (
-            select pid from pk_sim where tit_curve is not null or error_description is not null or sim_date >= '2021-03-13'
+            select pid from pk_sim where tit_curve is not null or error_description is not null
+            union
+            select pid from sim_queue where status = 'claimed' and lease_expires >= now()
         )
     ) as large
 ;
 
+select
+    count(*) filter (where status = 'pending') as pending,
+    count(*) filter (where status = 'claimed' and lease_expires >= now()) as live,
+    count(*) filter (where status = 'claimed' and lease_expires < now()) as stalled,
+    count(*) filter (where status = 'done') as done,
+    count(*) filter (where status = 'failed') as failed,
+    count(distinct worker) filter (where status = 'claimed' and lease_expires >= now()) as live_workers
+from sim_queue;
+
 select count(dpk) as total_dpks
 from pk
 where dpk is not null;
@@ -2,7 +2,4 @@
 
 mkdir -p tmp
 cd tmp
-for i in {1..10}
-do
-    python3 ../src/fill.py
-done
+python3 ../src/fill.py --daemon
@@ -0,0 +1,55 @@
+#! /usr/bin/python3
+
+import argparse
+import logging
+
+from db import session, PDB
+from utils import compress_pdb
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch-size", default=500, type=int)
+args = parser.parse_args()
+
+logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+
+def compress_batch(last_pid: int, batch_size: int) -> int:
+    """Moves the plain text structures of a batch of rows to the compressed columns
+
+    Returns:
+        int: pid of the last row of the batch, None if there were no rows left
+    """
+    rows = (
+        session.query(PDB.pid, PDB.pdb_file, PDB.pdb_file_hs)
+        .filter(PDB.pid > last_pid)
+        .filter(PDB.pdb_file_z == None)
+        .order_by(PDB.pid)
+        .limit(batch_size)
+        .all()
+    )
+    if not rows:
+        return None
+
+    mappings = []
+    for pid, pdb_file, pdb_file_hs in rows:
+        mapping = {"pid": pid, "pdb_file": None, "pdb_file_hs": None}
+        mapping["pdb_file_z"] = compress_pdb(pdb_file) if pdb_file else None
+        mapping["pdb_file_hs_z"] = compress_pdb(pdb_file_hs) if pdb_file_hs else None
+        mappings.append(mapping)
+
+    session.bulk_update_mappings(PDB, mappings)
+    session.commit()
+    return rows[-1][0]
+
+
+if __name__ == "__main__":
+    last_pid = 0
+    while last_pid is not None:
+        last_pid = compress_batch(last_pid, args.batch_size)
+        if last_pid is not None:
+            logging.info(f"Compressed up to PID {last_pid}")
+
+    logging.info(
+        "Finished compressing the pdb table. "
+        "Run VACUUM FULL pdb to give the space back to the system."
+    )
@@ -0,0 +1,196 @@
+#! /usr/bin/python3
+
+import logging
+import numpy as np
+from typing import NamedTuple
+from sqlalchemy import text
+
+from db import db
+
+MIN_TIMINGS = 20
+DEFAULT_NCPUS = 8
+# Residues per CPU of a pypka run in fill.py --executor mode
+RESIDUES_PER_CPU = 50
+
+TIMINGS_QUERY = """
+SELECT pk_sim.wall_time,
+       coalesce(pk_sim.ncpus, :default_ncpus),
+       protein.nres,
+       (SELECT count(*) FROM pk WHERE pk.pksimid = pk_sim.pksimid),
+       (SELECT count(DISTINCT chain) FROM residue WHERE residue.pid = pk_sim.pid)
+FROM pk_sim, protein
+WHERE pk_sim.pid = protein.pid
+  AND pk_sim.wall_time IS NOT NULL
+  AND pk_sim.tit_curve IS NOT NULL
+  AND protein.nres > 0
+"""
+
+SYNC_NRES_QUERY = """
+UPDATE sim_queue
+SET nres = protein.nres
+FROM protein
+WHERE sim_queue.pid = protein.pid
+  AND sim_queue.status = 'pending'
+  AND sim_queue.nres IS DISTINCT FROM protein.nres
+"""
+
+UPDATE_PRIORITIES_QUERY = """
+UPDATE sim_queue
+SET expected_time = new.expected_time, priority = new.priority
+FROM unnest(
+    CAST(:pids AS INT[]), CAST(:times AS REAL[]), CAST(:priorities AS REAL[])
+) AS new(pid, expected_time, priority)
+WHERE sim_queue.pid = new.pid
+"""
+
+
+class CostModel(NamedTuple):
+    """log(wall_time) = coefs . [1, log nres, log nsites, log nchains, log ncpus]
+
+    The number of sites and chains of a protein is only known after it
+    has been simulated, so unsimulated proteins use the typical sites per
+    residue and number of chains of the fitted proteins.
+    """
+
+    coefs: np.ndarray
+    sites_per_res: float
+    log_nchains: float
+    r2: float
+    ntimings: int
+
+
+def features(nres, nsites, nchains, ncpus) -> np.ndarray:
+    nres = np.asarray(nres, dtype=float)
+    columns = (
+        np.ones_like(nres),
+        np.log(nres),
+        np.log(np.maximum(nsites, 1)),
+        np.log(np.maximum(nchains, 1)),
+        np.log(ncpus),
+    )
+    return np.column_stack([np.broadcast_to(col, nres.shape) for col in columns])
+
+
+def fit_cost_model() -> CostModel:
+    """Fits the pypka wall time against the size of the simulated proteins
+
+    Returns:
+        CostModel: None if there are not enough recorded timings
+    """
+    with db.connect() as conn:
+        timings = conn.execute(
+            text(TIMINGS_QUERY), {"default_ncpus": DEFAULT_NCPUS}
+        ).fetchall()
+
+    if len(timings) < MIN_TIMINGS:
+        logging.warning(f"Only {len(timings)} recorded timings, no cost model fitted")
+        return None
+
+    wall_time, ncpus, nres, nsites, nchains = np.array(timings, dtype=float).T
+    X = features(nres, nsites, nchains, ncpus)
+    y = np.log(np.maximum(wall_time, 1.0))
+
+    # Features without variance (eg. every run used the same ncpus) are left out
+    fitted = np.concatenate(([True], np.ptp(X[:, 1:], axis=0) > 0))
+    coefs = np.zeros(X.shape[1])
+    coefs[fitted], _, _, _ = np.linalg.lstsq(X[:, fitted], y, rcond=None)
+    residuals = y - X @ coefs
+    r2 = 1 - residuals.var() / y.var() if y.var() > 0 else 0.0
+
+    return CostModel(
+        coefs=coefs,
+        sites_per_res=float(np.median(nsites / nres)),
+        log_nchains=float(np.mean(np.log(np.maximum(nchains, 1)))),
+        r2=float(r2),
+        ntimings=len(timings),
+    )
+
+
+def executor_ncpus(nres, max_ncpus: int) -> np.ndarray:
+    """CPUs of the pypka runs of proteins with nres residues in --executor mode
+
+    Small proteins do not have enough sites to keep max_ncpus busy, so they
+    get fewer CPUs and more of them run side by side.
+    """
+    ncpus = np.ceil(np.asarray(nres, dtype=float) / RESIDUES_PER_CPU)
+    return np.clip(ncpus, 1, max_ncpus)
+
+
+def predict_times(model: CostModel, nres, ncpus=DEFAULT_NCPUS) -> np.ndarray:
+    """Expected wall time in seconds of unsimulated proteins run with ncpus"""
+    nres = np.asarray(nres, dtype=float)
+    X = features(nres, nres * model.sites_per_res, np.exp(model.log_nchains), ncpus)
+    return np.exp(X @ model.coefs)
+
+
+def update_queue_priorities(
+    model: CostModel, ncpus: int = DEFAULT_NCPUS, executor: bool = False
+) -> int:
+    """Orders the pending proteins by longest expected wall time first
+
+    Without a model the proteins are ordered by decreasing nres.
+
+    Args:
+        model (CostModel): fitted cost model
+        ncpus (int): CPUs of a pypka run, the maximum per protein with executor
+        executor (bool): the proteins are run by fill.py --executor
+
+    Returns:
+        int: number of reprioritized proteins
+    """
+    with db.begin() as conn:
+        conn.execute(text(SYNC_NRES_QUERY))
+        pending = conn.execute(
+            text(
+                "SELECT pid, nres FROM sim_queue "
+                "WHERE status = 'pending' AND nres > 0"
+            )
+        ).fetchall()
+        if not pending:
+            return 0
+
+        pids, nres = np.array(pending, dtype=float).T
+        if model:
+            if executor:
+                ncpus = executor_ncpus(nres, ncpus)
+            times = predict_times(model, nres, ncpus)
+            priorities = -times
+            times = times.tolist()
+        else:
+            priorities = -nres
+            times = [None] * len(pending)
+
+        conn.execute(
+            text(UPDATE_PRIORITIES_QUERY),
+            {
+                "pids": pids.astype(int).tolist(),
+                "times": times,
+                "priorities": priorities.tolist(),
+            },
+        )
+    return len(pending)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncpus", default=DEFAULT_NCPUS, type=int)
+    parser.add_argument(
+        "--executor",
+        action="store_true",
+        help="the proteins are run by fill.py --executor, with a CPU share each",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    model = fit_cost_model()
+    if model:
+        logging.info(
+            f"Fitted the cost model over {model.ntimings} timings "
+            f"(R2={model.r2:.3f}, coefs={np.round(model.coefs, 3).tolist()})"
+        )
+
+    nupdated = update_queue_priorities(model, args.ncpus, args.executor)
+    logging.info(f"Updated the priority of {nupdated} queued proteins")
@@ -3,6 +3,7 @@ from sqlalchemy import (
     Column,
     Integer,
     Date,
+    DateTime,
     CHAR,
     JSON,
     Time,
@@ -10,7 +11,9 @@ from sqlalchemy import (
     VARCHAR,
     REAL,
     ARRAY,
+    Boolean,
 )
+from sqlalchemy.dialects.postgresql import BYTEA, OID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import psycopg2
@@ -77,8 +80,10 @@ class PDB(Base):
     __tablename__ = "pdb"
 
     pid = Column(Integer, primary_key=True)
-    pdb_file = Column(JSON, nullable=False)
-    pdb_file_hs = Column(JSON)
+    pdb_file = Column(JSON(none_as_null=True))
+    pdb_file_hs = Column(JSON(none_as_null=True))
+    pdb_file_z = Column(BYTEA)
+    pdb_file_hs_z = Column(BYTEA)
     ForeignKeyConstraint(["pid"], ["protein.pid"])
 
 
@@ -94,9 +99,26 @@ class Pk_sim(Base):
     sim_time = Column(Time)
     settid = Column(Integer)
     error_description = Column(Text)
+    wall_time = Column(REAL)
+    ncpus = Column(Integer)
     ForeignKeyConstraint(["pid", "settid"], ["protein.pid", "sim_settings.settid"])
 
 
+class Sim_queue(Base):
+    __tablename__ = "sim_queue"
+
+    pid = Column(Integer, primary_key=True)
+    nres = Column(Integer)
+    priority = Column(REAL, nullable=False)
+    expected_time = Column(REAL)
+    status = Column(VARCHAR, nullable=False)
+    worker = Column(Text)
+    claim_date = Column(DateTime)
+    heartbeat_date = Column(DateTime)
+    lease_expires = Column(DateTime)
+    ForeignKeyConstraint(["pid"], ["protein.pid"])
+
+
 class Residue(Base):
     __tablename__ = "residue"
 
@@ -144,18 +166,32 @@ class Sim_settings(Base):
     pypka_params = Column(JSON, nullable=False)
     delphi_params = Column(JSON, nullable=False)
     mc_params = Column(JSON, nullable=False)
+    params_hash = Column(CHAR, unique=True)
 
 
 class Contact_map(Base):
     __tablename__ = "contact_map"
 
     pid = Column(Integer, primary_key=True)
-    distances = Column(JSON, nullable=False)
+    # No longer written, see initial/migrations/11_contact_map_array_columns.sql
+    distances = Column(ARRAY(REAL))
     anumbs = Column(Integer, nullable=False)
     anames = Column(CHAR, nullable=False)
     chains = Column(CHAR, nullable=False)
     resnumbs = Column(Integer, nullable=False)
     resnames = Column(CHAR, nullable=False)
+    # Sparse maps only keep the atom pairs closer than cutoff
+    cutoff = Column(REAL)
+    atom1 = Column(ARRAY(Integer))
+    atom2 = Column(ARRAY(Integer))
+    # dense, pairs, csr or csr_triu, see initial/migrations/08_contact_map_csr.sql
+    # and initial/migrations/10_contact_map_csr_triu.sql
+    layout = Column(VARCHAR)
+    # Binary distances and atom pairs in large objects
+    dtype = Column(VARCHAR)
+    distances_oid = Column(OID)
+    pairs_oid = Column(OID)
+    offsets_oid = Column(OID)
     ForeignKeyConstraint(["pid"], ["protein.pid"])
 
 
@@ -196,6 +232,18 @@ class Similarity(Base):
     ForeignKeyConstraint(["pid"], ["protein.pid"])
 
 
+class Similarity_cluster(Base):
+    __tablename__ = "similarity_cluster"
+
+    pid = Column(Integer, primary_key=True)
+    seqid = Column(REAL, primary_key=True)
+    cluster_id = Column(Integer, nullable=False)
+    is_representative = Column(Boolean, nullable=False)
+    # Last similarity row of pid in the clusters, see initial/migrations/09_similarity_cluster.sql
+    similid = Column(Integer)
+    ForeignKeyConstraint(["pid"], ["protein.pid"])
+
+
 class PKPDB:
     """For bulk operations"""
 
@@ -244,8 +292,8 @@ class PKPDB:
         self.close_db()
         self.connect()
 
-    def exec_statement(self, statement, commit=False, fetchall=False):
-        self.cursor.execute(statement)
+    def exec_statement(self, statement, commit=False, fetchall=False, params=None):
+        self.cursor.execute(statement, params)
         if commit:
             self.connection.commit()
         if fetchall:
@@ -0,0 +1,353 @@
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from db import config
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pkpdb_cache")
+DEFAULT_MAX_SIZE = 10 * 1024**3  # bytes
+DEFAULT_MIN_AGE = 600  # seconds
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    fname TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+CREATE TABLE IF NOT EXISTS totals (size INTEGER NOT NULL);
+INSERT INTO totals (size) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM totals);
+"""
+
+# Remote path of each file type relative to its base url
+FILE_TYPES = {
+    "pdb": ("rcsb_files_url", "download/{idcode}.pdb.gz"),
+    "cif": ("rcsb_files_url", "header/{idcode}.cif"),
+    "fasta": ("rcsb_fasta_url", "fasta/entry/{idcode}"),
+}
+
+BASE_URLS = {
+    "rcsb_files_url": config.get("rcsb_files_url", "https://files.rcsb.org"),
+    "rcsb_fasta_url": config.get("rcsb_fasta_url", "https://www.rcsb.org"),
+}
+
+
+def to_url(base_url: str) -> str:
+    # A plain directory is used as a local mirror
+    if "://" not in base_url:
+        base_url = "file://" + os.path.abspath(base_url)
+    return base_url.rstrip("/")
+
+
+class DownloadCache:
+    """On-disk cache of the files downloaded from the PDB shared by all workers of a node
+
+    Files are keyed by idcode and file type, written atomically and
+    evicted by least recent use once the cache grows over max_size.
+
+    The size and last use of every file are kept in an sqlite index in the
+    cache directory, shared by every process, together with the running
+    size of the cache, so eviction never walks the directory. Files used
+    in the last min_age seconds are never evicted, as the paths handed out
+    by fetch() are opened right after.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_size: int = DEFAULT_MAX_SIZE,
+        base_urls: dict = None,
+        timeout: int = 60,
+        min_age: float = DEFAULT_MIN_AGE,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.base_urls = {
+            key: to_url(url) for key, url in (base_urls or BASE_URLS).items()
+        }
+        self.timeout = timeout
+        self.min_age = min_age
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.warned = False
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_fname = os.path.join(cache_dir, "index.sqlite")
+        # One connection shared by the threads of the process
+        self.index_lock = threading.Lock()
+        self.index = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.index is None:
+            new_index = not os.path.isfile(self.index_fname)
+            conn = sqlite3.connect(
+                self.index_fname,
+                timeout=60,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.executescript(INDEX_SCHEMA)
+            if new_index:
+                self.scan(conn)
+            self.index = conn
+        return self.index
+
+    def scan(self, conn: sqlite3.Connection) -> None:
+        """Indexes the files already in the cache directory"""
+        rows = []
+        for root, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                fname = os.path.join(root, fname)
+                if os.path.dirname(fname) == self.cache_dir:
+                    # The index itself and the lock files
+                    continue
+                try:
+                    stat = os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(fname, self.cache_dir)
+                rows.append((key, stat.st_size, stat.st_mtime))
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT OR IGNORE INTO files (fname, size, last_used) VALUES (?, ?, ?)",
+            rows,
+        )
+        conn.execute(
+            "UPDATE totals SET size = (SELECT coalesce(sum(size), 0) FROM files)"
+        )
+        conn.execute("COMMIT")
+
+    def touch(self, fname: str, size: int = None) -> int:
+        """Records the use of a cached file, or its addition when size is given
+
+        Returns:
+            int: size of the cache
+        """
+        key = os.path.relpath(fname, self.cache_dir)
+        with self.index_lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if size is None:
+                    updated = conn.execute(
+                        "UPDATE files SET last_used = ? WHERE fname = ?",
+                        (time.time(), key),
+                    ).rowcount
+                    if not updated:
+                        size = os.path.getsize(fname)
+                if size is not None:
+                    previous = conn.execute(
+                        "SELECT size FROM files WHERE fname = ?", (key,)
+                    ).fetchone()
+                    conn.execute(
+                        "INSERT OR REPLACE INTO files (fname, size, last_used) "
+                        "VALUES (?, ?, ?)",
+                        (key, size, time.time()),
+                    )
+                    added = size - (previous[0] if previous else 0)
+                    conn.execute("UPDATE totals SET size = size + ?", (added,))
+                (total_size,) = conn.execute("SELECT size FROM totals").fetchone()
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        return total_size
+
+    def path(self, idcode: str, ftype: str) -> str:
+        remote_path = FILE_TYPES[ftype][1].format(idcode=idcode)
+        fname = os.path.basename(remote_path)
+        return os.path.join(self.cache_dir, ftype, idcode[1:3], fname)
+
+    def url(self, idcode: str, ftype: str) -> str:
+        base_key, remote_path = FILE_TYPES[ftype]
+        return f"{self.base_urls[base_key]}/{remote_path.format(idcode=idcode)}"
+
+    def fetch(self, idcode: str, ftype: str) -> Optional[str]:
+        """Path of the cached file, downloading it if needed
+
+        The file is kept for at least min_age seconds.
+
+        Args:
+            idcode (str)
+            ftype (str): one of "pdb", "cif" or "fasta"
+
+        Returns:
+            str: None if the download failed
+        """
+        fname = self.path(idcode, ftype)
+        if os.path.isfile(fname):
+            try:
+                self.touch(fname)
+                self.hits += 1
+                return fname
+            except FileNotFoundError:
+                # Evicted in the meantime, so it is downloaded again
+                pass
+
+        self.misses += 1
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        url = self.url(idcode, ftype)
+        # Written next to its final path and renamed, so readers never see partial files
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname))
+        try:
+            with os.fdopen(fd, "wb") as f_tmp:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                    shutil.copyfileobj(response, f_tmp)
+            os.replace(tmp_fname, fname)
+        except (urllib.error.URLError, OSError) as e:
+            self.failures += 1
+            logging.warning(f"Download of {url} failed: {e}")
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            return None
+
+        total_size = self.touch(fname, os.path.getsize(fname))
+        if total_size > self.max_size:
+            self.evict()
+
+        return fname
+
+    def evict(self) -> None:
+        """Removes the least recently used files until the cache fits in 90% of max_size
+
+        Files used in the last min_age seconds are kept.
+        """
+        target_size = self.max_size * 0.9
+        with self.index_lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                (total_size,) = conn.execute("SELECT size FROM totals").fetchone()
+                # Only the oldest files needed to reach the target size are read
+                oldest = conn.execute(
+                    "SELECT fname, size FROM files "
+                    "WHERE last_used < ? ORDER BY last_used",
+                    (time.time() - self.min_age,),
+                )
+                evicted = []
+                for key, size in oldest:
+                    if total_size <= target_size:
+                        break
+                    try:
+                        os.remove(os.path.join(self.cache_dir, key))
+                    except FileNotFoundError:
+                        pass
+                    evicted.append((key,))
+                    total_size -= size
+
+                conn.executemany("DELETE FROM files WHERE fname = ?", evicted)
+                conn.execute("UPDATE totals SET size = ?", (total_size,))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+
+        if total_size > self.max_size and not self.warned:
+            # Warned once, as every download of a busy cache would repeat it
+            self.warned = True
+            logging.warning(
+                f"The download cache holds {total_size} bytes of files used in the "
+                f"last {self.min_age} s, over its maximum of {self.max_size}"
+            )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "failures": self.failures}
+
+    def add_stats(self, stats: dict) -> None:
+        """Adds the stats counted by another process, eg. an executor worker"""
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        self.failures += stats["failures"]
+
+
+CACHE = DownloadCache(
+    cache_dir=config.get("cache_dir", DEFAULT_CACHE_DIR),
+    max_size=int(config.get("cache_max_size", DEFAULT_MAX_SIZE)),
+    min_age=float(config.get("cache_min_age", DEFAULT_MIN_AGE)),
+)
+
+
+def gunzip_to(gz_fname: str, fname: str) -> None:
+    # Decompressed in-process and renamed, so a complete file appears at once
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        with gzip.open(gz_fname, "rb") as f_gz, os.fdopen(fd, "wb") as f_tmp:
+            shutil.copyfileobj(f_gz, f_tmp)
+        os.replace(tmp_fname, fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+
+
+def fetch_structure(idcode: str, cache: DownloadCache = CACHE) -> Optional[str]:
+    """Downloads the structure of idcode to {idcode}.pdb in the working directory
+
+    Returns:
+        str: None if the download failed
+    """
+    cached = cache.fetch(idcode, "pdb")
+    if not cached:
+        return None
+
+    fname = f"{idcode}.pdb"
+    try:
+        gunzip_to(cached, fname)
+    except (OSError, EOFError) as e:
+        logging.warning(f"Decompression of {cached} failed: {e}")
+        return None
+    return fname
+
+
+class Prefetcher:
+    """Downloads the structures of the next proteins while the current one runs
+
+    At most depth structures are fetched ahead by a pool of worker
+    threads, so pypka only ever reads local files.
+    """
+
+    def __init__(self, depth: int = 2, workers: int = 2, cache: DownloadCache = CACHE):
+        self.depth = depth
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+
+    def submit(self, idcodes: List[str]) -> None:
+        for idcode in idcodes:
+            if len(self.futures) >= self.depth:
+                break
+            if idcode not in self.futures:
+                self.futures[idcode] = self.pool.submit(
+                    fetch_structure, idcode, self.cache
+                )
+
+    def get(self, idcode: str) -> Optional[str]:
+        """Local structure of idcode, waiting for its download if needed
+
+        Returns:
+            str: None if idcode was never submitted or its download failed
+        """
+        future = self.futures.pop(idcode, None)
+        if future is None:
+            return None
+        return future.result()
+
+    def shutdown(self) -> None:
+        # Structures that were fetched but will not be used are removed
+        self.pool.shutdown(wait=True)
+        for future in self.futures.values():
+            fname = future.result()
+            if fname and os.path.isfile(fname):
+                os.remove(fname)
+        self.futures = {}
@@ -1,29 +1,267 @@
 import os
+import re
 import sys
+import gzip
+import time
 import logging
+import threading
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 file_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(1, f"{file_dir}/../")
-from db import session, Protein, SequenceAlign, StructureValidation
+from db import session, config, Protein, SequenceAlign, StructureValidation
 from utils import download_cif
 from sqlalchemy import or_
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
 
+RCSB_DATA_URL = config.get("rcsb_data_url", "https://data.rcsb.org")
+MAX_REQUESTS_PER_SECOND = float(config.get("rcsb_max_rate", 10))
 
-def handle_cif_line(line, expectedtype):
-    value = None
-    parts = line.split()
-    if len(parts) > 1:
+
+class RCSBFetcher:
+    """Fetches documents from the RCSB Data API over a pool of kept-alive connections
+
+    Requests are issued concurrently by a pool of worker threads, spaced
+    to at most max_rate per second and retried with backoff on
+    connection errors and 429/5xx responses.
+    The entry document of the recently annotated proteins is kept so
+    that it is only downloaded once per protein.
+    """
+
+    def __init__(
+        self,
+        base_url: str = RCSB_DATA_URL,
+        workers: int = 8,
+        max_rate: float = MAX_REQUESTS_PER_SECOND,
+        retries: int = 3,
+        timeout: int = 30,
+        max_entries: int = 32,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries = {}
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self.interval = 1 / max_rate if max_rate > 0 else 0
+        self.next_request = 0.0
+        self.rate_lock = threading.Lock()
+
+    def wait_turn(self) -> None:
+        with self.rate_lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_json(self, path: str, not_found=None):
+        """Document at path relative to the base url, None if it could not be fetched
+
+        Args:
+            path (str): path of the document
+            not_found: returned instead of None when there is no such document
+        """
+        url = f"{self.base_url}/{path}"
+        self.wait_turn()
         try:
-            value = expectedtype(parts[1])
-        except:
+            r = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.warning(f"Request to {url} failed: {e}")
+            return None
+        if r.status_code == 404:
+            return not_found
+        if not r.ok:
+            return None
+        try:
+            return r.json()
+        except ValueError:
+            logging.warning(f"Invalid JSON in {url}")
+            return None
+
+    def get_many(self, paths: List[str], not_found=None) -> list:
+        """Documents at paths fetched concurrently, in the same order"""
+        return list(self.pool.map(lambda path: self.get_json(path, not_found), paths))
+
+    def entry(self, idcode: str) -> Optional[dict]:
+        if idcode not in self.entries:
+            content = self.get_json(f"rest/v1/core/entry/{idcode}")
+            if content is None:
+                return None
+            if len(self.entries) >= self.max_entries:
+                # Entries are dropped in insertion order
+                del self.entries[next(iter(self.entries))]
+            self.entries[idcode] = content
+        return self.entries[idcode]
+
+    def entity_documents(self, idcode: str, entities: List[str]) -> Optional[list]:
+        """polymer_entity and uniprot documents of each entity of idcode
+
+        Entities without a UniProt reference get an empty uniprot document.
+
+        Returns:
+            Optional[list]: (polymer_entity, uniprot) pairs, None if any
+                request failed
+        """
+        contents = self.get_many(
+            [f"rest/v1/core/polymer_entity/{idcode}/{entity}" for entity in entities]
+        )
+        uniprots = self.get_many(
+            [f"rest/v1/core/uniprot/{idcode}/{entity}" for entity in entities],
+            not_found=[],
+        )
+        if None in contents or None in uniprots:
+            return None
+        return list(zip(contents, uniprots))
+
+
+FETCHER = RCSBFetcher()
+
+
+CIF_TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+# Experimental conditions and the CIF items they are read from
+CONDITION_ITEMS = {
+    "_exptl_crystal_grow.pH": "ph",
+    "_exptl_crystal_grow.temp": "temp",
+    "_em_buffer.pH": "ph",
+    "_pdbx_nmr_exptl_sample_conditions.pH": "ph",
+    "_pdbx_nmr_exptl_sample_conditions.temperature": "temp",
+}
+
+
+def open_cif(fname: str) -> IO[str]:
+    with open(fname, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    if gzipped:
+        return gzip.open(fname, "rt")
+    return open(fname)
+
+
+def cif_tokens(lines: Iterable[str]) -> Iterator[Tuple[str, bool]]:
+    """Tokens of a CIF file and whether each one is a quoted value
+
+    ;-delimited text fields are returned as a single quoted token.
+    """
+    text_field = None
+    for line in lines:
+        if text_field is not None:
+            if line.startswith(";"):
+                yield "\n".join(text_field), True
+                text_field = None
+            else:
+                text_field.append(line.rstrip("\n"))
+            continue
+        if line.startswith(";"):
+            text_field = [line[1:].rstrip("\n")]
+            continue
+        for match in CIF_TOKEN.finditer(line):
+            bare = match.group(3)
+            if bare is None:
+                yield match.group(1) if match.group(1) is not None else match.group(2), True
+            elif bare.startswith("#"):
+                break
+            else:
+                yield bare, False
+
+
+def read_cif_items(lines: Iterable[str], items: Dict[str, str]) -> Dict[str, list]:
+    """Values of the wanted items of a CIF file, read in a single pass
+
+    Items are read both from key-value pairs and from loop_ blocks. The
+    file is only read until the categories that gave every field a value
+    have been read in full.
+
+    Args:
+        lines (Iterable[str]): lines of the CIF file
+        items (Dict[str, str]): field under which each CIF item is collected
+
+    Returns:
+        Dict[str, list]: values of each field in file order, without the
+            unknown (?) and inapplicable (.) ones
+    """
+    found = {field: [] for field in items.values()}
+    missing = set(found)
+    read = set()  # categories of the items with a value
+
+    def add(item: str, value: str, quoted: bool) -> None:
+        field = items.get(item)
+        if field and (quoted or value not in ("?", ".")):
+            found[field].append(value)
+            missing.discard(field)
+            read.add(item.split(".")[0])
+
+    def finished(item: str) -> bool:
+        # The items of a category are contiguous, so a new one ends the last
+        return not missing and item.split(".")[0] not in read
+
+    def is_value(token: str, quoted: bool) -> bool:
+        return quoted or not (
+            token.startswith("_") or token.lower().startswith(("loop_", "data_"))
+        )
+
+    tokens = cif_tokens(lines)
+    token, quoted = next(tokens, (None, False))
+    while token is not None:
+        if not quoted and token.lower() == "loop_":
+            header = []
+            token, quoted = next(tokens, (None, False))
+            while token is not None and not quoted and token.startswith("_"):
+                header.append(token)
+                token, quoted = next(tokens, (None, False))
+            if header and finished(header[0]):
+                break
+            # Loop values run until the next item, loop or data block
+            ncol = 0
+            while token is not None and header and is_value(token, quoted):
+                add(header[ncol % len(header)], token, quoted)
+                ncol += 1
+                token, quoted = next(tokens, (None, False))
+        elif not quoted and token.startswith("_"):
+            item = token
+            if finished(item):
+                break
+            token, quoted = next(tokens, (None, False))
+            if token is not None and is_value(token, quoted):
+                add(item, token, quoted)
+                token, quoted = next(tokens, (None, False))
+        else:
+            token, quoted = next(tokens, (None, False))
+
+    return found
+
+
+def last_float(values: list) -> Optional[float]:
+    """Last nonzero number of values, as kept by the former line parser"""
+    number = None
+    for value in values:
+        try:
+            number = float(value) or number
+        except ValueError:
             pass
-    return value
+    return number
 
 
-def save_experimental_conditions(idcode, pid):
+def parse_experimental_conditions(fname: str) -> Tuple[float, float]:
     """
     _exptl_crystal_grow.pH              4.5      70%
     _exptl_crystal_grow.temp            277.15   73.0%
@@ -32,7 +270,24 @@ def save_experimental_conditions(idcode, pid):
 
     _pdbx_nmr_exptl_sample_conditions.temperature         308
     _pdbx_nmr_exptl_sample_conditions.pH                  3.8
+
+    The last nonzero value is kept, as the former line parser did. Unlike
+    it, the values in loop_ blocks and the NMR pH are read as well, and the
+    file is not read past the categories reporting both conditions, so a
+    later category no longer overrides them.
+
+    Args:
+        fname (str): CIF file, optionally gzipped
+
+    Returns:
+        Tuple[float, float]: pH and temperature, None if they are not reported
     """
+    with open_cif(fname) as f:
+        found = read_cif_items(f, CONDITION_ITEMS)
+    return last_float(found["ph"]), last_float(found["temp"])
+
+
+def save_experimental_conditions(idcode, pid):
     exists_experimental = (
         session.query(Protein.pid)
         .filter(Protein.pid == pid)
@@ -43,32 +298,11 @@ def save_experimental_conditions(idcode, pid):
         logging.info(f"{idcode} experimental conditions already exist.")
         return
 
-    cif_file = download_cif(idcode, pid)
-
-    temperature = None
-    ph = None
-    for line in cif_file.splitlines():
-        if line.startswith("_exptl_crystal_grow.pH"):
-            tmp_ph = handle_cif_line(line, float)
-            if tmp_ph:
-                ph = tmp_ph
-        elif line.startswith("_exptl_crystal_grow.temp"):
-            tmp_temp = handle_cif_line(line, float)
-            if tmp_temp:
-                temperature = tmp_temp
-        elif line.startswith("_em_buffer.pH"):
-            tmp_ph = handle_cif_line(line, float)
-            if tmp_ph:
-                ph = tmp_ph
-        elif line.startswith("_pdbx_nmr_exptl_sample_conditions.temperature"):
-            tmp_temp = handle_cif_line(line, float)
-            if tmp_temp:
-                temperature = tmp_temp
-        elif line.startswith("_em_buffer.pH"):
-            tmp_ph = handle_cif_line(line, float)
-            if tmp_ph:
-                ph = tmp_ph
+    cif_fname = download_cif(idcode, pid)
+    if not cif_fname:
+        return
 
+    ph, temperature = parse_experimental_conditions(cif_fname)
     if ph or temperature:
         protein = session.query(Protein).filter_by(pid=pid).first()
         if ph:
@@ -78,7 +312,11 @@ def save_experimental_conditions(idcode, pid):
         session.commit()
 
 
-def save_sequence_info(idcode, pid):
+def entry_entities(entry: dict) -> List[str]:
+    return entry["rcsb_entry_container_identifiers"].get("polymer_entity_ids", [])
+
+
+def parse_sequence_info(pid: int, entities: List[str], documents: list) -> List[dict]:
     """
     https://data.rcsb.org/rest/v1/core/entry/2AT1
     "polymer_entity_ids":["1","2"]
@@ -90,27 +328,19 @@ def save_sequence_info(idcode, pid):
     "rcsb_id":"P0A786"
     "rcsb_uniprot_accession":["P0A786","P00479","Q2M662","Q47555","Q47557"]
     "feature_positions":[{"beg_seq_id":2,"end_seq_id":311}]}
-    """
-    exists_sequence = (
-        session.query(SequenceAlign.pid).filter(SequenceAlign.pid == pid).first()
-    )
-    if exists_sequence:
-        logging.info(f"{idcode} sequence alignment information already exist.")
-        return
-
-    r = requests.get(f"https://data.rcsb.org/rest/v1/core/entry/{idcode}")
-    if not r.ok:
-        return
 
-    entities = r.json()["rcsb_entry_container_identifiers"]["polymer_entity_ids"]
+    Args:
+        pid (int)
+        entities (List[str]): polymer entity ids of the entry
+        documents (list): (polymer_entity, uniprot) documents of each entity
 
-    for entity in entities:
-        r = requests.get(
-            f"https://data.rcsb.org/rest/v1/core/polymer_entity/{idcode}/{entity}"
-        )
-        if not r.ok:
+    Returns:
+        List[dict]: sequence_align rows
+    """
+    rows = []
+    for entity, (content, uniprot) in zip(entities, documents):
+        if not content:
             continue
-        content = r.json()
         chains = None
         if (
             "rcsb_polymer_entity_container_identifiers" in content
@@ -120,13 +350,10 @@ def save_sequence_info(idcode, pid):
                 "auth_asym_ids"
             ]
 
-        r = requests.get(
-            f"https://data.rcsb.org/rest/v1/core/uniprot/{idcode}/{entity}"
-        )
-        if not r.ok:
+        if not uniprot:
             continue
 
-        content = r.json()[0]
+        content = uniprot[0]
 
         rcsb_id = None
         uniprot_accession_codes = None
@@ -147,20 +374,44 @@ def save_sequence_info(idcode, pid):
             if "end_seq_id" in align:
                 seq_align_end = align["end_seq_id"]
 
-        new_seqalign = SequenceAlign(
-            pid=pid,
-            entity=entity,
-            rcsb_id=rcsb_id,
-            uniprot_accession_codes=uniprot_accession_codes,
-            chains=chains,
-            seq_align_beg=seq_align_beg,
-            seq_align_end=seq_align_end,
+        rows.append(
+            {
+                "pid": pid,
+                "entity": entity,
+                "rcsb_id": rcsb_id,
+                "uniprot_accession_codes": uniprot_accession_codes,
+                "chains": chains,
+                "seq_align_beg": seq_align_beg,
+                "seq_align_end": seq_align_end,
+            }
         )
-        session.add(new_seqalign)
+    return rows
+
+
+def save_sequence_info(idcode, pid):
+    exists_sequence = (
+        session.query(SequenceAlign.pid).filter(SequenceAlign.pid == pid).first()
+    )
+    if exists_sequence:
+        logging.info(f"{idcode} sequence alignment information already exist.")
+        return
+
+    entry = FETCHER.entry(idcode)
+    if not entry:
+        return
+
+    entities = entry_entities(entry)
+    documents = FETCHER.entity_documents(idcode, entities)
+    if documents is None:
+        # Saving part of the entities would keep the rest from being backfilled
+        return
+
+    for row in parse_sequence_info(pid, entities, documents):
+        session.add(SequenceAlign(**row))
     session.commit()
 
 
-def save_structure_quality(idcode, pid):
+def parse_structure_quality(pid: int, content: dict) -> dict:
     """
     https://data.rcsb.org/rest/v1/core/entry/4LZT
     ls_rfactor_rfree
@@ -168,22 +419,10 @@ def save_structure_quality(idcode, pid):
     percent_ramachandran_outliers
     percent_rotamer_outliers
     percent_rsrzoutliers
-    """
-    exists_validation = (
-        session.query(StructureValidation.pid)
-        .filter(StructureValidation.pid == pid)
-        .all()
-    )
-    if exists_validation:
-        logging.info(f"{idcode} structure validation already exist.")
-        return
-
-    r = requests.get(f"https://data.rcsb.org/rest/v1/core/entry/{idcode}")
-    if not r.ok:
-        logging.error(f"Unable to get structure validation info about {idcode}")
-        return
 
-    content = r.json()
+    Returns:
+        dict: structure_validation row
+    """
     rfree = None
     clashscore = None
     percent_ramachandran_outliers = None
@@ -204,15 +443,32 @@ def save_structure_quality(idcode, pid):
         if "percent_rsrzoutliers" in val_summ:
             percent_rsrzoutliers = val_summ["percent_rsrzoutliers"]
 
-    new_val = StructureValidation(
-        pid=pid,
-        rfree=rfree,
-        clashscore=clashscore,
-        rama=percent_ramachandran_outliers,
-        rota=percent_rotamer_outliers,
-        rsrz=percent_rsrzoutliers,
+    return {
+        "pid": pid,
+        "rfree": rfree,
+        "clashscore": clashscore,
+        "rama": percent_ramachandran_outliers,
+        "rota": percent_rotamer_outliers,
+        "rsrz": percent_rsrzoutliers,
+    }
+
+
+def save_structure_quality(idcode, pid):
+    exists_validation = (
+        session.query(StructureValidation.pid)
+        .filter(StructureValidation.pid == pid)
+        .all()
     )
-    session.add(new_val)
+    if exists_validation:
+        logging.info(f"{idcode} structure validation already exist.")
+        return
+
+    content = FETCHER.entry(idcode)
+    if not content:
+        logging.error(f"Unable to get structure validation info about {idcode}")
+        return
+
+    session.add(StructureValidation(**parse_structure_quality(pid, content)))
     session.commit()
 
 
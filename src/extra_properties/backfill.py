@@ -0,0 +1,262 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Set, Tuple
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, f"{file_dir}/../")
+from db import db, SequenceAlign, StructureValidation, Fasta
+from download_cache import CACHE
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from annotations import (
+    FETCHER,
+    entry_entities,
+    parse_experimental_conditions,
+    parse_sequence_info,
+    parse_structure_quality,
+)
+
+TARGETS = ("conditions", "sequence", "validation", "fasta")
+
+# Condition under which each target is missing for a protein
+MISSING = {
+    "conditions": "protein.exp_ph IS NULL AND protein.exp_temp IS NULL",
+    "sequence": "NOT EXISTS (SELECT 1 FROM sequence_align s WHERE s.pid = protein.pid)",
+    "validation": "NOT EXISTS "
+    "(SELECT 1 FROM structure_validation v WHERE v.pid = protein.pid)",
+    "fasta": "NOT EXISTS (SELECT 1 FROM fasta f WHERE f.pid = protein.pid)",
+}
+
+UPDATE_CONDITIONS_QUERY = """
+UPDATE protein
+SET exp_ph = coalesce(new.exp_ph, protein.exp_ph),
+    exp_temp = coalesce(new.exp_temp, protein.exp_temp)
+FROM unnest(
+    CAST(:pids AS INT[]), CAST(:phs AS REAL[]), CAST(:temps AS REAL[])
+) AS new(pid, exp_ph, exp_temp)
+WHERE protein.pid = new.pid
+"""
+
+
+def read_checkpoint(fname: str) -> Tuple[int, Set[int]]:
+    """Last processed pid and pids whose fetches failed, to be retried"""
+    if not os.path.isfile(fname):
+        return 0, set()
+    with open(fname) as f:
+        lines = f.read().split("\n")
+    last_pid = int(lines[0].strip() or 0)
+    failed = {int(pid) for line in lines[1:] for pid in line.split()}
+    return last_pid, failed
+
+
+def write_checkpoint(fname: str, last_pid: int, failed: Set[int]) -> None:
+    # Renamed into place so an interrupted write never loses the checkpoint
+    with open(f"{fname}.tmp", "w") as f:
+        f.write(f"{last_pid}\n")
+        f.write(" ".join(str(pid) for pid in sorted(failed)) + "\n")
+    os.replace(f"{fname}.tmp", fname)
+
+
+def stream_missing(
+    targets: List[str], last_pid: int, batch_size: int, retry: Set[int] = ()
+) -> Iterator[List[Tuple]]:
+    """Batches of the proteins missing any of the targets, by increasing pid
+
+    Each batch is read in its own short query after the pid of the
+    previous one, so no connection or transaction is held open for the
+    whole backfill. The pids in retry are included even when they are not
+    after last_pid.
+
+    Yields:
+        List[Tuple]: pid, idcode and the missing targets of each protein
+    """
+    columns = ", ".join(f"{MISSING[target]} AS {target}" for target in targets)
+    filters = " OR ".join(f"({MISSING[target]})" for target in targets)
+    query = (
+        f"SELECT protein.pid, protein.idcode, {columns} FROM protein "
+        f"WHERE protein.pid > :after "
+        f"AND (protein.pid > :last_pid OR protein.pid = ANY(:retry)) "
+        f"AND ({filters}) ORDER BY protein.pid LIMIT :batch_size"
+    )
+    params = {"last_pid": last_pid, "retry": list(retry), "batch_size": batch_size}
+    # The pids up to last_pid are only read from the first retried one
+    after = min([last_pid, *(pid - 1 for pid in retry)])
+    while True:
+        with db.connect() as conn:
+            rows = conn.execute(text(query), {**params, "after": after}).fetchall()
+        if not rows:
+            return
+        yield [
+            (pid, idcode.strip(), [t for t, missing in zip(targets, flags) if missing])
+            for pid, idcode, *flags in rows
+        ]
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+
+def read_cached(idcode: str, ftype: str) -> str:
+    cached = CACHE.fetch(idcode, ftype)
+    if not cached:
+        return None
+    with open(cached) as f:
+        return f.read()
+
+
+def fetch_annotations(pid: int, idcode: str, targets: List[str]) -> dict:
+    """Downloads and parses the missing annotations of a protein
+
+    Returns:
+        dict: rows to be written for each target that could be fetched,
+            and the targets whose download failed under "failed"
+    """
+    annotations = {"pid": pid, "failed": []}
+
+    if "sequence" in targets or "validation" in targets:
+        # The entry document is shared by the sequence and validation targets
+        entry = FETCHER.get_json(f"rest/v1/core/entry/{idcode}")
+        if entry and "sequence" in targets:
+            entities = entry_entities(entry)
+            documents = FETCHER.entity_documents(idcode, entities)
+            if documents is None:
+                # Partial rows would mark the sequence target as no longer missing
+                annotations["failed"].append("sequence")
+            else:
+                annotations["sequence"] = parse_sequence_info(pid, entities, documents)
+        if entry and "validation" in targets:
+            annotations["validation"] = parse_structure_quality(pid, entry)
+        if not entry:
+            annotations["failed"] += [
+                target for target in ("sequence", "validation") if target in targets
+            ]
+
+    if "conditions" in targets:
+        cif_fname = CACHE.fetch(idcode, "cif")
+        if cif_fname:
+            annotations["conditions"] = parse_experimental_conditions(cif_fname)
+        else:
+            annotations["failed"].append("conditions")
+
+    if "fasta" in targets:
+        fasta_file = read_cached(idcode, "fasta")
+        if fasta_file:
+            annotations["fasta"] = fasta_file
+        else:
+            annotations["failed"].append("fasta")
+
+    return annotations
+
+
+def write_batch(batch: List[dict]) -> None:
+    """Inserts the annotations of a batch of proteins in a single transaction"""
+    seqaligns = [row for ann in batch for row in ann.get("sequence", [])]
+    validations = [ann["validation"] for ann in batch if "validation" in ann]
+    fastas = [
+        {"pid": ann["pid"], "fasta_file": ann["fasta"]} for ann in batch if "fasta" in ann
+    ]
+    conditions = [
+        (ann["pid"], *ann["conditions"])
+        for ann in batch
+        if "conditions" in ann and any(ann["conditions"])
+    ]
+
+    with db.begin() as conn:
+        if seqaligns:
+            conn.execute(insert(SequenceAlign).values(seqaligns))
+        if validations:
+            conn.execute(
+                insert(StructureValidation).values(validations).on_conflict_do_nothing()
+            )
+        if fastas:
+            conn.execute(insert(Fasta).values(fastas).on_conflict_do_nothing())
+        if conditions:
+            pids, phs, temps = zip(*conditions)
+            conn.execute(
+                text(UPDATE_CONDITIONS_QUERY),
+                {"pids": list(pids), "phs": list(phs), "temps": list(temps)},
+            )
+
+
+def backfill(
+    targets: List[str], batch_size: int, workers: int, checkpoint: str
+) -> int:
+    """Annotates every protein missing any of the targets
+
+    Each batch is fetched concurrently while the previous one is being
+    written, and the last written pid is checkpointed after each batch
+    so that an interrupted backfill resumes where it stopped. Proteins
+    with a failed download are kept in the checkpoint and retried by the
+    next run.
+
+    Returns:
+        int: number of processed proteins
+    """
+    last_pid, failed = read_checkpoint(checkpoint)
+    if last_pid:
+        logging.info(
+            f"Resuming the backfill after PID {last_pid}, "
+            f"retrying {len(failed)} failed proteins"
+        )
+
+    nprocessed = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def write_oldest() -> None:
+            nonlocal nprocessed, last_pid
+            batch_last_pid, futures = pending.popleft()
+            batch = [future.result() for future in futures]
+            write_batch(batch)
+
+            for ann in batch:
+                if ann["failed"]:
+                    failed.add(ann["pid"])
+                else:
+                    failed.discard(ann["pid"])
+            last_pid = max(last_pid, batch_last_pid)
+            write_checkpoint(checkpoint, last_pid, failed)
+            nprocessed += len(futures)
+            logging.info(
+                f"Processed {nprocessed} proteins, up to PID {last_pid}, "
+                f"{len(failed)} failed"
+            )
+
+        for proteins in stream_missing(targets, last_pid, batch_size, failed.copy()):
+            futures = [
+                pool.submit(fetch_annotations, pid, idcode, missing)
+                for pid, idcode, missing in proteins
+            ]
+            pending.append((proteins[-1][0], futures))
+            if len(pending) > 1:
+                write_oldest()
+
+        while pending:
+            write_oldest()
+
+    return nprocessed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--batch-size", default=200, type=int)
+    parser.add_argument("--workers", default=16, type=int)
+    parser.add_argument("--checkpoint", default="backfill.checkpoint")
+    parser.add_argument("--restart", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    if args.restart and os.path.isfile(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    nprocessed = backfill(
+        list(args.targets), args.batch_size, args.workers, args.checkpoint
+    )
+    logging.info(f"Backfill finished, {nprocessed} proteins processed")
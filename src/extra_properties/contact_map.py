@@ -2,16 +2,53 @@ import os
 import sys
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
-from typing import Tuple, Dict, List, Any, Optional
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from typing import Tuple, Dict, List, Any, Optional, Iterator
 import logging
 
 file_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(1, f"{file_dir}/../")
-from db import session, Protein, PDB, Contact_map, db, PKPDB
-from utils import get_sites, get_pdb
-
-pkpdb = PKPDB()
+from db import session, config, Protein, Contact_map, db
+from utils import reset_peak_rss, peak_rss
+from structure import StructureContext
+
+# Maximum distance in angstroms of the stored atom pairs of a sparse map
+# (csr_triu layout), 0 stores the dense map of every pair
+CUTOFF = float(config.get("contact_cutoff", 0))
+
+# Distances are stored as little-endian binary arrays of this type
+DTYPE = np.dtype(config.get("contact_dtype", "float32")).newbyteorder("<")
+PAIRS_DTYPE = np.dtype("<i4")
+OFFSETS_DTYPE = np.dtype("<i8")
+# Bytes sent per large object write
+WRITE_CHUNK = 16 * 1024**2
+# Bytes of intermediate arrays allowed for each block of the computation
+MEMORY_BUDGET = int(config.get("contact_memory_budget", 256 * 1024**2))
+
+# Approximate bytes held per computed distance of a dense and a sparse block
+DENSE_BYTES = 24
+SPARSE_BYTES = 96
+
+INSERT_QUERY = """
+INSERT INTO contact_map(pid, anumbs, anames, chains, resnumbs, resnames,
+                        cutoff, layout, dtype, distances_oid, pairs_oid, offsets_oid)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# Maps saved before the binary format keep their distances in arrays
+ARRAY_MAPS_QUERY = """
+SELECT pid FROM contact_map
+WHERE distances_oid IS NULL AND distances IS NOT NULL
+ORDER BY pid
+"""
+
+MIGRATE_QUERY = """
+UPDATE contact_map
+SET layout = %s, dtype = %s, distances_oid = %s, pairs_oid = %s,
+    distances = NULL, atom1 = NULL, atom2 = NULL
+WHERE pid = %s
+"""
 
 titratable_hs = {
     "NT3": ("H1", "H2", "H3"),
@@ -25,6 +62,9 @@ titratable_hs = {
     "TH3": ("HG1", "HG2", "HG3"),
     "SE3": ("HG1", "HG2", "HG3"),
 }
+TITRATABLE_HS = np.array(
+    [f"{resname}:{aname}" for resname, anames in titratable_hs.items() for aname in anames]
+)
 
 
 class atoms_distances:
@@ -34,116 +74,361 @@ class atoms_distances:
         self.distance = None
 
 
-def read_pdb_line(line: str) -> tuple:
-    aname = line[12:16].strip()
-    anumb = int(line[5:11].strip())
-    b = line[16]
-    resname = line[17:21].strip()
-    chain = line[21]
-    resnumb = int(line[22:26])
-    icode = line[26]
-    x = float(line[30:38])
-    y = float(line[38:46])
-    z = float(line[46:54])
-    return (aname, anumb, b, resname, chain, resnumb, x, y, z, icode)
-
-
-def dist_between(
-    x: float, y: float, z: float, x2: float, y2: float, z2: float
-) -> float:
-    return (x - x2) ** 2 + (y - y2) ** 2 + (z - z2) ** 2
-
-
-def clean_pdb_atoms(pid: int) -> list:
-    """Removes all atoms from pdb_f that are not Nitrogen, Sulfur, or Oxygen
+def clean_pdb_atoms(atoms: np.ndarray) -> np.ndarray:
+    """Removes all atoms that are not Nitrogen, Sulfur, Oxygen or titratable hydrogens
 
     Args:
-        pid (int)
+        atoms (np.ndarray): atom table of the structure with hydrogens
 
     Returns:
-        list: each line is a original line from pdb_f where
-              the atom type is either a Nitrogen, Sulfur, or Oxygen
+        np.ndarray: atoms of the first conformer where the atom type is
+              either a Nitrogen, Sulfur, Oxygen or a titratable hydrogen
     """
-    pdb_content = session.query(PDB.pdb_file_hs).filter_by(pid=pid).first()[0]
-
-    short_pdb = []
-    for line in pdb_content.splitlines():
-        if line.startswith("ATOM "):
-            line_cols = read_pdb_line(line)
-            (aname, anumb, b, resname, chain, resnumb, x, y, z, icode) = line_cols
-
-            if b not in (" ", "A") or icode != " ":
-                continue
-
-            if aname[0] not in "NOS":
-                if resname not in titratable_hs:
-                    continue
-                if aname not in titratable_hs[resname]:
-                    continue
+    first_conformer = np.isin(atoms["altloc"], (" ", "A")) & (atoms["icode"] == " ")
+    heavy = np.isin(atoms["aname"].astype("U1"), ("N", "O", "S"))
+    atom_keys = np.char.add(np.char.add(atoms["resname"], ":"), atoms["aname"])
+    titratable = np.isin(atom_keys, TITRATABLE_HS)
 
-            short_pdb.append((aname, anumb, resname, chain, resnumb, x, y, z))
+    return atoms[first_conformer & (heavy | titratable)]
 
-            # with open("ccc_short.pdb", "a") as f:
-            #    f.write(line.strip() + "\n")
-
-    return short_pdb
-
-
-def calc_dists(short_pdb: list, pid: int) -> None:
 
+def atoms_frame(atoms: np.ndarray) -> pd.DataFrame:
     df = pd.DataFrame(
-        short_pdb,
-        columns=["aname", "anumb", "resname", "chain", "resnumb", "x", "y", "z"],
+        {
+            column: atoms[column]
+            for column in ("aname", "anumb", "resname", "chain", "resnumb")
+        }
     )
+    df[["x", "y", "z"]] = atoms["xyz"]
+    return df
 
-    dists = pdist(df[["x", "y", "z"]])
-    # squareform(dists)
-    return df, dists
 
+def dense_blocks(
+    coords: np.ndarray, budget: int = MEMORY_BUDGET
+) -> Iterator[Tuple[np.ndarray, None]]:
+    """Condensed distance matrix of coords, computed in blocks of rows
 
-def save_contact_map(idcode: str, pid: int) -> None:
+    Yields:
+        Tuple[np.ndarray, None]: consecutive parts of the condensed matrix
+    """
+    natoms = len(coords)
+    if natoms < 2:
+        return
+    nrows = max(1, budget // (DENSE_BYTES * natoms))
+    for start in range(0, natoms - 1, nrows):
+        end = min(start + nrows, natoms - 1)
+        block = cdist(coords[start:end], coords)
+        upper = np.arange(natoms)[None, :] > np.arange(start, end)[:, None]
+        yield block[upper].astype(DTYPE), None
+
+
+def sparse_blocks(
+    coords: np.ndarray, cutoff: float, budget: int = MEMORY_BUDGET
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Neighbours closer than cutoff of each atom, computed in blocks of atoms
+
+    Every pair is kept once, from its first atom, so the later neighbours
+    of an atom are contiguous in the output. The neighbours of every atom
+    are counted first so that each block holds as many atoms as fit in the
+    memory budget.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray]: distances and (npairs, 2) atom positions
+            of consecutive pairs i < j, ordered by i and then j
+    """
+    tree = cKDTree(coords)
+    nneighbours = tree.query_ball_point(coords, cutoff, return_length=True)
+
+    max_pairs = max(1, budget // SPARSE_BYTES)
+    start = 0
+    while start < len(coords):
+        # Every atom of the block is included while its neighbours fit
+        npairs = np.cumsum(nneighbours[start:])
+        end = start + max(1, int(np.searchsorted(npairs, max_pairs, side="right")))
+
+        found = cKDTree(coords[start:end]).sparse_distance_matrix(
+            tree, cutoff, output_type="ndarray"
+        )
+        atom1 = found["i"] + start
+        atom2 = found["j"]
+        later = atom2 > atom1
+        atom1, atom2, dists = atom1[later], atom2[later], found["v"][later]
+        del found
+
+        order = np.lexsort((atom2, atom1))
+        pairs = np.column_stack((atom1[order], atom2[order])).astype(PAIRS_DTYPE)
+        yield dists[order].astype(DTYPE), pairs
+        start = end
+
+
+def write_array(lobj, array: np.ndarray) -> None:
+    """Appends the raw bytes of array to an open large object"""
+    content = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    # Written in chunks so that only one chunk is ever copied
+    for start in range(0, len(content), WRITE_CHUNK):
+        lobj.write(content[start : start + WRITE_CHUNK].tobytes())
+
+
+def read_large_object(dbapi_conn, oid: int, dtype: np.dtype) -> np.ndarray:
+    lobj = dbapi_conn.lobject(oid, "rb")
+    content = lobj.read()
+    lobj.close()
+    return np.frombuffer(content, dtype=dtype)
+
+
+def save_contact_map(
+    idcode: str,
+    pid: int,
+    cutoff: float = CUTOFF,
+    budget: int = MEMORY_BUDGET,
+    structure: StructureContext = None,
+) -> None:
     cm_exists = session.query(Contact_map.pid).filter_by(pid=pid).first()
     if cm_exists:
         logging.warning(f"The contact map of {idcode} already exists!")
         return
 
-    short_pdb = clean_pdb_atoms(pid)
-
-    df, dists = calc_dists(short_pdb, pid)
-
-    sql_query = f"""
-INSERT INTO contact_map(PID, DISTANCES, ANUMBS, ANAMES, CHAINS, RESNUMBS, RESNAMES)
-VALUES ({pid}, '{str(np.round(dists, 4).tolist()).replace('[', '{').replace(']', '}')}', ARRAY{df.anumb.values.tolist()}, ARRAY{df.aname.values.tolist()}, ARRAY{df.chain.values.tolist()}, ARRAY{df.resnumb.values.tolist()}, ARRAY{df.resname.values.tolist()}) """
-    pkpdb.exec_statement(sql_query)
-    pkpdb.commit()
-    pkpdb.reconnect()
-
-    # sql_query = f"""
-    # UPDATE contact_map SET DISTANCES = DISTANCES || '{str(np.round(dists, 4).tolist()[8000000:]).replace('[', '{').replace(']', '}')}' WHERE PID = {pid}
-    # """
-    # pkpdb.exec_statement(sql_query)
-    # pkpdb.commit()
-    # pkpdb.reconnect()
-    # new_cm = Contact_map(
-    #    pid=pid,
-    #    distances=str(np.round(dists, 4).tolist()),
-    #    anumbs=,
-    #    anames=,
-    #    chains=,
-    #    resnumbs=,
-    #    resnames=,
-    # )
-    # session.add(new_cm)
-    # session.commit()
+    reset_peak_rss()
+    if structure is None:
+        structure = StructureContext(pid, idcode)
+    atoms = clean_pdb_atoms(structure.hs_atoms)
+    df = atoms_frame(atoms)
+    coords = atoms["xyz"]
+    del atoms
+
+    if cutoff:
+        blocks = sparse_blocks(coords, cutoff, budget)
+        layout = "csr_triu"
+    else:
+        blocks = dense_blocks(coords, budget)
+        cutoff = None
+        layout = "dense"
+
+    # Each block is streamed to the large objects as soon as it is computed
+    dbapi_conn = db.raw_connection()
+    try:
+        distances_lobj = dbapi_conn.lobject(0, "wb")
+        pairs_lobj = offsets_lobj = None
+        if layout == "csr_triu":
+            pairs_lobj = dbapi_conn.lobject(0, "wb")
+            offsets_lobj = dbapi_conn.lobject(0, "wb")
+            nneighbours = np.zeros(len(coords), dtype=OFFSETS_DTYPE)
+
+        ndists = 0
+        for dists, pairs in blocks:
+            write_array(distances_lobj, dists)
+            if pairs_lobj:
+                # The first atom of each pair is given by the row offsets
+                write_array(pairs_lobj, pairs[:, 1])
+                nneighbours += np.bincount(pairs[:, 0], minlength=len(coords))
+            ndists += len(dists)
+            del dists, pairs
+
+        if offsets_lobj:
+            write_array(offsets_lobj, np.concatenate(([0], np.cumsum(nneighbours))))
+
+        params = (
+            pid,
+            df.anumb.values.tolist(),
+            df.aname.values.tolist(),
+            df.chain.values.tolist(),
+            df.resnumb.values.tolist(),
+            df.resname.values.tolist(),
+            cutoff,
+            layout,
+            DTYPE.str,
+            distances_lobj.oid,
+            pairs_lobj.oid if pairs_lobj else None,
+            offsets_lobj.oid if offsets_lobj else None,
+        )
+        for lobj in (distances_lobj, pairs_lobj, offsets_lobj):
+            if lobj:
+                lobj.close()
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(INSERT_QUERY, params)
+        dbapi_conn.commit()
+    except:
+        dbapi_conn.rollback()
+        raise
+    finally:
+        dbapi_conn.close()
+
+    logging.info(
+        f"Contact map of {idcode}: {len(df)} atoms, {ndists} distances, "
+        f"peak RSS {peak_rss() / 1024**2:.0f} MB"
+    )
+
+
+def mirror_pairs(
+    dists: np.ndarray, pairs: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Each pair i < j of a sparse map from both atoms, ordered by atom and neighbour"""
+    dists = np.concatenate((dists, dists))
+    pairs = np.concatenate((pairs, pairs[:, ::-1]))
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    return dists[order], pairs[order]
+
+
+def load_contact_map(
+    pid: int, mirror: bool = False
+) -> Tuple[pd.DataFrame, np.ndarray, Optional[np.ndarray]]:
+    """Reads a stored contact map
+
+    Args:
+        pid (int)
+        mirror (bool): return the pairs of sparse maps from both atoms
+
+    Returns:
+        Tuple: atoms dataframe, distances and, for sparse maps, the (npairs, 2)
+            positions of the atoms of each distance with the first atom
+            before the second, unless mirror is set. Dense maps hold the
+            condensed distance matrix and no pairs.
+    """
+    dbapi_conn = db.raw_connection()
+    try:
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT anumbs, anames, chains, resnumbs, resnames, layout, dtype, "
+                "distances_oid, pairs_oid, offsets_oid, distances, atom1, atom2 "
+                "FROM contact_map WHERE pid = %s",
+                (pid,),
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        anumbs, anames, chains, resnumbs, resnames, layout, dtype = row[:7]
+        distances_oid, pairs_oid, offsets_oid, distances, atom1, atom2 = row[7:]
+        df = pd.DataFrame(
+            {
+                "aname": anames,
+                "anumb": anumbs,
+                "resname": resnames,
+                "chain": chains,
+                "resnumb": resnumbs,
+            }
+        )
+
+        pairs = None
+        if distances_oid is None:
+            # Maps saved before the binary format
+            dists = np.array(distances, dtype=np.float32)
+            if atom1 is not None:
+                pairs = np.column_stack((atom1, atom2))
+        else:
+            dists = read_large_object(dbapi_conn, distances_oid, np.dtype(dtype))
+        if layout == "pairs" and distances_oid is not None:
+            pairs = read_large_object(dbapi_conn, pairs_oid, PAIRS_DTYPE).reshape(-1, 2)
+        elif layout in ("csr", "csr_triu"):
+            offsets = read_large_object(dbapi_conn, offsets_oid, OFFSETS_DTYPE)
+            atom1 = np.repeat(np.arange(len(df), dtype=PAIRS_DTYPE), np.diff(offsets))
+            atom2 = read_large_object(dbapi_conn, pairs_oid, PAIRS_DTYPE)
+            # csr maps store each pair from both atoms, only one is kept
+            first = atom1 < atom2
+            pairs = np.column_stack((atom1[first], atom2[first]))
+            dists = dists[first]
+        dbapi_conn.commit()
+    finally:
+        dbapi_conn.close()
+
+    if mirror and pairs is not None:
+        dists, pairs = mirror_pairs(dists, pairs)
+    return df, dists, pairs
+
+
+def migrate_array_maps() -> int:
+    """Moves the maps saved before the binary format to large objects
+
+    Their distances, rounded to 4 decimals, and atom pairs are rewritten
+    as float32 and int32 large objects, so that every map is read the same
+    way, and the arrays are emptied. Each map is committed on its own.
+
+    Returns:
+        int: number of migrated maps
+    """
+    dbapi_conn = db.raw_connection()
+    try:
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(ARRAY_MAPS_QUERY)
+            pids = [pid for (pid,) in cursor.fetchall()]
+
+        for pid in pids:
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT distances, atom1, atom2 FROM contact_map "
+                    "WHERE pid = %s FOR UPDATE",
+                    (pid,),
+                )
+                distances, atom1, atom2 = cursor.fetchone()
+
+                dtype = np.dtype("<f4")
+                distances_lobj = dbapi_conn.lobject(0, "wb")
+                write_array(distances_lobj, np.array(distances, dtype=dtype))
+                distances_oid = distances_lobj.oid
+                distances_lobj.close()
+                pairs_oid = None
+                if atom1 is not None:
+                    pairs_lobj = dbapi_conn.lobject(0, "wb")
+                    write_array(
+                        pairs_lobj, np.column_stack((atom1, atom2)).astype(PAIRS_DTYPE)
+                    )
+                    pairs_oid = pairs_lobj.oid
+                    pairs_lobj.close()
+                layout = "dense" if atom1 is None else "pairs"
+                del distances, atom1, atom2
+
+                cursor.execute(
+                    MIGRATE_QUERY,
+                    (layout, dtype.str, distances_oid, pairs_oid, pid),
+                )
+            dbapi_conn.commit()
+            logging.info(f"Moved the {layout} contact map of PID {pid}")
+    except:
+        dbapi_conn.rollback()
+        raise
+    finally:
+        dbapi_conn.close()
+
+    return len(pids)
 
 
 if __name__ == "__main__":
 
     # for idcode in idcodes_to_process("urgent_idcodes"):
 
-    idcode = sys.argv[1]
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("idcode", nargs="?")
+    parser.add_argument(
+        "--cutoff",
+        default=CUTOFF,
+        type=float,
+        help="store a sparse map of the atom pairs within this distance",
+    )
+    parser.add_argument(
+        "--dense", action="store_true", help="store the distances of every atom pair"
+    )
+    parser.add_argument("--memory-budget", default=MEMORY_BUDGET, type=int)
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="move the maps saved in the distances arrays to large objects",
+    )
+    args = parser.parse_args()
+
+    if args.migrate:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+        nmigrated = migrate_array_maps()
+        logging.info(f"Moved {nmigrated} contact maps to large objects")
+        sys.exit(0)
+    if args.idcode is None:
+        parser.error("an idcode is required")
+
+    idcode = args.idcode
     print("############", idcode, "############")
 
     pid = session.query(Protein.pid).filter_by(idcode=idcode).first()[0]
 
-    save_contact_map(idcode, pid)
+    cutoff = 0 if args.dense else args.cutoff
+    save_contact_map(idcode, pid, cutoff, args.memory_budget)
@@ -2,13 +2,100 @@
 
 import os
 import sys
+import fcntl
+import shutil
 import logging
+import argparse
+import tempfile
 import subprocess
+from typing import Dict, Iterator, List, Optional, Tuple
 
 file_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(1, f"{file_dir}/../")
-from db import session, Protein, Fasta, Similarity, Pk_sim
+from db import db, session, config, Protein, Fasta, Similarity, Pk_sim
 from utils import download_fasta
+from extra_properties.sequence_index import get_index
+from sqlalchemy import select, exists
+from sqlalchemy.dialects.postgresql import insert
+
+MMSEQS = config.get("mmseqs_exec", "mmseqs")
+DB_FILE_PATH = config.get("mmseqs_db", f"{file_dir}/DB_PDB/DB_PDB")
+# Root of the scratch directories of every mmseqs run
+SCRATCH_DIR = config.get("mmseqs_scratch", tempfile.gettempdir())
+MAX_SEQS = 1000000
+# Novel sequences with an indexed near-duplicate of at least this ungapped
+# identity reuse its similar idcodes instead of being searched, 0 disables it
+NEAR_IDENTITY = float(config.get("near_duplicate_identity", 0))
+
+
+def scratch_dir() -> str:
+    # Each run gets its own directory, so concurrent workers never share files
+    return tempfile.mkdtemp(prefix=f"mmseqs_{os.getpid()}_", dir=SCRATCH_DIR)
+
+
+def mmseqs(*args: str) -> None:
+    subprocess.run(
+        [MMSEQS, *args], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+
+def ensure_index(scratch: str) -> None:
+    """Builds the persistent index of the target database once
+
+    mmseqs search reuses a precomputed index found next to the target
+    database instead of building one in every search. Workers wait on a
+    lock while another one builds it.
+    """
+    if os.path.isfile(f"{DB_FILE_PATH}.idx"):
+        return
+
+    with open(f"{DB_FILE_PATH}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isfile(f"{DB_FILE_PATH}.idx"):
+            return
+        logging.info(f"Building the mmseqs index of {DB_FILE_PATH}")
+        mmseqs("createindex", DB_FILE_PATH, os.path.join(scratch, "index"))
+
+
+def run_mmseqs(
+    query_fname: str, output_f: str, scratch: str, seqid: float, threads: int = None
+) -> bool:
+    """Searches the queries of a FASTA file against the indexed database
+
+    The queries are converted to a database and searched against the
+    target database by its name, as the precomputed index is only looked
+    up next to it. easy-search would convert the target database again.
+
+    Returns:
+        bool: False if mmseqs did not run successfully
+    """
+    query_db = os.path.join(scratch, "queryDB")
+    result_db = os.path.join(scratch, "alnDB")
+    search_args = ["--min-seq-id", str(seqid), "--max-seqs", str(MAX_SEQS)]
+    if threads:
+        search_args += ["--threads", str(threads)]
+
+    try:
+        ensure_index(scratch)
+        if not os.path.isfile(f"{DB_FILE_PATH}.idx"):
+            logging.warning(f"mmseqs index of {DB_FILE_PATH} is missing")
+            return False
+        mmseqs("createdb", query_fname, query_db)
+        mmseqs(
+            "search",
+            query_db,
+            DB_FILE_PATH,
+            result_db,
+            os.path.join(scratch, "tmp"),
+            *search_args,
+        )
+        mmseqs("convertalis", query_db, DB_FILE_PATH, result_db, output_f)
+    except subprocess.CalledProcessError as e:
+        logging.warning(
+            f"mmseqs did not run successfully\tMessage: {e.stderr.decode('ascii')}"
+        )
+        return False
+    return True
 
 
 def save_fasta(idcode: str, pid: int) -> None:
@@ -24,43 +111,112 @@ def save_fasta(idcode: str, pid: int) -> None:
         session.commit()
 
 
-def get_similar_idcodes(idcode: str, pid: int, seqid: float = 0.9) -> list:
-    if not os.path.isfile(idcode):
-        fasta_file = download_fasta(idcode, pid)
-        if not fasta_file:
-            logging.error("Failed to dowload FASTA of {}".format(idcode))
+def db_version() -> str:
+    # Rewritten whenever the target database is rebuilt
+    return str(os.stat(f"{DB_FILE_PATH}.dbtype").st_mtime_ns)
+
 
-    succeeded = False
+def search_sequences(
+    sequences: Dict[str, str], seqid: float, threads: int = None
+) -> Optional[Dict[str, list]]:
+    """Searches sequences in a single mmseqs run
+
+    Args:
+        sequences (Dict[str, str]): sequence of each digest
+        seqid (float): minimum sequence identity
+        threads (int): threads of mmseqs, all CPUs by default
+
+    Returns:
+        Optional[Dict[str, list]]: idcodes similar to each sequence, in
+            the order found by mmseqs, None if mmseqs failed
+    """
+    digests = list(sequences)
+    scratch = scratch_dir()
     try:
-        output_f = f"alnRes_{idcode}.m8"
-        DB_FILE_PATH = file_dir + "/DB_PDB/DB_PDB"
-
-        cmd = f"mmseqs easy-search {idcode} {DB_FILE_PATH} {output_f} tmp --min-seq-id {seqid} --max-seqs 1000000"
-        subprocess.run(
-            cmd,
-            shell=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        succeeded = True
-    except subprocess.CalledProcessError as e:
-        logging.warning(
-            f"mmseqs did not run successfully\tMessage: {e.stderr.decode('ascii')}"
-        )
+        query_fname = os.path.join(scratch, "queries.fasta")
+        output_f = os.path.join(scratch, "alnRes.m8")
+        with open(query_fname, "w") as f:
+            for n, digest in enumerate(digests):
+                f.write(f">{n}\n{sequences[digest]}\n")
+        if not run_mmseqs(query_fname, output_f, scratch, seqid, threads):
+            return None
 
-    similar = None
-    if succeeded:
-        similar = []
+        hits = {digest: {} for digest in digests}
         with open(output_f) as f:
             for line in f:
-                exc_idcode, _ = line.strip().split()[1].split("_")
-                if exc_idcode != idcode:
-                    similar.append(exc_idcode)
+                query, target = line.split(maxsplit=2)[:2]
+                hits[digests[int(query)]][target.split("_")[0]] = None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return {digest: list(idcodes) for digest, idcodes in hits.items()}
 
-        os.system(f"rm -f {idcode} {output_f}")
 
-    return similar
+def near_duplicate_hits(sequences: Dict[str, str], seqid: float) -> Dict[str, list]:
+    """Hits of the indexed near-duplicates of sequences, see NEAR_IDENTITY"""
+    index = get_index()
+    seqid_hits = index.hits[seqid]
+    hits = {}
+    for digest, sequence in sequences.items():
+        for duplicate, _ in index.near_duplicates(sequence, NEAR_IDENTITY):
+            if duplicate in seqid_hits:
+                hits[digest] = seqid_hits[duplicate]
+                break
+    return hits
+
+
+def search_proteins(
+    queries: List[Tuple[int, str, str]], seqid: float = 0.9, threads: int = None
+) -> Optional[Dict[int, list]]:
+    """idcodes similar to each query protein
+
+    Chains already searched for any protein of the sequence index are not
+    searched again, so mmseqs only runs for novel sequences, each once.
+
+    Args:
+        queries (List[Tuple[int, str, str]]): pid, idcode and FASTA of each protein
+        seqid (float): minimum sequence identity
+        threads (int): threads of mmseqs, all CPUs by default
+
+    Returns:
+        Optional[Dict[int, list]]: similar idcodes of each protein, None if
+            mmseqs failed
+    """
+    index = get_index()
+    index.set_db_version(db_version())
+    index.add_proteins(queries)
+
+    pids = [pid for pid, _, _ in queries]
+    novel = index.unsearched(pids, seqid)
+    if novel and NEAR_IDENTITY:
+        hits = near_duplicate_hits(novel, seqid)
+        index.add_hits(seqid, hits)
+        novel = {digest: novel[digest] for digest in novel if digest not in hits}
+
+    nsequences = sum(len(index.proteins[pid][1]) for pid in pids)
+    logging.info(f"Searching {len(novel)} novel sequences of {nsequences} chains")
+    if novel:
+        hits = search_sequences(novel, seqid, threads)
+        if hits is None:
+            return None
+        index.add_hits(seqid, hits)
+
+    return {pid: index.cluster(pid, seqid) for pid in pids}
+
+
+def get_similar_idcodes(idcode: str, pid: int, seqid: float = 0.9) -> list:
+    fasta_file = session.query(Fasta.fasta_file).filter_by(pid=pid).scalar()
+    if not fasta_file:
+        fasta_file = download_fasta(idcode, pid)
+        os.system(f"rm -f {idcode}")
+    if not fasta_file:
+        logging.error("Failed to dowload FASTA of {}".format(idcode))
+        return None
+
+    similar = search_proteins([(pid, idcode, fasta_file)], seqid)
+    if similar is None:
+        return None
+    return similar[pid]
 
 
 def save_similar_idcodes(idcode: str, pid: int, seqid: float = 0.9):
@@ -77,20 +233,105 @@ def save_similar_idcodes(idcode: str, pid: int, seqid: float = 0.9):
         session.commit()
 
 
-if __name__ == "__main__":
-    subquery1 = session.query(Similarity.pid)
-    subquery2 = session.query(Pk_sim.pid).filter(Pk_sim.tit_curve != None)
-    missing = (
-        session.query(Protein.pid, Protein.idcode)
-        .filter(Protein.pid.notin_(subquery1))
-        .filter(Protein.pid.in_(subquery2))
-        .all()
+def save_similarity_batch(similar: Dict[int, list], seqid: float) -> int:
+    """Inserts the clusters of a batch in a single transaction
+
+    Proteins that got a cluster from another worker meanwhile are skipped.
+
+    Returns:
+        int: number of inserted clusters
+    """
+    with db.begin() as conn:
+        existing = conn.execute(
+            select(Similarity.pid).where(Similarity.pid.in_(list(similar)))
+        ).fetchall()
+        existing = {pid for pid, in existing}
+
+        rows = [
+            {"pid": pid, "cluster": cluster, "seqid": seqid}
+            for pid, cluster in similar.items()
+            if cluster and pid not in existing
+        ]
+        if rows:
+            conn.execute(insert(Similarity).values(rows))
+    return len(rows)
+
+
+def search_batch(
+    queries: List[Tuple[int, str, str]], seqid: float = 0.9, threads: int = None
+) -> int:
+    """Saves the similarity clusters of a batch of query proteins
+
+    Args:
+        queries (List[Tuple[int, str, str]]): pid, idcode and FASTA of each protein
+        seqid (float): minimum sequence identity
+        threads (int): threads of mmseqs, all CPUs by default
+
+    Returns:
+        int: number of saved clusters
+    """
+    similar = search_proteins(queries, seqid, threads)
+    if similar is None:
+        return 0
+    return save_similarity_batch(similar, seqid)
+
+
+def missing_similarity(batch_size: int) -> Iterator[List[Tuple[int, str, str]]]:
+    """Batches of the simulated proteins with a FASTA file but no similarity cluster"""
+    query = (
+        select(Protein.pid, Protein.idcode, Fasta.fasta_file)
+        .join(Fasta, Fasta.pid == Protein.pid)
+        .where(Protein.pid.notin_(select(Similarity.pid).where(Similarity.pid != None)))
+        .where(Protein.pid.in_(select(Pk_sim.pid).where(Pk_sim.tit_curve != None)))
+        .order_by(Protein.pid)
+    )
+    with db.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        for rows in result.partitions(batch_size):
+            yield [(pid, idcode.strip(), fasta_file) for pid, idcode, fasta_file in rows]
+
+
+def missing_fasta(batch_size: int = 1000) -> Iterator[Tuple[int, str]]:
+    """Simulated proteins with neither a FASTA file nor a similarity cluster
+
+    The proteins are read by increasing pid in pages of batch_size, each
+    in its own short query, as the FASTA files are downloaded in between.
+    """
+    query = (
+        select(Protein.pid, Protein.idcode)
+        .where(~exists().where(Fasta.pid == Protein.pid))
+        .where(~exists().where(Similarity.pid == Protein.pid))
+        .where(exists().where(Pk_sim.pid == Protein.pid, Pk_sim.tit_curve != None))
+        .order_by(Protein.pid)
+        .limit(batch_size)
     )
+    last_pid = 0
+    while True:
+        with db.connect() as conn:
+            rows = conn.execute(query.where(Protein.pid > last_pid)).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_pid = rows[-1][0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seqid", default=0.9, type=float)
+    parser.add_argument("--batch-size", default=20000, type=int)
+    parser.add_argument("--threads", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    for pid, idcode in missing_fasta():
+        save_fasta(idcode.strip(), pid)
+        os.system(f"rm -f {idcode.strip()}")
 
-    for pid, idcode in missing:
-        # idcode = sys.argv[1]
-        print("############", idcode, pid, "############")
-        # pid = session.query(Protein.pid).filter_by(idcode=idcode).first()[0]
+    logging.info(f"Indexed {get_index().update()} new FASTA files")
 
-        save_fasta(idcode, pid)
-        save_similar_idcodes(idcode, pid)
+    nsaved = 0
+    for queries in missing_similarity(args.batch_size):
+        logging.info(f"Searching the similar proteins of {len(queries)} proteins")
+        nsaved += search_batch(queries, args.seqid, args.threads)
+    logging.info(f"Saved {nsaved} similarity clusters")
@@ -0,0 +1,224 @@
+#! /usr/bin/python3
+
+import sys
+import time
+import argparse
+import numpy as np
+from math import pi
+from typing import List, Tuple
+from scipy.spatial import cKDTree
+
+from Bio.PDB.PDBParser import PDBParser
+from Bio.PDB.Polypeptide import CaPPBuilder
+from Bio.PDB.vectors import rotaxis
+
+RADIUS = 12.0  # angstroms, the default of Biopython's HSExposure classes
+
+TITRATABLE = ("ASP", "GLU", "HIS", "CYS", "TYR", "LYS")
+
+
+def peptide_cas(model) -> Tuple[List, np.ndarray, np.ndarray, np.ndarray]:
+    """Residues of the CA-CA peptides of model, as used by Biopython's HSExposure
+
+    Returns:
+        Tuple[List, np.ndarray, np.ndarray, np.ndarray]: residues, CA
+            coordinates, and index of the previous and next residue in the
+            same peptide (-1 at the ends)
+    """
+    residues, prev, nxt = [], [], []
+    for pp in CaPPBuilder().build_peptides(model):
+        first = len(residues)
+        last = first + len(pp) - 1
+        for i, residue in enumerate(pp, start=first):
+            residues.append(residue)
+            prev.append(i - 1 if i > first else -1)
+            nxt.append(i + 1 if i < last else -1)
+
+    cas = np.array([residue["CA"].get_coord() for residue in residues], dtype=float)
+    return residues, cas.reshape(-1, 3), np.array(prev, dtype=int), np.array(nxt, dtype=int)
+
+
+def gly_cb_vector(residue) -> np.ndarray:
+    """Pseudo CB-CA vector of a glycine, None if it misses backbone atoms
+
+    The N atom rotated by -120 degrees around the CA-C axis, as in
+    HSExposureCB._get_gly_cb_vector.
+    """
+    try:
+        n_v = residue["N"].get_vector()
+        c_v = residue["C"].get_vector()
+        ca_v = residue["CA"].get_vector()
+    except KeyError:
+        return None
+    n_v = n_v - ca_v
+    c_v = c_v - ca_v
+    rot = rotaxis(-pi * 120.0 / 180.0, c_v)
+    return n_v.left_multiply(rot).get_array()
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return vectors / norms
+
+
+def count_sides(
+    center: np.ndarray, diffs: np.ndarray, directions: np.ndarray, nsites: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Number of neighbours of each site in the half sphere of its direction and opposite"""
+    up = np.einsum("ij,ij->i", diffs, directions[center]) > 0
+    nup = np.bincount(center[up], minlength=nsites)
+    ndown = np.bincount(center[~up], minlength=nsites)
+    return nup, ndown
+
+
+def site_exposure(
+    model, chain_sites: dict, radius: float = RADIUS
+) -> Tuple[dict, dict, dict]:
+    """Half sphere exposures and coordination number of the sites of model
+
+    Equivalent to HSExposureCA, HSExposureCB and ExposureCN with an offset
+    of 0, but the neighbours are only searched for the sites, all at once
+    in a KD-tree of the CA atoms.
+
+    Args:
+        model: Biopython model
+        chain_sites (dict): resnumbs of the sites of each chain
+        radius (float): radius of the sphere in angstroms
+
+    Returns:
+        Tuple[dict, dict, dict]: HSE-CA (u, d, angle), HSE-CB (u, d, 0.0)
+            and CN of each site, keyed by chain id and residue id
+    """
+    residues, cas, prev, nxt = peptide_cas(model)
+    keys = [(residue.get_parent().id, residue.id) for residue in residues]
+    sites = np.array(
+        [
+            i
+            for i, (chain_id, res_id) in enumerate(keys)
+            if chain_id in chain_sites and res_id[1] in chain_sites[chain_id]
+        ],
+        dtype=int,
+    )
+    if not len(sites):
+        return {}, {}, {}
+    nsites = len(sites)
+
+    # Neighbours closer than radius, excluding the site itself
+    tree = cKDTree(cas)
+    neighbours = tree.query_ball_point(cas[sites], radius)
+    center = np.repeat(np.arange(nsites), [len(nb) for nb in neighbours])
+    other = np.fromiter((j for nb in neighbours for j in nb), dtype=int, count=len(center))
+    diffs = cas[other] - cas[sites[center]]
+    close = (other != sites[center]) & (np.linalg.norm(diffs, axis=1) < radius)
+    center, diffs = center[close], diffs[close]
+
+    cn = np.bincount(center, minlength=nsites)
+
+    # HSE-CA is oriented by the sum of the CA-CA vectors of the adjacent residues
+    interior = (prev[sites] >= 0) & (nxt[sites] >= 0)
+    site_cas = cas[sites]
+    pcb = normalized(
+        normalized(site_cas - cas[prev[sites]]) + normalized(site_cas - cas[nxt[sites]])
+    )
+    ca_up, ca_down = count_sides(center, diffs, pcb, nsites)
+
+    # HSE-CB is oriented by the CA-CB vector, or a pseudo CB for glycines,
+    # which is also used for the HSE-CA angle when a glycine has no CB
+    cb_vectors = np.full((nsites, 3), np.nan)
+    angles = [None] * nsites
+    for n, i in enumerate(sites):
+        residue = residues[i]
+        is_gly = residue.get_resname() == "GLY"
+        gly_vector = gly_cb_vector(residue) if is_gly else None
+        real_vector = None
+        if "CB" in residue:
+            real_vector = residue["CB"].get_coord() - residue["CA"].get_coord()
+            real_vector = real_vector.astype(float)
+
+        cb_vector = gly_vector if is_gly else real_vector
+        if cb_vector is not None:
+            cb_vectors[n] = cb_vector
+
+        angle_vector = real_vector if real_vector is not None else gly_vector
+        if interior[n] and angle_vector is not None:
+            unit = normalized(angle_vector)
+            cos = np.dot(unit, pcb[n]) / (np.linalg.norm(unit) * np.linalg.norm(pcb[n]))
+            angles[n] = float(np.arccos(np.clip(cos, -1, 1)))
+    cb_up, cb_down = count_sides(center, diffs, cb_vectors, nsites)
+
+    hse_ca, hse_cb, exposure_cn = {}, {}, {}
+    for n, i in enumerate(sites):
+        key = keys[i]
+        if interior[n]:
+            hse_ca[key] = (int(ca_up[n]), int(ca_down[n]), angles[n])
+        if not np.isnan(cb_vectors[n, 0]):
+            hse_cb[key] = (int(cb_up[n]), int(cb_down[n]), 0.0)
+        exposure_cn[key] = int(cn[n])
+
+    return hse_ca, hse_cb, exposure_cn
+
+
+def max_difference(reference, values: dict) -> float:
+    """Largest difference between a Biopython property map and values of the same keys"""
+    diff = 0.0
+    for key, value in values.items():
+        ref = reference[key]
+        for a, b in zip(np.atleast_1d(ref), np.atleast_1d(value)):
+            if a is None or b is None:
+                if a is not b:
+                    return float("inf")
+                continue
+            diff = max(diff, abs(a - b))
+    return diff
+
+
+def benchmark(pdb_fname: str, radius: float = RADIUS, all_residues: bool = False) -> None:
+    """Compares site_exposure() with Biopython on the sites of a PDB file"""
+    from Bio.PDB.HSExposure import HSExposureCA, HSExposureCB, ExposureCN
+
+    model = PDBParser(QUIET=True).get_structure("benchmark", pdb_fname)[0]
+    chain_sites = {}
+    for residue in model.get_residues():
+        if all_residues or residue.get_resname() in TITRATABLE:
+            chain_sites.setdefault(residue.get_parent().id, set()).add(residue.id[1])
+    nsites = sum(len(sites) for sites in chain_sites.values())
+
+    start = time.perf_counter()
+    hse_ca, hse_cb, exposure_cn = site_exposure(model, chain_sites, radius)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    references = (
+        HSExposureCA(model, radius),
+        HSExposureCB(model, radius),
+        ExposureCN(model, radius),
+    )
+    biopython_time = time.perf_counter() - start
+
+    print(f"{pdb_fname}: {len(list(model.get_residues()))} residues, {nsites} sites")
+    print(f"Biopython   {biopython_time:8.3f} s")
+    print(f"Vectorized  {vectorized_time:8.3f} s ({biopython_time / vectorized_time:.0f}x)")
+    for name, values, reference in zip(
+        ("HSE-CA", "HSE-CB", "CN"), (hse_ca, hse_cb, exposure_cn), references
+    ):
+        missing = sum(1 for key in reference.keys() if key not in values)
+        print(
+            f"{name:7} {len(values)} sites, max difference "
+            f"{max_difference(reference, values):.2e}"
+            + (f", {missing} residues outside the sites" if missing else "")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the vectorized half sphere exposure against Biopython"
+    )
+    parser.add_argument("pdb_files", nargs="+")
+    parser.add_argument("--radius", default=RADIUS, type=float)
+    parser.add_argument("--all-residues", action="store_true")
+    args = parser.parse_args()
+
+    for pdb_fname in args.pdb_files:
+        benchmark(pdb_fname, args.radius, args.all_residues)
+    sys.exit(0)
@@ -0,0 +1,313 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import json
+import zlib
+import fcntl
+import pickle
+import hashlib
+import logging
+import argparse
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, f"{file_dir}/../")
+from db import db, config, Protein, Fasta
+from sqlalchemy import select
+
+INDEX_FILE = config.get("sequence_index", f"{file_dir}/DB_PDB/sequence_index.pkl")
+
+KMER_SIZE = 5
+# Only the k-mers whose checksum is a multiple of this are indexed
+KMER_SAMPLING = 4
+# Fraction of the sampled k-mers of a sequence that a candidate has to share
+MIN_SHARED_KMERS = 0.5
+
+
+def normalize_sequence(sequence: str) -> str:
+    return "".join(sequence.split()).upper()
+
+
+def fasta_sequences(fasta_file: str) -> List[str]:
+    """Normalized sequence of each chain record of a FASTA file"""
+    sequences = []
+    for line in fasta_file.splitlines():
+        if line.startswith(">"):
+            sequences.append("")
+        elif sequences:
+            sequences[-1] += normalize_sequence(line)
+    return [sequence for sequence in sequences if sequence]
+
+
+def sequence_digest(sequence: str) -> str:
+    return hashlib.blake2b(sequence.encode(), digest_size=16).hexdigest()
+
+
+def sampled_kmers(sequence: str, k: int = KMER_SIZE) -> set:
+    # zlib.crc32 is used as it does not change between processes like hash()
+    kmers = {sequence[i : i + k] for i in range(len(sequence) - k + 1)}
+    return {kmer for kmer in kmers if zlib.crc32(kmer.encode()) % KMER_SAMPLING == 0}
+
+
+def identity(sequence1: str, sequence2: str) -> float:
+    """Ungapped identity of two sequences of the same length"""
+    if len(sequence1) != len(sequence2) or not sequence1:
+        return 0.0
+    return sum(a == b for a, b in zip(sequence1, sequence2)) / len(sequence1)
+
+
+class SequenceIndex:
+    """Chain sequences of every protein with a FASTA file, keyed by their hash
+
+    Identical chains share one entry, so the similar idcodes found by
+    mmseqs for a sequence are reused by every protein holding it. Sampled
+    k-mers point to the candidate near-duplicates of a sequence.
+
+    The index is persisted as a snapshot and an append-only log of the
+    changes made since. Every worker appends its changes to the log and
+    reads the changes of the others from it, and compact() folds the log
+    back into the snapshot.
+    """
+
+    def __init__(self, fname: str = INDEX_FILE):
+        self.fname = fname
+        self.log_fname = f"{fname}.log"
+        self.lock_fname = f"{fname}.lock"
+        self.reset()
+
+    def reset(self) -> None:
+        self.db_version = None
+        self.sequences = []  # sequence of each entry
+        self.digests = []  # digest of each entry
+        self.entries = {}  # digest -> entry
+        self.members = []  # entry -> idcodes of the proteins holding the sequence
+        self.kmers = defaultdict(list)  # sampled k-mer -> entries
+        self.proteins = {}  # pid -> idcode and digests of its chains
+        self.hits = defaultdict(dict)  # seqid -> digest -> similar idcodes
+        self.snapshot_id = None
+        self.log_offset = 0
+
+    @contextmanager
+    def locked(self, exclusive: bool = False) -> Iterator[None]:
+        with open(self.lock_fname, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def apply(self, record: dict) -> None:
+        if "db_version" in record:
+            # The similar idcodes are only valid for the database they were found in
+            self.db_version = record["db_version"]
+            self.hits = defaultdict(dict)
+        elif "pid" in record:
+            self.add_sequences(record["pid"], record["idcode"], record["sequences"])
+        elif "hits" in record:
+            seqid_hits = self.hits[record["seqid"]]
+            for digest, idcodes in record["hits"].items():
+                seqid_hits[digest] = [sys.intern(idcode) for idcode in idcodes]
+
+    def add_sequences(self, pid: int, idcode: str, sequences: List[str]) -> None:
+        digests = []
+        for sequence in sequences:
+            digest = sequence_digest(sequence)
+            entry = self.entries.get(digest)
+            if entry is None:
+                entry = len(self.sequences)
+                self.entries[digest] = entry
+                self.sequences.append(sequence)
+                self.digests.append(digest)
+                self.members.append(set())
+                for kmer in sampled_kmers(sequence):
+                    self.kmers[kmer].append(entry)
+            self.members[entry].add(sys.intern(idcode))
+            digests.append(digest)
+        self.proteins[pid] = (idcode, digests)
+
+    def write(self, records: List[dict]) -> None:
+        """Applies records and appends them to the log"""
+        with self.locked(exclusive=True):
+            self.refresh(locked=True)
+            with open(self.log_fname, "a") as f_log:
+                for record in records:
+                    f_log.write(json.dumps(record) + "\n")
+                self.log_offset = f_log.tell()
+        for record in records:
+            self.apply(record)
+
+    def refresh(self, locked: bool = False) -> None:
+        """Loads the changes written by other workers since the last refresh"""
+        if not locked:
+            with self.locked():
+                return self.refresh(locked=True)
+
+        snapshot_id = None
+        if os.path.isfile(self.fname):
+            stat = os.stat(self.fname)
+            snapshot_id = (stat.st_ino, stat.st_mtime_ns)
+        if snapshot_id != self.snapshot_id:
+            # The snapshot was compacted, so the log starts over
+            self.reset()
+            if snapshot_id is not None:
+                with open(self.fname, "rb") as f:
+                    state = pickle.load(f)
+                self.__dict__.update(state)
+            self.snapshot_id = snapshot_id
+
+        if not os.path.isfile(self.log_fname):
+            return
+        with open(self.log_fname) as f_log:
+            f_log.seek(self.log_offset)
+            for line in f_log:
+                self.apply(json.loads(line))
+            self.log_offset = f_log.tell()
+
+    def compact(self) -> None:
+        """Writes every change to the snapshot and empties the log"""
+        with self.locked(exclusive=True):
+            self.refresh(locked=True)
+            state = {
+                key: value
+                for key, value in self.__dict__.items()
+                if key not in ("fname", "log_fname", "lock_fname", "snapshot_id", "log_offset")
+            }
+            with open(f"{self.fname}.tmp", "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{self.fname}.tmp", self.fname)
+            open(self.log_fname, "w").close()
+
+            stat = os.stat(self.fname)
+            self.snapshot_id = (stat.st_ino, stat.st_mtime_ns)
+            self.log_offset = 0
+
+    def set_db_version(self, db_version: str) -> None:
+        self.refresh()
+        if db_version != self.db_version:
+            self.write([{"db_version": db_version}])
+
+    def add_proteins(self, proteins: List[Tuple[int, str, str]]) -> int:
+        """Indexes the chains of the proteins not indexed yet
+
+        Args:
+            proteins (List[Tuple[int, str, str]]): pid, idcode and FASTA of each protein
+
+        Returns:
+            int: number of indexed proteins
+        """
+        self.refresh()
+        records = [
+            {"pid": pid, "idcode": idcode, "sequences": fasta_sequences(fasta_file)}
+            for pid, idcode, fasta_file in proteins
+            if pid not in self.proteins
+        ]
+        if records:
+            self.write(records)
+        return len(records)
+
+    def add_hits(self, seqid: float, hits: Dict[str, List[str]]) -> None:
+        if hits:
+            self.write([{"seqid": seqid, "hits": hits}])
+
+    def update(self, batch_size: int = 5000) -> int:
+        """Indexes the FASTA files saved since the last update
+
+        Returns:
+            int: number of indexed proteins
+        """
+        query = (
+            select(Fasta.pid, Protein.idcode, Fasta.fasta_file)
+            .join(Protein, Protein.pid == Fasta.pid)
+            .order_by(Fasta.pid)
+        )
+        nindexed = 0
+        with db.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            for rows in result.partitions(batch_size):
+                nindexed += self.add_proteins(
+                    [(pid, idcode.strip(), fasta_file) for pid, idcode, fasta_file in rows]
+                )
+        return nindexed
+
+    def unsearched(self, pids: List[int], seqid: float) -> Dict[str, str]:
+        """Sequences of the proteins that were never searched at seqid"""
+        seqid_hits = self.hits[seqid]
+        return {
+            digest: self.sequences[self.entries[digest]]
+            for pid in pids
+            for digest in self.proteins[pid][1]
+            if digest not in seqid_hits
+        }
+
+    def cluster(self, pid: int, seqid: float) -> Optional[List[str]]:
+        """idcodes similar to any chain of a protein, None if a chain was never searched"""
+        idcode, digests = self.proteins[pid]
+        seqid_hits = self.hits[seqid]
+        if any(digest not in seqid_hits for digest in digests):
+            return None
+
+        similar = {}
+        for digest in digests:
+            for exc_idcode in seqid_hits[digest]:
+                if exc_idcode != idcode:
+                    similar[exc_idcode] = None
+        return list(similar)
+
+    def near_duplicates(self, sequence: str, min_identity: float) -> List[Tuple[str, float]]:
+        """Indexed sequences of the same length with at least min_identity
+
+        Only the sequences sharing MIN_SHARED_KMERS of the sampled k-mers
+        of sequence are compared.
+
+        Returns:
+            List[Tuple[str, float]]: digest and identity of each near-duplicate
+        """
+        kmers = sampled_kmers(sequence)
+        shared = Counter(entry for kmer in kmers for entry in self.kmers.get(kmer, ()))
+        min_shared = max(1, MIN_SHARED_KMERS * len(kmers))
+
+        duplicates = []
+        for entry, nshared in shared.items():
+            if nshared < min_shared or len(self.sequences[entry]) != len(sequence):
+                continue
+            entry_identity = identity(sequence, self.sequences[entry])
+            if entry_identity >= min_identity:
+                duplicates.append((self.digests[entry], entry_identity))
+        return sorted(duplicates, key=lambda duplicate: -duplicate[1])
+
+    def stats(self) -> dict:
+        return {
+            "proteins": len(self.proteins),
+            "sequences": len(self.sequences),
+            "searched": {seqid: len(hits) for seqid, hits in self.hits.items()},
+        }
+
+
+_INDEX = None
+
+
+def get_index() -> SequenceIndex:
+    """Shared sequence index of the process, loaded on first use
+
+    Only the similarity commands need it, so the snapshot is not loaded by
+    every process that imports this module.
+    """
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = SequenceIndex()
+    return _INDEX
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compact", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    index = get_index()
+    nindexed = index.update()
+    logging.info(f"Indexed {nindexed} new proteins")
+    if args.compact:
+        index.compact()
+    logging.info(f"Sequence index: {index.stats()}")
@@ -0,0 +1,265 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, f"{file_dir}/../")
+from db import db, Similarity_cluster
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+# Every idcode is a node, numbered by reading its 4 characters in base 36
+NCODES = 36**4
+
+# seqid is REAL, so the parameter has to be rounded the same way
+SEQID = "seqid = CAST(:seqid AS REAL)"
+
+EDGES_QUERY = f"""
+SELECT s.similid, s.pid, p.idcode, array_to_string(s.cluster, ''), cardinality(s.cluster)
+FROM similarity s
+JOIN protein p ON p.pid = s.pid
+WHERE s.{SEQID} AND {{condition}}
+"""
+
+# Similarity rows already in the clusters
+INCLUDED = """EXISTS (
+    SELECT 1 FROM similarity_cluster c
+    WHERE c.pid = s.pid AND c.seqid = s.seqid AND c.similid >= s.similid
+)"""
+NEW_CONDITION = f"NOT {INCLUDED}"
+# Included rows that share an idcode with the new rows, which may connect
+# their clusters through proteins missing from the protein table
+RELATED_CONDITION = f"{INCLUDED} AND s.cluster && CAST(:idcodes AS CHAR(4)[])"
+
+STATE_QUERY = f"""
+SELECT c.pid, p.idcode, c.cluster_id, c.is_representative, c.similid
+FROM similarity_cluster c
+JOIN protein p ON p.pid = c.pid
+WHERE c.{SEQID}
+"""
+
+# The representative of a cluster is the first of its proteins in this order
+QUALITY_QUERY = """
+SELECT p.pid, p.idcode, p.resolution, v.rfree, v.clashscore
+FROM protein p
+LEFT JOIN structure_validation v ON v.pid = p.pid
+WHERE p.idcode ~ '^[0-9A-Za-z]{4}$'
+"""
+QUALITY_ORDER = ["resolution", "rfree", "clashscore", "pid"]
+
+BATCH_SIZE = 10000
+
+
+def encode_idcodes(idcodes: str) -> np.ndarray:
+    """Node of each idcode of a string of concatenated 4 character idcodes"""
+    chars = np.frombuffer(idcodes.lower().encode("ascii"), dtype=np.uint8)
+    chars = chars.reshape(-1, 4).astype(np.int64)
+    digits = np.where(chars >= ord("a"), chars - ord("a") + 10, chars - ord("0"))
+    if ((digits < 0) | (digits >= 36)).any():
+        raise ValueError("idcodes must be alphanumeric")
+    return digits @ 36 ** np.arange(3, -1, -1)
+
+
+def valid_idcodes(*idcodes: str, count: int) -> bool:
+    joined = "".join(idcodes)
+    return len(joined) == 4 * count and joined.isascii() and joined.isalnum()
+
+
+def load_edges(conn, condition: str, params: dict) -> Tuple[np.ndarray, ...]:
+    """Edges between each protein and the idcodes of its similarity cluster
+
+    Returns:
+        Tuple[np.ndarray, ...]: pid and similid of each row, and source
+            and target node of each edge
+    """
+    query = text(EDGES_QUERY.format(condition=condition))
+    pids, similids, sources, targets = [], [], [], []
+    result = conn.execution_options(stream_results=True).execute(query, params)
+    for rows in result.partitions(BATCH_SIZE):
+        rows = [
+            row for row in rows if valid_idcodes(row[2].strip(), row[3], count=1 + row[4])
+        ]
+        if not rows:
+            continue
+        pids.append(np.array([row[1] for row in rows], dtype=np.int64))
+        similids.append(np.array([row[0] for row in rows], dtype=np.int64))
+        own = encode_idcodes("".join(row[2].strip() for row in rows))
+        sources.append(np.repeat(own, [row[4] for row in rows]))
+        targets.append(encode_idcodes("".join(row[3] for row in rows)))
+
+    if not pids:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    return tuple(np.concatenate(arrays) for arrays in (pids, similids, sources, targets))
+
+
+def compress(parent: np.ndarray) -> np.ndarray:
+    """Points every node straight to the root of its tree"""
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def union(parent: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Union-find over whole arrays of edges
+
+    Every round hooks the root of each edge with two different roots to
+    the smaller one, so the roots only decrease and no cycle is formed,
+    and then compresses the paths of every node.
+
+    Returns:
+        np.ndarray: root of each node
+    """
+    parent = compress(parent)
+    while True:
+        source_roots, target_roots = parent[sources], parent[targets]
+        differ = source_roots != target_roots
+        if not differ.any():
+            return parent
+        source_roots, target_roots = source_roots[differ], target_roots[differ]
+        np.minimum.at(
+            parent,
+            np.maximum(source_roots, target_roots),
+            np.minimum(source_roots, target_roots),
+        )
+        parent = compress(parent)
+
+
+def assign_clusters(
+    nodes: pd.DataFrame, roots: np.ndarray, first_id: int
+) -> pd.DataFrame:
+    """cluster_id and representative of every protein node
+
+    Clusters keep the smallest cluster_id of the clusters they merged, and
+    new clusters are numbered from first_id.
+    """
+    nodes = nodes.assign(root=roots[nodes["node"].to_numpy()])
+    cluster_ids = nodes.groupby("root")["old_cluster_id"].min()
+    new_roots = cluster_ids.index[cluster_ids.isna()]
+    cluster_ids[new_roots] = np.arange(first_id, first_id + len(new_roots))
+    nodes["cluster_id"] = cluster_ids[nodes["root"]].to_numpy().astype(np.int64)
+
+    ranked = nodes.sort_values(QUALITY_ORDER, na_position="last")
+    representatives = ranked.drop_duplicates("root")["pid"]
+    nodes["is_representative"] = nodes["pid"].isin(representatives)
+    return nodes
+
+
+def update_clusters(seqid: float = 0.9, rebuild: bool = False) -> int:
+    """Merges the new similarity rows into the clusters of seqid
+
+    Only the new rows and the included rows sharing idcodes with them are
+    loaded. The stored clusters are linked back together as one edge per
+    protein, so the components are the same as with every row.
+
+    Args:
+        seqid (float): sequence identity of the similarity rows
+        rebuild (bool): recompute the clusters from every row
+
+    Returns:
+        int: number of written rows
+    """
+    params = {"seqid": seqid}
+    with db.begin() as conn:
+        if rebuild:
+            conn.execute(text(f"DELETE FROM similarity_cluster WHERE {SEQID}"), params)
+
+        pids, similids, sources, targets = load_edges(conn, NEW_CONDITION, params)
+        if not len(pids):
+            logging.info(f"The clusters at {seqid} are up to date")
+            return 0
+        logging.info(f"Loaded {len(sources)} edges of {len(pids)} new similarity rows")
+
+        state = pd.DataFrame(
+            conn.execute(text(STATE_QUERY), params).fetchall(),
+            columns=["pid", "idcode", "cluster_id", "is_representative", "similid"],
+        )
+        if len(state):
+            idcodes = np.unique(np.concatenate((sources, targets)))
+            idcodes = [f"{np.base_repr(code, 36).lower():0>4}" for code in idcodes]
+            related = load_edges(conn, RELATED_CONDITION, {**params, "idcodes": idcodes})
+            sources = np.concatenate((sources, related[2]))
+            targets = np.concatenate((targets, related[3]))
+
+        proteins = pd.DataFrame(
+            conn.execute(text(QUALITY_QUERY)).fetchall(),
+            columns=["pid", "idcode", "resolution", "rfree", "clashscore"],
+        )
+        proteins["node"] = encode_idcodes("".join(proteins["idcode"].str.strip()))
+
+        # Proteins of the same stored cluster are joined to its first protein
+        state["node"] = encode_idcodes("".join(state["idcode"].str.strip()))
+        first = state.groupby("cluster_id")["node"].transform("first").to_numpy()
+        roots = union(
+            np.arange(NCODES),
+            np.concatenate((sources, state["node"].to_numpy())),
+            np.concatenate((targets, first)),
+        )
+
+        in_graph = np.zeros(NCODES, dtype=bool)
+        in_graph[sources] = in_graph[targets] = True
+        in_graph[state["node"].to_numpy()] = True
+        nodes = proteins[in_graph[proteins["node"].to_numpy()]]
+        nodes = nodes.merge(
+            state[["pid", "cluster_id", "is_representative", "similid"]].rename(
+                columns=lambda column: f"old_{column}" if column != "pid" else column
+            ),
+            on="pid",
+            how="left",
+        )
+        latest = pd.Series(similids, index=pids).groupby(level=0).max()
+        nodes["similid"] = nodes["pid"].map(latest).fillna(nodes["old_similid"])
+
+        first_id = int(state["cluster_id"].max()) + 1 if len(state) else 1
+        nodes = assign_clusters(nodes, roots, first_id)
+        changed = nodes[
+            (nodes["cluster_id"] != nodes["old_cluster_id"])
+            | (nodes["is_representative"] != nodes["old_is_representative"])
+            | (nodes["similid"].fillna(-1) != nodes["old_similid"].fillna(-1))
+        ]
+
+        rows = [
+            {
+                "pid": int(pid),
+                "seqid": seqid,
+                "cluster_id": int(cluster_id),
+                "is_representative": bool(is_representative),
+                "similid": None if pd.isna(similid) else int(similid),
+            }
+            for pid, cluster_id, is_representative, similid in changed[
+                ["pid", "cluster_id", "is_representative", "similid"]
+            ].itertuples(index=False)
+        ]
+        for start in range(0, len(rows), BATCH_SIZE):
+            stmt = insert(Similarity_cluster).values(rows[start : start + BATCH_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["pid", "seqid"],
+                set_={
+                    column: stmt.excluded[column]
+                    for column in ("cluster_id", "is_representative", "similid")
+                },
+            )
+            conn.execute(stmt)
+
+    nclusters = nodes["cluster_id"].nunique()
+    logging.info(f"Wrote {len(rows)} rows, {len(nodes)} proteins in {nclusters} clusters")
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seqid", default=0.9, type=float)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    update_clusters(args.seqid, args.rebuild)
@@ -0,0 +1,317 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, f"{file_dir}/../")
+from db import db, session, Protein
+from sqlalchemy import text
+from utils import get_sites
+from extra_properties.contact_map import load_contact_map, PAIRS_DTYPE, OFFSETS_DTYPE
+
+DEFAULT_RADIUS = 6.0  # angstroms
+
+# Stored elements closer than this are read in a single range
+MAX_GAP = 256
+# Elements read per range, as bytea values can not exceed 1 GB
+MAX_RANGE = 64 * 1024**2
+
+MAP_QUERY = """
+SELECT anumbs, anames, chains, resnumbs, resnames, layout, dtype, cutoff,
+       distances_oid, pairs_oid, offsets_oid
+FROM contact_map
+WHERE pid = :pid
+"""
+
+RANGES_QUERY = """
+SELECT lo_get(:oid, r.start * :itemsize, r.length * :itemsize)
+FROM unnest(CAST(:starts AS BIGINT[]), CAST(:lengths AS INT[]))
+     WITH ORDINALITY AS r(start, length, n)
+ORDER BY r.n
+"""
+
+SITE_COLUMNS = ["chain", "resnumb", "resname", "aname", "anumb"]
+
+
+def read_elements(conn, oid: int, dtype: np.dtype, indices: np.ndarray) -> np.ndarray:
+    """Elements of a large object array at the given indices
+
+    The indices are merged into ranges which are all fetched in a single
+    query, so only the needed parts of the array are transferred.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if not len(indices):
+        return np.empty(0, dtype=dtype)
+
+    unique = np.unique(indices)
+    breaks = np.flatnonzero(np.diff(unique) > MAX_GAP) + 1
+    starts = unique[np.concatenate(([0], breaks))]
+    ends = unique[np.concatenate((breaks - 1, [len(unique) - 1]))] + 1
+
+    # Long ranges are split in parts of at most MAX_RANGE elements
+    nparts = -(-(ends - starts) // MAX_RANGE)
+    part = np.arange(nparts.sum()) - np.repeat(np.cumsum(nparts) - nparts, nparts)
+    starts = np.repeat(starts, nparts) + part * MAX_RANGE
+    lengths = np.minimum(np.repeat(ends, nparts) - starts, MAX_RANGE)
+
+    rows = conn.execute(
+        text(RANGES_QUERY),
+        {
+            "oid": oid,
+            "itemsize": dtype.itemsize,
+            "starts": starts.tolist(),
+            "lengths": lengths.tolist(),
+        },
+    ).fetchall()
+    values = np.frombuffer(b"".join(row[0] for row in rows), dtype=dtype)
+
+    positions = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ranges = np.searchsorted(starts, indices, side="right") - 1
+    return values[positions[ranges] + indices - starts[ranges]]
+
+
+def condensed_index(natoms: int, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+    """Position of the distance between atoms i and j in a condensed matrix"""
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return natoms * i - i * (i + 1) // 2 + j - i - 1
+
+
+def open_contact_map(conn, pid: int) -> dict:
+    """Atoms and storage details of the contact map of pid, None if there is none"""
+    row = conn.execute(text(MAP_QUERY), {"pid": pid}).fetchone()
+    if row is None:
+        return None
+
+    anumbs, anames, chains, resnumbs, resnames = row[:5]
+    layout, dtype, cutoff, distances_oid, pairs_oid, offsets_oid = row[5:]
+    cmap = {
+        "pid": pid,
+        "atoms": pd.DataFrame(
+            {
+                "chain": chains,
+                "resnumb": resnumbs,
+                "resname": resnames,
+                "aname": anames,
+                "anumb": anumbs,
+            }
+        ),
+        "layout": layout,
+        "dtype": np.dtype(dtype) if dtype else None,
+        "cutoff": cutoff,
+        "distances_oid": distances_oid,
+        "pairs_oid": pairs_oid,
+        "offsets": None,
+        "neighbours": None,
+        "loaded": None,
+    }
+
+    if layout in ("csr", "csr_triu"):
+        (offsets,) = conn.execute(
+            text("SELECT lo_get(:oid)"), {"oid": offsets_oid}
+        ).fetchone()
+        cmap["offsets"] = np.frombuffer(offsets, dtype=OFFSETS_DTYPE)
+    if layout == "csr_triu":
+        # Pairs are only stored from their first atom, so the earlier
+        # neighbours of an atom are found in every row
+        (neighbours,) = conn.execute(
+            text("SELECT lo_get(:oid)"), {"oid": pairs_oid}
+        ).fetchone()
+        cmap["neighbours"] = np.frombuffer(neighbours, dtype=PAIRS_DTYPE)
+    elif distances_oid is None or layout == "pairs":
+        # Maps without an index into their storage are read whole
+        _, dists, pairs = load_contact_map(pid)
+        cmap["loaded"] = (dists, pairs)
+
+    return cmap
+
+
+def site_distances(
+    conn, cmap: dict, atoms: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stored distances between each of atoms and the other atoms of the map
+
+    Args:
+        conn: database connection
+        cmap (dict): contact map returned by open_contact_map()
+        atoms (np.ndarray): positions of the site atoms in the map
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: site atom, other atom
+            and distance of each stored pair
+    """
+    natoms = len(cmap["atoms"])
+
+    if cmap["neighbours"] is not None:
+        offsets, neighbours = cmap["offsets"], cmap["neighbours"]
+        counts = offsets[atoms + 1] - offsets[atoms]
+        later = np.repeat(offsets[atoms], counts) + np.arange(counts.sum())
+        later -= np.repeat(np.cumsum(counts) - counts, counts)
+        earlier = np.flatnonzero(np.isin(neighbours, atoms))
+        site = np.concatenate((np.repeat(atoms, counts), neighbours[earlier]))
+        row = np.searchsorted(offsets, earlier, side="right") - 1
+        other = np.concatenate((neighbours[later], row))
+        indices = np.concatenate((later, earlier))
+        dists = read_elements(conn, cmap["distances_oid"], cmap["dtype"], indices)
+        return site.astype(np.int64), other.astype(np.int64), dists
+
+    if cmap["offsets"] is not None:
+        offsets = cmap["offsets"]
+        counts = offsets[atoms + 1] - offsets[atoms]
+        site = np.repeat(atoms, counts)
+        first = np.repeat(offsets[atoms], counts)
+        indices = first + np.arange(len(site)) - np.repeat(np.cumsum(counts) - counts, counts)
+        other = read_elements(conn, cmap["pairs_oid"], PAIRS_DTYPE, indices)
+        dists = read_elements(conn, cmap["distances_oid"], cmap["dtype"], indices)
+        return site, other.astype(np.int64), dists
+
+    if cmap["loaded"] is not None and cmap["loaded"][1] is not None:
+        loaded_dists, pairs = cmap["loaded"]
+        first = np.isin(pairs[:, 0], atoms)
+        second = np.isin(pairs[:, 1], atoms)
+        site = np.concatenate((pairs[first, 0], pairs[second, 1]))
+        other = np.concatenate((pairs[first, 1], pairs[second, 0]))
+        dists = np.concatenate((loaded_dists[first], loaded_dists[second]))
+        return site, other, dists
+
+    # Dense maps hold the distance of every pair at its condensed index
+    site = np.repeat(atoms, natoms)
+    other = np.tile(np.arange(natoms), len(atoms))
+    different = site != other
+    site, other = site[different], other[different]
+    indices = condensed_index(natoms, site, other)
+    if cmap["loaded"] is not None:
+        dists = cmap["loaded"][0][indices]
+    else:
+        dists = read_elements(conn, cmap["distances_oid"], cmap["dtype"], indices)
+    return site, other, dists
+
+
+def contacts_frame(
+    cmap: dict, atoms: np.ndarray, radius: float, conn
+) -> pd.DataFrame:
+    site, other, dists = site_distances(conn, cmap, atoms)
+    close = (dists <= radius) & ~np.isin(other, atoms)
+
+    atoms_df = cmap["atoms"]
+    contacts = pd.concat(
+        [
+            atoms_df.iloc[site[close]].reset_index(drop=True).add_prefix("site_"),
+            atoms_df.iloc[other[close]].reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    contacts["distance"] = dists[close]
+    return contacts.sort_values(["site_anumb", "distance"], ignore_index=True)
+
+
+def check_radius(cmap: dict, radius: float) -> None:
+    if cmap["cutoff"] and radius > cmap["cutoff"]:
+        logging.warning(
+            f"The contact map of PID {cmap['pid']} only holds distances up to "
+            f"{cmap['cutoff']} A, contacts up to {radius} A will be missing"
+        )
+
+
+def get_pid(idcode: str) -> int:
+    pid = session.query(Protein.pid).filter_by(idcode=idcode).first()
+    if pid is None:
+        raise ValueError(f"Unknown idcode {idcode}")
+    return pid[0]
+
+
+def site_contacts(
+    idcode: str, chain: str, resnumb: int, radius: float = DEFAULT_RADIUS
+) -> pd.DataFrame:
+    """Atoms of other residues within radius of the atoms of a site
+
+    Args:
+        idcode (str)
+        chain (str)
+        resnumb (int)
+        radius (float): maximum distance in angstroms
+
+    Returns:
+        pd.DataFrame: one row per site atom and neighbour atom, with the
+            site_* columns describing the site atom
+    """
+    pid = get_pid(idcode)
+    with db.connect() as conn:
+        cmap = open_contact_map(conn, pid)
+        if cmap is None:
+            raise ValueError(f"{idcode} has no contact map")
+        check_radius(cmap, radius)
+
+        atoms_df = cmap["atoms"]
+        atoms = np.flatnonzero(
+            (atoms_df.chain == chain) & (atoms_df.resnumb == resnumb)
+        )
+        if not len(atoms):
+            logging.warning(f"{idcode} has no atoms of {chain} {resnumb}")
+        return contacts_frame(cmap, atoms, radius, conn)
+
+
+def protein_site_contacts(idcode: str, radius: float = DEFAULT_RADIUS) -> pd.DataFrame:
+    """site_contacts() of every titratable site of a protein"""
+    pid = get_pid(idcode)
+    chain_sites = get_sites(pid)
+
+    with db.connect() as conn:
+        cmap = open_contact_map(conn, pid)
+        if cmap is None:
+            raise ValueError(f"{idcode} has no contact map")
+        check_radius(cmap, radius)
+
+        atoms_df = cmap["atoms"]
+        site_keys = {
+            (chain, resnumb) for chain, sites in chain_sites.items() for resnumb in sites
+        }
+        atom_keys = zip(atoms_df.chain, atoms_df.resnumb)
+        in_site = np.fromiter((key in site_keys for key in atom_keys), dtype=bool)
+
+        # Each site is queried separately to keep its ranges small
+        frames = [
+            contacts_frame(cmap, atoms.to_numpy(), radius, conn)
+            for _, atoms in atoms_df[in_site].groupby(["chain", "resnumb"]).groups.items()
+        ]
+
+    if not frames:
+        return contacts_frame(cmap, np.empty(0, dtype=np.int64), radius, None)
+    return pd.concat(frames, ignore_index=True)
+
+
+def contact_residues(contacts: pd.DataFrame) -> pd.DataFrame:
+    """Residues in contact with each site and their closest distance"""
+    site_columns = ["site_chain", "site_resnumb", "site_resname"]
+    residues = contacts.groupby(
+        site_columns + ["chain", "resnumb", "resname"], sort=False, as_index=False
+    )["distance"].min()
+    return residues.sort_values(site_columns[:2] + ["distance"], ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("idcode")
+    parser.add_argument("chain", nargs="?")
+    parser.add_argument("resnumb", nargs="?", type=int)
+    parser.add_argument("--radius", default=DEFAULT_RADIUS, type=float)
+    parser.add_argument("--residues", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    if args.chain is None:
+        contacts = protein_site_contacts(args.idcode, args.radius)
+    elif args.resnumb is None:
+        parser.error("a chain requires a resnumb")
+    else:
+        contacts = site_contacts(args.idcode, args.chain, args.resnumb, args.radius)
+
+    if args.residues:
+        contacts = contact_residues(contacts)
+    contacts.to_csv(sys.stdout, index=False)
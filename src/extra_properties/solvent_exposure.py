@@ -1,96 +1,104 @@
 import sys
 import os
-
-from Bio.PDB.PDBParser import PDBParser
-from Bio.PDB.HSExposure import HSExposureCA, HSExposureCB, ExposureCN
-from Bio.PDB.ResidueDepth import ResidueDepth
+import shlex
+import tempfile
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+
+from Bio.PDB.Polypeptide import is_aa
+from Bio.PDB.ResidueDepth import get_surface
 from Bio.PDB.DSSP import DSSP
 
 file_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(1, f"{file_dir}/../")
-from db import session, Protein, Residue, Residue_props, Pk
-from utils import get_pdb, get_sites
+from db import config, session, Protein, Residue, Residue_props, Pk
+from structure import StructureContext
+from extra_properties.half_sphere import site_exposure
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 
+MSMS = config.get("msms_exec", "msms")
+MKDSSP = config.get("dssp_exec", "mkdssp")
+MSMS_TIMEOUT = int(config.get("msms_timeout", 600))  # seconds
+DSSP_TIMEOUT = int(config.get("dssp_timeout", 600))  # seconds
 
-def calc_hseCA(model, chain_sites: dict) -> None:
-    # HSExposureCA
-    hseCA = HSExposureCA(model)
-    for residue in hseCA.keys():
-        hseCA_u, hseCA_d, hseCA_angle = hseCA[residue]
-        chain_id, res_id = residue
-        _, resnumb, _ = res_id
+PROPS_COLUMNS = [
+    column.name for column in Residue_props.__table__.columns if column.name != "resid"
+]
 
-        if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
-            resid = chain_sites[chain_id][resnumb][1]
-            new_res = chain_sites[chain_id][resnumb][2]
 
-            new_res.hseca_u = hseCA_u
-            new_res.hseca_d = hseCA_d
-            new_res.hseca_angle = hseCA_angle
-    session.commit()
+def site_record(chain_sites: dict, records: dict, residue: tuple) -> dict:
+    """Metrics record of a biopython residue key, None if it is not a site"""
+    chain_id, res_id = residue
+    _, resnumb, _ = res_id
 
+    if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
+        resid = chain_sites[chain_id][resnumb][1]
+        return records[resid]
+    return None
 
-def calc_hseCB(model, chain_sites: dict) -> None:
-    # HSExposureCB
+
+def calc_hse(model, chain_sites: dict, records: dict) -> None:
+    # HSExposureCA, HSExposureCB and ExposureCN of the sites only
     try:
-        hseCB = HSExposureCB(model)
-    except:
-        print("HSE CB failed!")
-        hseCB = {}
-
-    for residue in hseCB.keys():
-        hseCB_u, hseCB_d, hseCB_angle = hseCB[residue]
-        chain_id, res_id = residue
-        _, resnumb, _ = res_id
-
-        if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
-            resid = chain_sites[chain_id][resnumb][1]
-            new_res = chain_sites[chain_id][resnumb][2]
-
-            new_res.hsecb_u = hseCB_u
-            new_res.hsecb_d = hseCB_d
-    session.commit()
+        hseCA, hseCB, hseCN = site_exposure(model, chain_sites)
+    except Exception as e:
+        print(f"HSE failed! {e}")
+        return
 
+    for residue, (hseCA_u, hseCA_d, hseCA_angle) in hseCA.items():
+        new_res = site_record(chain_sites, records, residue)
+        if new_res is not None:
+            new_res["hseca_u"] = hseCA_u
+            new_res["hseca_d"] = hseCA_d
+            new_res["hseca_angle"] = hseCA_angle
 
-def calc_hseCN(model, chain_sites: dict) -> None:
-    # HSExposureCN
-    hseCN = ExposureCN(model)
-    for residue in hseCN.keys():
-        exposure = hseCN[residue]
-        chain_id, res_id = residue
-        _, resnumb, _ = res_id
+    for residue, (hseCB_u, hseCB_d, _) in hseCB.items():
+        new_res = site_record(chain_sites, records, residue)
+        if new_res is not None:
+            new_res["hsecb_u"] = hseCB_u
+            new_res["hsecb_d"] = hseCB_d
 
-        if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
-            resid = chain_sites[chain_id][resnumb][1]
-            new_res = chain_sites[chain_id][resnumb][2]
+    for residue, exposure in hseCN.items():
+        new_res = site_record(chain_sites, records, residue)
+        if new_res is not None:
+            new_res["hsecn"] = exposure
 
-            new_res.hsecn = exposure
-    session.commit()
+
+def msms_surface(model) -> np.ndarray:
+    """Vertices of the molecular surface of model
+
+    get_surface runs msms through the shell, so coreutils timeout stops it
+    after MSMS_TIMEOUT, and get_surface then raises as no surface was written.
+    """
+    return get_surface(model, MSMS=f"timeout {MSMS_TIMEOUT} {shlex.quote(MSMS)}")
 
 
-def calc_msms(model, chain_sites: dict) -> None:
-    # ResidueDepth
+def calc_msms(model, chain_sites: dict, records: dict) -> None:
+    # ResidueDepth of the sites, with the closest vertices found in a KD-tree
     try:
-        rd = ResidueDepth(model)
-    except:
-        print("msms failed!")
-        rd = {}
-
-    for residue in rd.keys():
-        residue_depth, ca_depth = rd[residue]
-        chain_id, res_id = residue
-        _, resnumb, _ = res_id
-
-        if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
-            resid = chain_sites[chain_id][resnumb][1]
-            new_res = chain_sites[chain_id][resnumb][2]
-
-            new_res.residue_depth = residue_depth
-            new_res.ca_depth = ca_depth
-    session.commit()
+        surface = cKDTree(msms_surface(model))
+    except Exception as e:
+        print(f"msms failed! {e}")
+        return
+
+    for residue in model.get_residues():
+        if not is_aa(residue):
+            continue
+        new_res = site_record(chain_sites, records, (residue.get_parent().id, residue.id))
+        if new_res is None:
+            continue
+
+        depths, _ = surface.query([atom.get_coord() for atom in residue.get_unpacked_list()])
+        new_res["residue_depth"] = float(depths.mean())
+        new_res["ca_depth"] = None
+        if residue.has_id("CA"):
+            new_res["ca_depth"] = float(surface.query(residue["CA"].get_coord())[0])
 
 
-def calc_dssp(model, chain_sites: dict, pdb_name: str) -> None:
+def calc_dssp(model, chain_sites: dict, records: dict, pdb_name: str) -> None:
     # DSSP
     #    ============ ===
     #    Tuple Index  Value
@@ -111,11 +119,21 @@ def calc_dssp(model, chain_sites: dict, pdb_name: str) -> None:
     #    13           O-->NH_2_energy
     #    ============ ===
 
+    # mkdssp writes to a file that is parsed afterwards, so it can be timed out
     try:
-        dssp = DSSP(model, pdb_name, dssp="mkdssp")
-    except:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dssp_fname = os.path.join(tmp_dir, "structure.dssp")
+            subprocess.run(
+                [MKDSSP, pdb_name, dssp_fname],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=DSSP_TIMEOUT,
+                check=True,
+            )
+            dssp = DSSP(model, dssp_fname, file_type="DSSP")
+    except Exception as e:
         dssp = {}
-        print("dssp failed!")
+        print(f"dssp failed! {e}")
     for residue in dssp.keys():
         (
             dssp_i,
@@ -134,25 +152,42 @@ def calc_dssp(model, chain_sites: dict, pdb_name: str) -> None:
             o_nh2_e,
         ) = dssp[residue]
 
-        chain_id, res_id = residue
-        _, resnumb, _ = res_id
+        new_res = site_record(chain_sites, records, residue)
+        if new_res is not None:
+            new_res["sec_struct"] = sec_struct
+            new_res["sasa_r"] = sasa_r
+            new_res["phi"] = phi
+            new_res["psi"] = psi
 
-        if chain_id in chain_sites and resnumb in chain_sites[chain_id]:
-            resid = chain_sites[chain_id][resnumb][1]
-            new_res = chain_sites[chain_id][resnumb][2]
 
-            new_res.sec_struct = sec_struct
-            new_res.sasa_r = sasa_r
-            new_res.phi = phi
-            new_res.psi = psi
+def save_records(records: dict) -> None:
+    """Upserts the metrics of every site in a single statement
+
+    Metrics that could not be calculated do not overwrite stored values.
+    """
+    if not records:
+        return
+    rows = [
+        {"resid": resid, **{column: record.get(column) for column in PROPS_COLUMNS}}
+        for resid, record in records.items()
+    ]
+    stmt = insert(Residue_props).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["resid"],
+        set_={
+            column: func.coalesce(stmt.excluded[column], Residue_props.__table__.c[column])
+            for column in PROPS_COLUMNS
+        },
+    )
+    session.execute(stmt)
     session.commit()
 
 
-def calc_all_metrics(pid: int, idcode: str) -> None:
+def calc_all_metrics(pid: int, idcode: str, structure: StructureContext = None) -> None:
     has_dssp = (
         session.query(Residue_props.resid)
         .filter(Residue_props.resid == Residue.resid)
-        .filter(Residue.pid == 1)
+        .filter(Residue.pid == pid)
         .filter(Residue_props.sec_struct != None)
         .first()
     )
@@ -162,30 +197,29 @@ def calc_all_metrics(pid: int, idcode: str) -> None:
         print(to_print)
         return
 
-    _, _, pdb_name = get_pdb(pid, idcode, prefix="tmp_solv_")
-
-    chain_sites = get_sites(pid)
-    for chain in chain_sites:
-        for resnumb in chain_sites[chain]:
-            _, resid = chain_sites[chain][resnumb]
-
-            new_res = session.query(Residue_props).filter_by(resid=resid).first()
-            if not new_res:
-                new_res = Residue_props(resid=resid)
-                session.add(new_res)
-            chain_sites[chain][resnumb].append(new_res)
-    session.flush()
-
-    # biopython parser
-    parser = PDBParser()
-    structure = parser.get_structure("test", pdb_name)
-    model = structure[0]
-
-    calc_hseCA(model, chain_sites)
-    calc_hseCB(model, chain_sites)
-    calc_hseCN(model, chain_sites)
-    calc_msms(model, chain_sites)
-    calc_dssp(model, chain_sites, pdb_name)
+    if structure is None:
+        structure = StructureContext(pid, idcode)
+    # mkdssp is the only calculator reading the structure from a file
+    pdb_name = structure.write_pdb(f"tmp_solv_{idcode}.pdb")
+
+    chain_sites = structure.sites
+    records = {
+        resid: {} for sites in chain_sites.values() for _, resid in sites.values()
+    }
+    model = structure.model
+
+    # The calculators fill different metrics of the records, so they run
+    # concurrently and the msms and mkdssp subprocesses overlap
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        calculations = [
+            pool.submit(calc_hse, model, chain_sites, records),
+            pool.submit(calc_msms, model, chain_sites, records),
+            pool.submit(calc_dssp, model, chain_sites, records, pdb_name),
+        ]
+        for calculation in calculations:
+            calculation.result()
+
+    save_records(records)
 
     os.system(f"rm -f {pdb_name}")
 
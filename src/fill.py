@@ -1,15 +1,27 @@
 #! /usr/bin/python3
 
 import os
+import json
+import time
+import hashlib
+import signal
+import multiprocessing
 import argparse
 import logging
 import traceback
-from sqlalchemy import func, exists, cast, String
+from sqlalchemy import func, exists, cast, String, or_, select
 from sqlalchemy.dialects.postgresql import insert
-from typing import Tuple
-
-from db import session, Protein, Pk_sim, PDB, Residue, Pk, Sim_settings
-from utils import get_pdb, download_pdb, PK_MOD
+from sqlalchemy.exc import OperationalError
+from typing import Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from db import db, session, Protein, Pk_sim, PDB, Residue, Pk, Sim_settings
+from utils import get_pdb, download_pdb, store_pdb_content, PK_MOD
+from download_cache import CACHE, Prefetcher
+from structure import StructureContext
+import sim_queue
+from sim_queue import claim_proteins, finish_claim, release_claims, Heartbeat
+from cost_model import executor_ncpus
 import pypka
 from pypka import __version__ as pypka_version
 
@@ -21,12 +33,24 @@ parser.add_argument("--ncpus", default=8, type=int)
 parser.add_argument("--idcode", type=str)
 parser.add_argument("--nres-limit", default=500, type=int)
 parser.add_argument("--no-post-processing", default=False, action="store_true")
+parser.add_argument("--daemon", default=False, action="store_true")
+parser.add_argument("--poll-interval", default=60, type=int)
+parser.add_argument("--claim-batch", default=1, type=int)
+parser.add_argument("--lease-time", default=900, type=int)
+parser.add_argument("--executor", default=False, action="store_true")
+parser.add_argument("--node-cpus", default=os.cpu_count(), type=int)
+parser.add_argument("--time-budget", type=float)
+parser.add_argument("--prefetch-depth", default=0, type=int)
+parser.add_argument("--prefetch-workers", default=2, type=int)
 parser.add_argument(
     "--verbose", default="INFO", type=str, choices=["DEBUG", "INFO", "WARNING"]
 )
 
 args = parser.parse_args()
 
+if (args.daemon or args.executor) and args.idcode:
+    parser.error("--daemon and --executor can not be used together with --idcode")
+
 VERBOSE_LEVELS = {
     "DEBUG": logging.DEBUG,
     "INFO": logging.INFO,
@@ -38,39 +62,29 @@ logging.basicConfig(
 )
 
 
-def save_pdb(pid: int, fname: str) -> Tuple[float, PDB]:
+def save_pdb(pid: int, idcode: str, fname: str) -> Tuple[int, PDB, StructureContext]:
     # Save the pdb file in the database
-    content = ""
-    nres = 0
-    with open(fname) as f:
-        previous_res = None
-        for line in f:
-            if line.startswith("ATOM "):
-                resi = line[22:26]
-                if resi != previous_res:
-                    nres += 1
-                previous_res = resi
-                content += line
-            if line.startswith("ENDMDL"):
-                break
+    structure = StructureContext.from_file(pid, idcode, fname)
+    nres = structure.nres
 
-    new_pdb = PDB(pid=pid, pdb_file=content)
+    new_pdb = PDB(pid=pid)
+    store_pdb_content(new_pdb, structure.pdb_content)
     session.add(new_pdb)
 
     CUR_PROTEIN.nres = nres
     session.commit()
 
-    return nres, new_pdb
+    return nres, new_pdb, structure
 
 
-def run_pypka(fname: str, pdb_file_Hs: str) -> pypka.Titration:
+def run_pypka(fname: str, pdb_file_Hs: str, ncpus: int) -> pypka.Titration:
     # Run pypka
     parameters = {
         "structure": fname,
         "epsin": 15,
         "ionicstr": 0.1,
         "pbc_dimensions": 0,
-        "ncpus": args.ncpus,
+        "ncpus": ncpus,
         "pH": "-6,20",
         "convergence": 0.01,
         "save_pdb": pdb_file_Hs,
@@ -80,6 +94,47 @@ def run_pypka(fname: str, pdb_file_Hs: str) -> pypka.Titration:
     return tit
 
 
+BOOL_PARAMS = [
+    "CpHMD_mode",
+    "ser_thr_titration",
+    "clean_pdb",
+    "keep_ions",
+    "pbx",
+    "pby",
+]
+
+SETTINGS_CACHE = {}
+
+
+def hash_settings(pypka_params: dict, delphi_params: dict, mc_params: dict) -> str:
+    """Canonical hash of a normalized parameter set"""
+    params = {"pypka": pypka_params, "delphi": delphi_params, "mc": mc_params}
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def find_unhashed_settings(
+    pypka_params: dict, delphi_params: dict, mc_params: dict
+) -> Optional[int]:
+    # Settings saved before params_hash existed can only be found by their content
+    query = session.query(Sim_settings.settid).filter(Sim_settings.params_hash == None)
+    for column, params in (
+        (Sim_settings.pypka_params, pypka_params),
+        (Sim_settings.delphi_params, delphi_params),
+        (Sim_settings.mc_params, mc_params),
+    ):
+        for param in params:
+            to_compare = str(params[param])
+            if param in BOOL_PARAMS:
+                to_compare = to_compare.lower()
+            query = query.filter(column[param].as_string() == to_compare)
+
+    settid = query.first()
+    if settid:
+        return settid[0]
+    return None
+
+
 def save_settings(tit: pypka.Titration) -> None:
     # Save settings
     pypka_params, delphi_params, mc_params = tit.getParametersDict()
@@ -101,67 +156,62 @@ def save_settings(tit: pypka.Titration) -> None:
     pypka_params["version"] = pypka_version
     mc_params["pH_values"] = list(mc_params["pH_values"])
 
-    bool_params = [
-        "CpHMD_mode",
-        "ser_thr_titration",
-        "clean_pdb",
-        "keep_ions",
-        "pbx",
-        "pby",
-    ]
-
-    query = session.query(Sim_settings.settid)
-    for param in pypka_params:
-        to_compare = str(pypka_params[param])
-        if param in bool_params:
-            to_compare = to_compare.lower()
-        query = query.filter(Sim_settings.pypka_params[param].as_string() == to_compare)
-
-    for param in delphi_params:
-        to_compare = str(delphi_params[param])
-        if param in bool_params:
-            to_compare = to_compare.lower()
-        query = query.filter(
-            Sim_settings.delphi_params[param].as_string() == to_compare
-        )
-
-    for param in mc_params:
-        to_compare = str(mc_params[param])
-        if param in bool_params:
-            to_compare = to_compare.lower()
-        query = query.filter(Sim_settings.mc_params[param].as_string() == to_compare)
+    params_hash = hash_settings(pypka_params, delphi_params, mc_params)
+    if params_hash in SETTINGS_CACHE:
+        NEW_PK_SIM.settid = SETTINGS_CACHE[params_hash]
+        return
 
-    settid = query.first()
-
-    if not settid:
-        new_sim_settings = Sim_settings(
-            pypka_params=pypka_params, delphi_params=delphi_params, mc_params=mc_params
-        )
-        session.add(new_sim_settings)
-        session.flush()
+    settid = (
+        session.query(Sim_settings.settid).filter_by(params_hash=params_hash).first()
+    )
+    if settid:
+        settid = settid[0]
+    else:
+        settid = find_unhashed_settings(pypka_params, delphi_params, mc_params)
+        if settid:
+            session.query(Sim_settings).filter_by(settid=settid).update(
+                {"params_hash": params_hash}, synchronize_session=False
+            )
 
-        settid = new_sim_settings.settid
+    if settid:
+        # Only settings that were already committed are safe to cache
+        SETTINGS_CACHE[params_hash] = settid
     else:
-        settid = settid[0]
+        settings_insert = (
+            insert(Sim_settings)
+            .values(
+                pypka_params=pypka_params,
+                delphi_params=delphi_params,
+                mc_params=mc_params,
+                params_hash=params_hash,
+            )
+            .on_conflict_do_nothing(index_elements=["params_hash"])
+            .returning(Sim_settings.settid)
+        )
+        settid = session.execute(settings_insert).scalar()
+        if not settid:
+            # Inserted by a concurrent worker
+            settid = (
+                session.query(Sim_settings.settid)
+                .filter_by(params_hash=params_hash)
+                .first()[0]
+            )
 
     NEW_PK_SIM.settid = settid
-    session.commit()
 
 
-def save_pdbfile_hs(pdb_file_Hs) -> None:
+def save_pdbfile_hs(pdb_file_Hs: str, structure: StructureContext) -> None:
     # Save Structure with Hydrogens
     with open(pdb_file_Hs) as f:
         content = f.read()
-        safe_content = content
-    CUR_PDB.pdb_file_hs = safe_content
-    session.commit()
+    store_pdb_content(CUR_PDB, content, hs=True)
+    structure.hs_content = content
 
 
 def save_titration_curve(tit):
     # Save total titration curve
     titration_curve = tit.getTitrationCurve()
     NEW_PK_SIM.tit_curve = titration_curve
-    session.commit()
 
 
 def save_isoelectric_point(tit):
@@ -173,7 +223,6 @@ def save_isoelectric_point(tit):
         NEW_PK_SIM.isoelectric_point_limit = limit
 
     NEW_PK_SIM.isoelectric_point = isoelectric_point
-    session.commit()
 
 
 def save_residues(tit: pypka.Titration, pid: int) -> pypka.Titration:
@@ -185,31 +234,41 @@ def save_residues(tit: pypka.Titration, pid: int) -> pypka.Titration:
         _,
     ) = tit.getSiteInteractions()
 
-    for site in all_sites:
-
-        residue_details = {
+    residues = [
+        {
             "pid": pid,
             "residue_number": site.getResNumber(),
             "residue_type": site.res_name,
             "chain": site.molecule.chain,
         }
-
-        res_insert = insert(Residue).values(residue_details)
-        res_insert = res_insert.on_conflict_do_update(
-            index_elements=["pid", "residue_number", "residue_type", "chain"],
-            set_={"pid": pid},
-        ).returning(Residue.resid)
-        result = session.execute(res_insert)
-        resid = result.fetchall()[0][0]
-
-        site.resid = resid
-
-    session.commit()
+        for site in all_sites
+    ]
+    if not residues:
+        return tit
+
+    # Residues of a previous simulation of the same protein are kept
+    res_insert = insert(Residue).values(residues)
+    res_insert = res_insert.on_conflict_do_nothing(
+        index_elements=["pid", "residue_number", "residue_type", "chain"]
+    )
+    session.execute(res_insert)
+
+    resids = {
+        (resnumb, resname, chain): resid
+        for resid, resnumb, resname, chain in session.query(
+            Residue.resid, Residue.residue_number, Residue.residue_type, Residue.chain
+        ).filter(Residue.pid == pid)
+    }
+    for site, residue in zip(all_sites, residues):
+        site.resid = resids[
+            (residue["residue_number"], residue["residue_type"], residue["chain"])
+        ]
     return tit
 
 
 def save_pks(pid: int, tit: pypka.Titration) -> None:
     # Save pK predictions
+    pks = []
     for site in tit:
         resid = site.resid
         pK = site.pK
@@ -224,109 +283,205 @@ def save_pks(pid: int, tit: pypka.Titration) -> None:
 
         tautomers_probs = site.states_prob
 
-        new_pk = Pk(
-            pksimid=NEW_PK_SIM.pksimid,
-            resid=resid,
-            pk=pK,
-            dpk=dpK,
-            tautomers=tautomers,
-            tautomer_probs=tautomers_probs,
-            tit_curve=tit_curve,
+        pks.append(
+            {
+                "pksimid": NEW_PK_SIM.pksimid,
+                "resid": resid,
+                "pk": pK,
+                "dpk": dpK,
+                "tautomers": tautomers,
+                "tautomer_probs": tautomers_probs,
+                "tit_curve": tit_curve,
+            }
         )
-        session.add(new_pk)
+
+    if pks:
+        session.execute(insert(Pk).values(pks))
+
+
+SAVE_RETRIES = 3
+
+
+def save_results(
+    pid: int, tit: pypka.Titration, pdb_file_Hs: str, structure: StructureContext
+) -> None:
+    """Writes all the results of a pypka run in a single transaction
+
+    Each step runs inside a savepoint, so a step that hits a transient
+    error (eg. a deadlock) is retried without losing the previous steps.
+    Nothing is visible to other workers before the final commit.
+    """
+    steps = (
+        (save_pdbfile_hs, (pdb_file_Hs, structure)),
+        (save_titration_curve, (tit,)),
+        (save_isoelectric_point, (tit,)),
+        (save_settings, (tit,)),
+        (save_residues, (tit, pid)),
+        (save_pks, (pid, tit)),
+    )
+    for step, step_args in steps:
+        for attempt in range(1, SAVE_RETRIES + 1):
+            try:
+                with session.begin_nested():
+                    step(*step_args)
+                break
+            except OperationalError as e:
+                if attempt == SAVE_RETRIES:
+                    raise
+                logging.warning(f"{step.__name__} failed ({e.orig}). Retrying...")
     session.commit()
 
 
-def choose_protein() -> Tuple[int, str, Pk_sim, Protein]:
-    def register_sim(pid: int, force=False) -> Pk_sim:
-        try:
+def register_sim(pid: int, force=False) -> Optional[Pk_sim]:
+    try:
+        new_sim = Pk_sim(
+            pid=pid, sim_date=func.current_date(), sim_time=func.current_time()
+        )
+        session.add(new_sim)
+        session.commit()
+    except:
+        if force:
+            session.rollback()
+
+            del_pksimid = session.query(Pk_sim.pksimid).filter(Pk_sim.pid == pid)
+            to_del = session.query(Pk).filter(Pk.pksimid == del_pksimid)
+            to_del.delete(synchronize_session=False)
+
+            to_del = session.query(Pk_sim).filter(Pk_sim.pid == pid)
+            to_del.delete(synchronize_session=False)
+
+            session.commit()
+
             new_sim = Pk_sim(
                 pid=pid, sim_date=func.current_date(), sim_time=func.current_time()
             )
             session.add(new_sim)
             session.commit()
-        except:
-            if force:
-                session.rollback()
+        else:
+            session.rollback()
+            logging.error("The protein has already been calculated")
+            return None
+    return new_sim
 
-                del_pksimid = session.query(Pk_sim.pksimid).filter(Pk_sim.pid == pid)
-                to_del = session.query(Pk).filter(Pk.pksimid == del_pksimid)
-                to_del.delete(synchronize_session=False)
 
-                to_del = session.query(Pk_sim).filter(Pk_sim.pid == pid)
-                to_del.delete(synchronize_session=False)
+def has_finished_sim(pid: int) -> bool:
+    finished = (
+        session.query(Pk_sim.pid)
+        .filter(Pk_sim.pid == pid)
+        .filter(or_(Pk_sim.tit_curve != None, Pk_sim.error_description != None))
+        .first()
+    )
+    return finished is not None
 
-                session.commit()
 
-                new_sim = Pk_sim(
-                    pid=pid, sim_date=func.current_date(), sim_time=func.current_time()
-                )
-                session.add(new_sim)
-                session.commit()
-            else:
-                logging.error("The protein has already been calculated")
-                exit()
-        return new_sim
+def start_sim(pid: int, idcode: str) -> Optional[Tuple[Pk_sim, Protein]]:
+    """Registers the simulation of a protein claimed from the queue"""
+    if has_finished_sim(pid):
+        logging.info(f"{idcode} has already been calculated")
+        finish_claim(pid)
+        return None
+
+    # Any unfinished simulation was left behind by a worker whose lease expired
+    new_sim = register_sim(pid, force=True)
+    cur_protein = session.query(Protein).filter_by(pid=pid).first()
+    return new_sim, cur_protein
+
+
+CLAIMED = []
+START_TIME = time.time()
+
+
+def remaining_time() -> Optional[float]:
+    if args.time_budget is None:
+        return None
+    return args.time_budget - (time.time() - START_TIME)
+
+
+PREFETCHER = None
+
+
+def stored_pdbs(pids: list) -> set:
+    with db.connect() as conn:
+        stored = conn.execute(select(PDB.pid).where(PDB.pid.in_(pids))).fetchall()
+    return {pid for pid, in stored}
+
+
+def next_claimed() -> Optional[Tuple[int, str]]:
+    # Enough proteins are claimed to keep the prefetch queue full
+    if len(CLAIMED) <= args.prefetch_depth:
+        nclaim = max(args.claim_batch, args.prefetch_depth + 1 - len(CLAIMED))
+        CLAIMED.extend(
+            claim_proteins(
+                nclaim,
+                nres_limit=args.nres_limit,
+                lease_time=args.lease_time,
+                time_budget=remaining_time(),
+            )
+        )
+    if not CLAIMED:
+        # Get a protein for which there is no nres record
+        CLAIMED.extend(
+            claim_proteins(
+                args.claim_batch,
+                lease_time=args.lease_time,
+                time_budget=remaining_time(),
+            )
+        )
+
+    if not CLAIMED:
+        return None
+    claimed = CLAIMED.pop(0)
+
+    if PREFETCHER and CLAIMED:
+        stored = stored_pdbs([pid for pid, _ in CLAIMED])
+        PREFETCHER.submit([idcode for pid, idcode in CLAIMED if pid not in stored])
+
+    return claimed
+
+
+def get_prefetched(idcode: str) -> Optional[str]:
+    if PREFETCHER:
+        return PREFETCHER.get(idcode)
+    return None
+
 
+def choose_protein() -> Optional[Tuple[int, str, Pk_sim, Protein]]:
     if args.idcode:
         # Use input idcode
         idcode = args.idcode
         pid = session.query(Protein.pid).filter_by(idcode=idcode).first()[0]
         NEW_PK_SIM = register_sim(pid, force=True)
+        CUR_PROTEIN = session.query(Protein).filter_by(pid=pid).first()
+        return pid, idcode, NEW_PK_SIM, CUR_PROTEIN
 
-    else:
-        # Get a protein that with no previous pka prediction
-        next_sim = (
-            (
-                session.query(Protein.pid, Protein.idcode)
-                .filter(Protein.protein_type == "prot")
-                .filter(Protein.nres < args.nres_limit)
-                .filter(~exists().where(Pk_sim.pid == Protein.pid))
-            )
-            .order_by(func.random())
-            .first()
-        )
-
-        if next_sim:
-            pid, idcode = next_sim
-            NEW_PK_SIM = register_sim(pid)
-        else:
-            # Get a protein for which there is no nres record
-            next_sim = (
-                (
-                    session.query(Protein.pid, Protein.idcode)
-                    .filter(Protein.protein_type == "prot")
-                    .filter(~exists().where(Pk_sim.pid == Protein.pid))
-                )
-                .order_by(func.random())
-                .first()
-            )
-
-            if next_sim:
-                pid, idcode = next_sim
-                NEW_PK_SIM = register_sim(pid)
+    # Get the next queued protein with no previous pka prediction
+    started = None
+    while not started:
+        claimed = next_claimed()
+        if not claimed:
+            logging.info("No more proteins to simulate!")
+            return None
 
-            else:
-                logging.info("No more proteins to simulate!")
-                exit()
+        pid, idcode = claimed
+        started = start_sim(pid, idcode)
 
-    CUR_PROTEIN = session.query(Protein).filter_by(pid=pid).first()
+    NEW_PK_SIM, CUR_PROTEIN = started
     return pid, idcode, NEW_PK_SIM, CUR_PROTEIN
 
 
-def try_to_run_pypka(pid: int, idcode: str, fpdb_name: str) -> bool:
+def try_to_run_pypka(
+    pid: int, idcode: str, fpdb_name: str, ncpus: int, structure: StructureContext
+) -> bool:
     success_status = False
     try:
         pdb_file_Hs = idcode + "_Hs.pdb"
-        tit = run_pypka(fpdb_name, pdb_file_Hs)
+        start = time.time()
+        tit = run_pypka(fpdb_name, pdb_file_Hs, ncpus)
+        NEW_PK_SIM.wall_time = time.time() - start
+        NEW_PK_SIM.ncpus = ncpus
         logging.info(f"PypKa run of {idcode} succeeded!")
 
-        save_pdbfile_hs(pdb_file_Hs)
-        save_titration_curve(tit)
-        save_isoelectric_point(tit)
-        save_settings(tit)
-        tit = save_residues(tit, pid)
-        save_pks(pid, tit)
+        save_results(pid, tit, pdb_file_Hs, structure)
         logging.info(f"Saving {idcode} results succeeded!")
 
         success_status = True
@@ -338,6 +493,8 @@ def try_to_run_pypka(pid: int, idcode: str, fpdb_name: str) -> bool:
             error_message = f"{idcode}\n{e}\n"
             f.write(error_message)
             f.write(traceback.format_exc())
+        # Discard any partially written results
+        session.rollback()
         NEW_PK_SIM.error_description = str(e)
         session.commit()
         raise
@@ -346,38 +503,280 @@ def try_to_run_pypka(pid: int, idcode: str, fpdb_name: str) -> bool:
     return success_status
 
 
-def fetch_pdb(pid: int, idcode: str) -> Tuple[int, PDB, str]:
+def fetch_pdb(
+    pid: int, idcode: str, prefetched: Optional[str] = None
+) -> Tuple[int, PDB, str, StructureContext]:
     pdb_exists = session.query(PDB).filter_by(pid=pid).first()
     if not pdb_exists:
-        fpdb_name = download_pdb(idcode)
+        fpdb_name = prefetched or download_pdb(idcode)
         if not fpdb_name:
             NEW_PK_SIM.error_description = "Failed to download PDB of {}".format(idcode)
             session.commit()
             raise
-        nres, CUR_PDB = save_pdb(pid, fpdb_name)
+        nres, CUR_PDB, structure = save_pdb(pid, idcode, fpdb_name)
 
     else:
-        nres, CUR_PDB, fpdb_name = get_pdb(pid, idcode)
+        structure = StructureContext(pid, idcode)
+        nres, CUR_PDB, fpdb_name = get_pdb(
+            pid, idcode, pdb_content=structure.pdb_content
+        )
 
-    return nres, CUR_PDB, fpdb_name
+    return nres, CUR_PDB, fpdb_name, structure
 
 
-if __name__ == "__main__":
+def run_pipeline(
+    pid: int, idcode: str, ncpus: int, prefetched: Optional[str] = None
+) -> None:
+    global CUR_PDB
+
+    try:
+        # The structure is parsed once and shared by every following stage
+        nres, CUR_PDB, fpdb_name, structure = fetch_pdb(pid, idcode, prefetched)
 
-    pid, idcode, NEW_PK_SIM, CUR_PROTEIN = choose_protein()
+        if nres > args.nres_limit and not args.idcode:
+            logging.info(
+                f"Protein {idcode} has {nres}. nres-limit is set to {args.nres_limit}"
+            )
+            os.system(f"rm {idcode}.pdb*")
+            finish_claim(pid)
+            return
+
+        success_status = try_to_run_pypka(pid, idcode, fpdb_name, ncpus, structure)
+
+        if success_status and not args.no_post_processing:
+            run_all(pid, idcode, structure)  # run_post_processing(pid, idcode, pdbDB)
+            logging.info(f"Post-processing of {idcode} succeeded!")
+    except:
+        finish_claim(pid, "failed")
+        raise
+
+    finish_claim(pid)
+
+
+def process_protein() -> bool:
+    """Runs the whole pipeline over a single protein
+
+    Returns:
+        bool: False if there was no protein left to simulate
+    """
+    global NEW_PK_SIM, CUR_PROTEIN
+
+    chosen = choose_protein()
+    if not chosen:
+        return False
+
+    pid, idcode, NEW_PK_SIM, CUR_PROTEIN = chosen
     logging.info(f"Choose {idcode} with PID: {pid}")
 
-    nres, CUR_PDB, fpdb_name = fetch_pdb(pid, idcode)
+    run_pipeline(pid, idcode, args.ncpus, get_prefetched(idcode))
+    return True
 
-    if nres > args.nres_limit and not args.idcode:
-        logging.info(
-            f"Protein {idcode} has {nres}. nres-limit is set to {args.nres_limit}"
-        )
-        os.system(f"rm {idcode}.pdb*")
-        exit()
 
-    success_status = try_to_run_pypka(pid, idcode, fpdb_name)
+STOP_REQUESTED = False
 
-    if success_status and not args.no_post_processing:
-        run_all(pid, idcode)  # run_post_processing(pid, idcode, pdbDB)
-        logging.info(f"Post-processing of {idcode} succeeded!")
+
+def request_stop(signum, frame) -> None:
+    global STOP_REQUESTED
+    logging.info(f"Received signal {signum}. Stopping after the current protein...")
+    STOP_REQUESTED = True
+
+
+def reset_session_state() -> None:
+    # Drop any pending transaction and every ORM object of the previous protein
+    session.rollback()
+    session.expunge_all()
+
+
+def wait_for_proteins() -> None:
+    logging.info(f"Waiting {args.poll_interval}s for new proteins...")
+    waited = 0
+    while not STOP_REQUESTED and waited < args.poll_interval:
+        time.sleep(1)
+        waited += 1
+
+
+def start_prefetcher() -> None:
+    global PREFETCHER
+    if args.prefetch_depth > 0:
+        PREFETCHER = Prefetcher(args.prefetch_depth, args.prefetch_workers)
+
+
+def stop_prefetcher() -> None:
+    if PREFETCHER:
+        PREFETCHER.shutdown()
+
+
+def run_daemon() -> None:
+    """Keeps a single warm process simulating proteins until a SIGTERM/SIGINT"""
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    start_prefetcher()
+
+    heartbeat = Heartbeat(lease_time=args.lease_time)
+    heartbeat.start()
+
+    while not STOP_REQUESTED:
+        try:
+            processed = process_protein()
+        except Exception:
+            processed = True
+            logging.error(traceback.format_exc())
+        finally:
+            reset_session_state()
+
+        if not processed:
+            wait_for_proteins()
+
+    heartbeat.stop()
+    stop_prefetcher()
+    release_claims([pid for pid, _ in CLAIMED])
+    session.close()
+    db.dispose()
+    logging.info(f"Download cache: {CACHE.stats()}")
+    logging.info("Daemon stopped.")
+
+
+def cpu_share(nres: Optional[int]) -> int:
+    """Number of CPUs given to a pypka run of a protein with nres residues
+
+    The same share is expected by cost_model.py --executor.
+    """
+    if nres:
+        ncpus = int(executor_ncpus(nres, args.ncpus))
+    else:
+        ncpus = args.ncpus
+    return max(1, min(ncpus, args.node_cpus))
+
+
+def init_executor_worker(worker: str) -> None:
+    # The claims belong to the executor, not to the pool process
+    sim_queue.WORKER_ID = worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def simulate_claimed(
+    pid: int, idcode: str, ncpus: int, prefetched: Optional[str] = None
+) -> Tuple[bool, dict]:
+    """Runs in a process of the executor pool
+
+    Returns:
+        Tuple[bool, dict]: whether the protein was processed and the download
+            cache stats of its run, which the executor adds to its own
+    """
+    global NEW_PK_SIM, CUR_PROTEIN
+
+    before = CACHE.stats()
+    success = True
+    try:
+        started = start_sim(pid, idcode)
+        if started:
+            NEW_PK_SIM, CUR_PROTEIN = started
+            logging.info(f"Running {idcode} (PID: {pid}) with {ncpus} CPUs")
+            run_pipeline(pid, idcode, ncpus, prefetched)
+    except Exception:
+        logging.error(traceback.format_exc())
+        success = False
+    finally:
+        reset_session_state()
+    downloads = {key: count - before[key] for key, count in CACHE.stats().items()}
+    return success, downloads
+
+
+def get_nres(pid: int) -> Optional[int]:
+    with db.connect() as conn:
+        return conn.execute(
+            select(Protein.nres).where(Protein.pid == pid)
+        ).scalar()
+
+
+def run_executor() -> None:
+    """Keeps all CPUs of a node busy with concurrent pypka runs
+
+    Each protein gets a CPU share according to its size and the CPUs of
+    finished jobs are handed to the next claimed proteins. pypka can not
+    be given more CPUs once running, so a protein waits until its whole
+    share is free instead of starting with fewer CPUs.
+    """
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    start_prefetcher()
+
+    heartbeat = Heartbeat(lease_time=args.lease_time)
+    heartbeat.start()
+
+    free_cpus = args.node_cpus
+    running = {}
+    waiting = None  # claimed protein waiting for its CPU share
+    nfinished = 0
+    start = time.time()
+
+    with ProcessPoolExecutor(
+        max_workers=args.node_cpus,
+        # The executor runs threads, which can not be safely forked
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_executor_worker,
+        initargs=(sim_queue.WORKER_ID,),
+    ) as pool:
+        while True:
+            while not STOP_REQUESTED and free_cpus > 0:
+                if waiting is None:
+                    claimed = next_claimed()
+                    if not claimed:
+                        break
+                    pid, idcode = claimed
+                    waiting = (pid, idcode, cpu_share(get_nres(pid)))
+                pid, idcode, ncpus = waiting
+                if ncpus > free_cpus:
+                    break
+                job = pool.submit(
+                    simulate_claimed, pid, idcode, ncpus, get_prefetched(idcode)
+                )
+                running[job] = ncpus
+                free_cpus -= ncpus
+                waiting = None
+
+            if not running:
+                if STOP_REQUESTED:
+                    break
+                wait_for_proteins()
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for job in finished:
+                free_cpus += running.pop(job)
+                nfinished += 1
+                if not job.exception():
+                    _, downloads = job.result()
+                    CACHE.add_stats(downloads)
+
+            hours = (time.time() - start) / 3600
+            logging.info(
+                f"Node throughput: {nfinished / hours:.1f} proteins/hour "
+                f"({nfinished} proteins, {len(running)} running, {free_cpus} free CPUs)"
+            )
+
+    heartbeat.stop()
+    stop_prefetcher()
+    unprocessed = [pid for pid, _ in CLAIMED]
+    if waiting:
+        unprocessed.append(waiting[0])
+    release_claims(unprocessed)
+    db.dispose()
+    logging.info(f"Download cache: {CACHE.stats()}")
+    logging.info("Executor stopped.")
+
+
+if __name__ == "__main__":
+
+    if args.executor:
+        run_executor()
+    elif args.daemon:
+        run_daemon()
+    else:
+        heartbeat = Heartbeat(lease_time=args.lease_time)
+        heartbeat.start()
+        try:
+            process_protein()
+        finally:
+            heartbeat.stop()
@@ -6,16 +6,19 @@ from db import (
     Pk_sim,
 )  # , Protein, Pk_sim, PDB, Residue, Pk, Sim_settings
 from utils import idcodes_to_process
+from structure import StructureContext
 from extra_properties import solvent_exposure, fasta, contact_map, annotations
 
 
-def run_all(pid: int, idcode: str) -> None:
+def run_all(pid: int, idcode: str, structure: StructureContext = None) -> None:
+    if structure is None:
+        structure = StructureContext(pid, idcode)
 
     # contact_map
-    contact_map.save_contact_map(idcode, pid)
+    contact_map.save_contact_map(idcode, pid, structure=structure)
 
     # residue_props
-    solvent_exposure.calc_all_metrics(pid, idcode)
+    solvent_exposure.calc_all_metrics(pid, idcode, structure)
 
     # fasta
     fasta.save_fasta(idcode, pid)
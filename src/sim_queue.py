@@ -0,0 +1,207 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import socket
+import logging
+import threading
+from typing import List, Tuple
+from sqlalchemy import text
+
+from db import db
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TIME = 900  # seconds
+
+# New proteins get the median priority of the pending ones, so they neither
+# jump nor trail the proteins ordered by cost_model.py until it runs again
+ENQUEUE_QUERY = """
+INSERT INTO sim_queue(pid, nres, priority)
+SELECT protein.pid, protein.nres, coalesce(pending.priority, random())
+FROM protein, (
+    SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY priority) AS priority
+    FROM sim_queue
+    WHERE status = 'pending'
+) AS pending
+WHERE protein.protein_type = 'prot'
+  AND NOT EXISTS (SELECT 1 FROM pk_sim WHERE pk_sim.pid = protein.pid)
+ON CONFLICT (pid) DO NOTHING
+"""
+
+CLAIM_QUERY = """
+WITH next AS (
+    SELECT pid
+    FROM sim_queue
+    WHERE status = 'pending' {filters}
+    ORDER BY priority
+    LIMIT :nproteins
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE sim_queue
+SET status = 'claimed',
+    worker = :worker,
+    claim_date = now(),
+    heartbeat_date = now(),
+    lease_expires = now() + make_interval(secs => :lease_time)
+FROM next, protein
+WHERE sim_queue.pid = next.pid AND protein.pid = next.pid
+RETURNING sim_queue.pid, protein.idcode
+"""
+
+RECLAIM_QUERY = """
+UPDATE sim_queue
+SET status = 'pending', worker = NULL, claim_date = NULL, lease_expires = NULL
+WHERE status = 'claimed' AND lease_expires < now()
+"""
+
+RENEW_QUERY = """
+UPDATE sim_queue
+SET heartbeat_date = now(), lease_expires = now() + make_interval(secs => :lease_time)
+WHERE status = 'claimed' AND worker = :worker
+"""
+
+
+def enqueue_proteins() -> int:
+    """Adds every protein without a pKa simulation to the queue
+
+    Returns:
+        int: number of newly queued proteins
+    """
+    with db.begin() as conn:
+        result = conn.execute(text(ENQUEUE_QUERY))
+    return result.rowcount
+
+
+def reclaim_expired() -> int:
+    """Returns the proteins whose lease has expired to the queue
+
+    Returns:
+        int: number of reclaimed proteins
+    """
+    with db.begin() as conn:
+        result = conn.execute(text(RECLAIM_QUERY))
+    if result.rowcount:
+        logging.warning(f"Reclaimed {result.rowcount} proteins with expired leases")
+    return result.rowcount
+
+
+def claim_proteins(
+    nproteins: int = 1,
+    nres_limit: int = None,
+    worker: str = None,
+    lease_time: int = LEASE_TIME,
+    time_budget: float = None,
+) -> List[Tuple[int, str]]:
+    """Atomically reserves the next nproteins pending proteins
+
+    Rows locked by concurrent workers are skipped instead of waited on,
+    so each protein is handed to a single worker. The claim is a lease
+    that has to be renewed with renew_leases() before it expires.
+
+    Proteins come out by priority, which cost_model.py sets to the longest
+    expected wall time first. With a time_budget the proteins expected to
+    take longer are left for other workers.
+
+    Args:
+        nproteins (int): maximum number of proteins to claim
+        nres_limit (int): only claim proteins with less residues
+        worker (str): identifier of the claiming worker, WORKER_ID by default
+        lease_time (int): seconds until the claim expires
+        time_budget (float): seconds left to the worker
+
+    Returns:
+        List[Tuple[int, str]]: pid and idcode of the claimed proteins
+    """
+    reclaim_expired()
+
+    filters = ""
+    params = {
+        "nproteins": nproteins,
+        "worker": worker or WORKER_ID,
+        "lease_time": lease_time,
+    }
+    if nres_limit:
+        filters = "AND nres < :nres_limit"
+        params["nres_limit"] = nres_limit
+    if time_budget is not None:
+        # Proteins without an estimate, before the cost model is fitted or
+        # without nres, are claimed as well
+        filters += " AND (expected_time IS NULL OR expected_time <= :time_budget)"
+        params["time_budget"] = time_budget
+
+    with db.begin() as conn:
+        claimed = conn.execute(
+            text(CLAIM_QUERY.format(filters=filters)), params
+        ).fetchall()
+    return [(pid, idcode) for pid, idcode in claimed]
+
+
+def renew_leases(worker: str = None, lease_time: int = LEASE_TIME) -> int:
+    with db.begin() as conn:
+        result = conn.execute(
+            text(RENEW_QUERY), {"worker": worker or WORKER_ID, "lease_time": lease_time}
+        )
+    return result.rowcount
+
+
+class Heartbeat(threading.Thread):
+    """Renews the leases of every protein claimed by a worker
+
+    Runs in the background so that long pypka runs keep their claims.
+    """
+
+    def __init__(self, worker: str = None, lease_time: int = LEASE_TIME):
+        super().__init__(daemon=True)
+        self.worker = worker or WORKER_ID
+        self.lease_time = lease_time
+        self.interval = lease_time / 3
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                renew_leases(self.worker, self.lease_time)
+            except Exception as e:
+                logging.warning(f"Heartbeat of {self.worker} failed: {e}")
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def finish_claim(pid: int, status: str = "done", worker: str = None) -> None:
+    # A worker whose lease was reclaimed no longer owns the protein
+    worker = worker or WORKER_ID
+    with db.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE sim_queue SET status = :status "
+                "WHERE pid = :pid AND worker = :worker"
+            ),
+            {"status": status, "pid": pid, "worker": worker},
+        )
+
+
+def release_claims(pids: List[int]) -> None:
+    """Returns claimed but unprocessed proteins to the queue"""
+    if not pids:
+        return
+    with db.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE sim_queue SET status = 'pending', worker = NULL, "
+                "claim_date = NULL, lease_expires = NULL "
+                "WHERE pid = ANY(:pids) AND status = 'claimed'"
+            ),
+            {"pids": list(pids)},
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level="INFO")
+
+    if len(sys.argv) > 1 and sys.argv[1] != "enqueue":
+        logging.error(f"Unknown command {sys.argv[1]}")
+        exit(1)
+
+    nqueued = enqueue_proteins()
+    logging.info(f"Added {nqueued} proteins to the simulation queue")
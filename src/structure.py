@@ -0,0 +1,103 @@
+import io
+import numpy as np
+
+from Bio.PDB.PDBParser import PDBParser
+
+from utils import read_pdb_content, parse_pdb_atoms, get_sites
+
+
+class StructureContext:
+    """Structure of a protein parsed once and shared by every pipeline stage
+
+    The structure contents, atom tables, titratable sites and Biopython
+    model are read from the database or parsed the first time they are
+    used, unless the caller already had them.
+    """
+
+    def __init__(
+        self, pid: int, idcode: str, pdb_content: str = None, hs_content: str = None
+    ):
+        self.pid = pid
+        self.idcode = idcode
+        self._pdb_content = pdb_content
+        self._hs_content = hs_content
+        self._atoms = None
+        self._hs_atoms = None
+        self._sites = None
+        self._model = None
+
+    @classmethod
+    def from_file(cls, pid: int, idcode: str, fname: str) -> "StructureContext":
+        """Context of the ATOM lines of the first model of a pdb file"""
+        lines = []
+        with open(fname) as f:
+            for line in f:
+                if line.startswith("ATOM "):
+                    lines.append(line)
+                if line.startswith("ENDMDL"):
+                    break
+        return cls(pid, idcode, pdb_content="".join(lines))
+
+    @property
+    def pdb_content(self) -> str:
+        if self._pdb_content is None:
+            self._pdb_content = read_pdb_content(self.pid)
+        return self._pdb_content
+
+    @property
+    def hs_content(self) -> str:
+        """Structure with the hydrogens added by pypka"""
+        if self._hs_content is None:
+            self._hs_content = read_pdb_content(self.pid, hs=True)
+        return self._hs_content
+
+    @hs_content.setter
+    def hs_content(self, content: str) -> None:
+        self._hs_content = content
+        self._hs_atoms = None
+
+    @property
+    def atoms(self) -> np.ndarray:
+        if self._atoms is None:
+            self._atoms = parse_pdb_atoms(self.pdb_content)
+        return self._atoms
+
+    @property
+    def hs_atoms(self) -> np.ndarray:
+        if self._hs_atoms is None:
+            self._hs_atoms = parse_pdb_atoms(self.hs_content)
+        return self._hs_atoms
+
+    @property
+    def nres(self) -> int:
+        # Consecutive atoms with the same residue number belong to one residue
+        resnumbs = self.atoms["resnumb"]
+        if not len(resnumbs):
+            return 0
+        return 1 + int(np.count_nonzero(resnumbs[1:] != resnumbs[:-1]))
+
+    @property
+    def sites(self) -> dict:
+        """Titratable sites of each chain, as returned by get_sites()"""
+        if self._sites is None:
+            self._sites = get_sites(self.pid)
+        return self._sites
+
+    @property
+    def model(self):
+        """First model of the Biopython structure"""
+        if self._model is None:
+            parser = PDBParser()
+            structure = parser.get_structure(self.idcode, io.StringIO(self.pdb_content))
+            self._model = structure[0]
+        return self._model
+
+    def write_pdb(self, fname: str) -> str:
+        """Writes the structure for external programs
+
+        Returns:
+            str: fname
+        """
+        with open(fname, "w") as f_new:
+            f_new.write(self.pdb_content)
+        return fname
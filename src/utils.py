@@ -1,9 +1,17 @@
-from db import session, Protein, PDB, Residue, Pk
+from db import session, config, Protein, PDB, Residue, Pk
+from download_cache import CACHE, fetch_structure
 import os
+import zlib
+import resource
+import numpy as np
 from typing import Generator, Tuple
-import subprocess
 import logging
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 PK_MOD = {
     "ASP": 3.79,
     "CTR": 2.90,
@@ -16,79 +24,106 @@ PK_MOD = {
 }
 
 
+# "compressed" keeps the structures as compressed bytes, "json" as plain text
+PDB_STORAGE = config.get("pdb_storage", "compressed")
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def compress_pdb(content: str) -> bytes:
+    # zstd when available, zlib otherwise. Both are told apart by their header
+    data = content.encode()
+    if zstandard:
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress_pdb(blob: bytes) -> str:
+    blob = bytes(blob)
+    if blob.startswith(ZSTD_MAGIC):
+        if not zstandard:
+            raise ImportError("zstandard is required to read zstd compressed files")
+        return zstandard.ZstdDecompressor().decompress(blob).decode()
+    return zlib.decompress(blob).decode()
+
+
+def store_pdb_content(pdb: PDB, content: str, hs: bool = False) -> None:
+    """Sets the structure of a PDB row in the configured storage mode"""
+    if PDB_STORAGE == "compressed":
+        compressed, plain = compress_pdb(content), None
+    else:
+        compressed, plain = None, content
+
+    if hs:
+        pdb.pdb_file_hs_z, pdb.pdb_file_hs = compressed, plain
+    else:
+        pdb.pdb_file_z, pdb.pdb_file = compressed, plain
+
+
+def read_pdb_content(pid: int, hs: bool = False) -> str:
+    """Reads the structure of a protein from either storage mode
+
+    Args:
+        pid (int)
+        hs (bool): read the structure with hydrogens saved by pypka
+
+    Returns:
+        str: content of the pdb file
+    """
+    if hs:
+        columns = (PDB.pdb_file_hs_z, PDB.pdb_file_hs)
+    else:
+        columns = (PDB.pdb_file_z, PDB.pdb_file)
+
+    compressed, plain = session.query(*columns).filter_by(pid=pid).first()
+    if compressed is not None:
+        return decompress_pdb(compressed)
+    return plain
+
+
 def download_pdb(pdb_idcode: str) -> str:
-    fname = None
-    try:
-        cmd = (
-            f"wget https://files.rcsb.org/download/{pdb_idcode}.pdb.gz;"
-            f"gunzip -f {pdb_idcode}.pdb.gz"
-        )
-        subprocess.run(
-            cmd,
-            shell=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        fname = f"{pdb_idcode}.pdb"
-    except subprocess.CalledProcessError as e:
-        logging.warning(f"{idcode} PDB download failed!")
+    fname = fetch_structure(pdb_idcode)
+    if not fname:
+        logging.warning(f"{pdb_idcode} PDB download failed!")
 
     return fname
 
 
-def get_pdb(pid: int, idcode: str, prefix="") -> Tuple[int, PDB, str]:
-    pdb_content = session.query(PDB.pdb_file).filter_by(pid=pid).first()[0]
+def get_pdb(
+    pid: int, idcode: str, prefix="", pdb_content: str = None
+) -> Tuple[int, PDB, str]:
+    if pdb_content is None:
+        pdb_content = read_pdb_content(pid)
     fname = f"{prefix}{idcode}.pdb"
     with open(fname, "w") as f_new:
         f_new.write(pdb_content)
 
     nres = session.query(Protein.nres).filter(Protein.pid == pid).first()[0]
-    CUR_PDB = session.query(PDB).filter_by(pid=pid)
+    CUR_PDB = session.query(PDB).filter_by(pid=pid).first()
     return nres, CUR_PDB, fname
 
 
 def download_fasta(idcode: str, pid: int) -> str:
-    try:
-        cmd = f"wget https://www.rcsb.org/fasta/entry/{idcode}"
-        subprocess.run(
-            cmd,
-            shell=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-    except subprocess.CalledProcessError as e:
-        logging.warning(f"{idcode} FASTA download failed!")
-
     fasta_file = None
-    if os.path.isfile(f"{idcode}"):
-        with open(f"{idcode}") as f:
+    cached = CACHE.fetch(idcode, "fasta")
+    if cached:
+        with open(cached) as f:
             fasta_file = f.read()
+        # mmseqs reads the query from the working directory
+        with open(f"{idcode}", "w") as f_new:
+            f_new.write(fasta_file)
+    else:
+        logging.warning(f"{idcode} FASTA download failed!")
 
     return fasta_file
 
 
 def download_cif(idcode: str, pid: int) -> str:
-    if not os.path.isfile(f"{idcode}.cif"):
-        try:
-            cmd = f"wget https://files.rcsb.org/header/{idcode}.cif"
-            subprocess.run(
-                cmd,
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"{idcode} CIF download failed!")
-
-    cif_file = None
-    if os.path.isfile(f"{idcode}.cif"):
-        with open(f"{idcode}.cif") as f:
-            cif_file = f.read()
-
-    return cif_file
+    """Path of the cached CIF header of idcode, None if the download failed"""
+    cached = CACHE.fetch(idcode, "cif")
+    if not cached:
+        logging.warning(f"{idcode} CIF download failed!")
+    return cached
 
 
 def idcodes_to_process(fname) -> Generator:
@@ -98,18 +133,132 @@ def idcodes_to_process(fname) -> Generator:
             yield idcode
 
 
-def read_pdb_line(line):
-    aname = line[12:16].strip()
-    anumb = int(line[5:11].strip())
-    b = line[16]
-    resname = line[17:21].strip()
-    chain = line[21]
-    resnumb = int(line[22:26])
-    icode = line[26]
-    x = float(line[30:38])
-    y = float(line[38:46])
-    z = float(line[46:54])
-    return (aname, anumb, b, resname, chain, resnumb, x, y, z, icode)
+ATOM_DTYPE = np.dtype(
+    [
+        ("aname", "U4"),
+        ("anumb", "i8"),
+        ("altloc", "U1"),
+        ("resname", "U4"),
+        ("chain", "U1"),
+        ("resnumb", "i8"),
+        ("icode", "U1"),
+        ("xyz", "f8", 3),
+    ]
+)
+
+# Offset and width of the fixed-width columns of an ATOM record
+ATOM_COLUMNS = {
+    "anumb": (5, 6),
+    "aname": (12, 4),
+    "altloc": (16, 1),
+    "resname": (17, 4),
+    "chain": (21, 1),
+    "resnumb": (22, 4),
+    "icode": (26, 1),
+    "x": (30, 8),
+    "y": (38, 8),
+    "z": (46, 8),
+}
+# The coordinates are the last column that is read
+ATOM_WIDTH = 54
+
+
+def text_column(columns: np.ndarray, offset: int, width: int) -> np.ndarray:
+    # ASCII bytes widened to 4 bytes are the code points of a unicode array
+    field = np.ascontiguousarray(columns[offset : offset + width].T, dtype=np.uint32)
+    return field.view(f"U{width}").reshape(-1)
+
+
+def number_column(columns: np.ndarray, offset: int, width: int) -> np.ndarray:
+    """Numbers written in a fixed-width column, as int64 or float64 if they have decimals
+
+    The digits are accumulated one character position at a time over
+    every row, so each step is a single operation over contiguous arrays.
+
+    Raises:
+        ValueError: if a field is empty or holds anything but a number
+    """
+    nrows = columns.shape[1]
+    values = np.zeros(nrows, dtype=np.int64)
+    decimals = np.zeros(nrows, dtype=np.int64)
+    point = np.zeros(nrows, dtype=bool)
+    minus = np.zeros(nrows, dtype=bool)
+    ndigits = np.zeros(nrows, dtype=np.int64)
+    valid = np.ones(nrows, dtype=bool)
+    for chars in columns[offset : offset + width]:
+        digits = chars - np.uint8(ord("0"))
+        is_digit = digits < 10
+        values = np.where(is_digit, values * 10 + digits, values)
+        ndigits += is_digit
+        decimals += is_digit & point
+        point |= chars == ord(".")
+        minus |= chars == ord("-")
+        valid &= is_digit | (chars == ord(".")) | (chars == ord("-")) | (chars == ord(" "))
+
+    valid &= ndigits > 0
+    if not valid.all():
+        row = columns[offset : offset + width, np.flatnonzero(~valid)[0]]
+        raise ValueError(
+            f"Invalid number '{row.tobytes().decode(errors='replace')}' "
+            f"in the columns {offset + 1}-{offset + width} of an ATOM record"
+        )
+
+    values = np.where(minus, -values, values)
+    if not point.any():
+        return values
+    # Exact integers divided by a power of ten round like float() does
+    return np.where(minus, -1.0, 1.0) * np.abs(values) / 10.0**decimals
+
+
+def parse_pdb_atoms(content) -> np.ndarray:
+    """Atom table of the ATOM lines of a pdb file
+
+    The lines are located and sliced into their fixed-width columns with
+    array operations over the whole buffer, without a Python loop per line.
+
+    Args:
+        content (str or bytes): content of the pdb file
+
+    Returns:
+        np.ndarray: structured array of ATOM_DTYPE with one row per atom
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    buffer = np.frombuffer(content, dtype=np.uint8)
+
+    newlines = np.flatnonzero(buffer == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(buffer)]))
+
+    is_atom = ends - starts >= 5
+    for i, char in enumerate(b"ATOM "):
+        is_atom[is_atom] &= buffer[starts[is_atom] + i] == char
+    starts, ends = starts[is_atom], ends[is_atom]
+
+    # The first ATOM_WIDTH bytes of every line are copied at once from a
+    # sliding window view, and the shorter lines are padded with spaces
+    padded = np.concatenate((buffer, np.full(ATOM_WIDTH, ord(" "), dtype=np.uint8)))
+    chars = np.lib.stride_tricks.sliding_window_view(padded, ATOM_WIDTH)[starts]
+    short = np.flatnonzero(ends - starts <= ATOM_WIDTH)
+    if len(short):
+        beyond = np.arange(ATOM_WIDTH) >= (ends - starts)[short, None]
+        short_chars = chars[short]
+        short_chars[beyond | (short_chars == ord("\r"))] = ord(" ")
+        chars[short] = short_chars
+
+    # Each character position of every line is contiguous in memory
+    columns = np.ascontiguousarray(chars.T)
+
+    atoms = np.empty(len(chars), dtype=ATOM_DTYPE)
+    for name in ("aname", "resname"):
+        atoms[name] = np.char.strip(text_column(columns, *ATOM_COLUMNS[name]))
+    for name in ("altloc", "chain", "icode"):
+        atoms[name] = text_column(columns, *ATOM_COLUMNS[name])
+    for name in ("anumb", "resnumb"):
+        atoms[name] = number_column(columns, *ATOM_COLUMNS[name])
+    for axis, name in enumerate("xyz"):
+        atoms["xyz"][:, axis] = number_column(columns, *ATOM_COLUMNS[name])
+    return atoms
 
 
 def get_sites(pid: str) -> dict:
@@ -129,3 +278,24 @@ def get_sites(pid: str) -> dict:
         chain_sites[chain][resnumb] = [resname, resid]
 
     return chain_sites
+
+
+def reset_peak_rss() -> None:
+    """Restarts the peak measured by peak_rss() from the current usage (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """Peak resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, f"{tests_dir}/../src")
+
+
+@pytest.fixture
+def fragment_pdb() -> str:
+    """Structure with HETATM records, alternate locations and an insertion code"""
+    with open(f"{tests_dir}/data/fragment.pdb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def conn():
+    """Database connection in a transaction that is rolled back afterwards"""
+    from db import db
+    from sqlalchemy.exc import OperationalError
+
+    try:
+        connection = db.connect()
+    except OperationalError:
+        pytest.skip("the database in .env is not reachable")
+    transaction = connection.begin()
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
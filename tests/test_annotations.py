@@ -0,0 +1,78 @@
+import gzip
+
+import pytest
+
+from extra_properties.annotations import (
+    CONDITION_ITEMS,
+    parse_experimental_conditions,
+    read_cif_items,
+)
+
+CRYSTAL_CIF = """data_1ABC
+#
+_exptl.entry_id          1ABC
+_exptl.method            'X-RAY DIFFRACTION'
+#
+loop_
+_exptl_crystal_grow.crystal_id
+_exptl_crystal_grow.pH
+_exptl_crystal_grow.temp
+_exptl_crystal_grow.pdbx_details
+1 6.5 0   'PEG 4000, pH 6.5'
+2 7.0 277 ?
+3 ?   .
+;sodium citrate
+;
+#
+_em_buffer.pH            9.0
+"""
+
+NMR_CIF = """data_2XYZ
+_pdbx_nmr_exptl_sample_conditions.conditions_id   1
+_pdbx_nmr_exptl_sample_conditions.temperature     308
+_pdbx_nmr_exptl_sample_conditions.pH              3.8
+_pdbx_nmr_exptl_sample_conditions.ionic_strength  100
+"""
+
+
+def read_up_to(content: str, last_line: str):
+    """Lines of content, failing if anything after last_line is read"""
+    for line in content.splitlines(keepends=True):
+        yield line
+        if line.startswith(last_line):
+            break
+    pytest.fail(f"Read past {last_line}")
+
+
+@pytest.mark.parametrize("gzipped", [False, True])
+def test_conditions_keep_the_last_nonzero_value(tmp_path, gzipped):
+    fname = tmp_path / "1abc.cif"
+    if gzipped:
+        with gzip.open(fname, "wt") as f:
+            f.write(CRYSTAL_CIF)
+    else:
+        fname.write_text(CRYSTAL_CIF)
+
+    # The later _em_buffer category is not read
+    assert parse_experimental_conditions(str(fname)) == (7.0, 277.0)
+
+
+def test_conditions_of_nmr_entries(tmp_path):
+    fname = tmp_path / "2xyz.cif"
+    fname.write_text(NMR_CIF)
+
+    assert parse_experimental_conditions(str(fname)) == (3.8, 308.0)
+
+
+def test_reading_stops_after_the_category_of_the_conditions():
+    lines = read_up_to(CRYSTAL_CIF, "_em_buffer.pH")
+    found = read_cif_items(lines, CONDITION_ITEMS)
+
+    assert found == {"ph": ["6.5", "7.0"], "temp": ["0", "277"]}
+
+
+def test_reading_continues_until_every_condition_is_found():
+    content = CRYSTAL_CIF.replace("_exptl_crystal_grow.temp", "_exptl_crystal_grow.x")
+    found = read_cif_items(content.splitlines(keepends=True), CONDITION_ITEMS)
+
+    assert found == {"ph": ["6.5", "7.0", "9.0"], "temp": []}
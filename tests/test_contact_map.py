@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist
+
+from utils import parse_pdb_atoms
+from extra_properties.contact_map import (
+    dense_blocks,
+    sparse_blocks,
+    mirror_pairs,
+    DENSE_BYTES,
+    SPARSE_BYTES,
+    DTYPE,
+)
+
+
+@pytest.fixture
+def coords(fragment_pdb) -> np.ndarray:
+    return parse_pdb_atoms(fragment_pdb)["xyz"]
+
+
+def condensed_index(natoms: int, atom1: np.ndarray, atom2: np.ndarray) -> np.ndarray:
+    return natoms * atom1 - atom1 * (atom1 + 1) // 2 + atom2 - atom1 - 1
+
+
+@pytest.mark.parametrize("budget", [256 * 1024**2, SPARSE_BYTES])
+def test_sparse_blocks_match_pdist(coords, budget):
+    cutoff = 6.0
+    blocks = list(sparse_blocks(coords, cutoff, budget))
+    dists = np.concatenate([dists for dists, _ in blocks])
+    pairs = np.concatenate([pairs for _, pairs in blocks]).astype(np.int64)
+    assert dists.dtype == DTYPE
+    if budget == SPARSE_BYTES:
+        assert len(blocks) == len(coords)
+
+    # Every pair is stored once from its first atom, in the order of pdist
+    assert (pairs[:, 0] < pairs[:, 1]).all()
+    reference = pdist(coords)
+    found = condensed_index(len(coords), pairs[:, 0], pairs[:, 1])
+    assert np.array_equal(found, np.flatnonzero(reference <= cutoff))
+    np.testing.assert_allclose(dists, reference[found], rtol=1e-6)
+
+
+def test_mirror_pairs(coords):
+    dists, pairs = next(sparse_blocks(coords, 6.0))
+    mirrored_dists, mirrored = mirror_pairs(dists, pairs)
+    assert len(mirrored) == 2 * len(pairs)
+    assert np.array_equal(
+        np.lexsort((mirrored[:, 1], mirrored[:, 0])), np.arange(len(mirrored))
+    )
+    assert set(map(tuple, mirrored)) == set(map(tuple, pairs)) | set(
+        map(tuple, pairs[:, ::-1])
+    )
+    distances = np.linalg.norm(coords[mirrored[:, 0]] - coords[mirrored[:, 1]], axis=1)
+    np.testing.assert_allclose(mirrored_dists, distances, rtol=1e-6)
+
+
+@pytest.mark.parametrize("budget", [256 * 1024**2, DENSE_BYTES])
+def test_dense_blocks_match_pdist(coords, budget):
+    blocks = [dists for dists, _ in dense_blocks(coords, budget)]
+    if budget == DENSE_BYTES:
+        assert len(blocks) == len(coords) - 1
+    dists = np.concatenate(blocks)
+    assert dists.dtype == DTYPE
+    np.testing.assert_allclose(dists, pdist(coords), rtol=1e-6)
+
+
+@pytest.mark.parametrize("natoms", [0, 1])
+def test_dense_blocks_without_pairs(coords, natoms):
+    assert list(dense_blocks(coords[:natoms])) == []
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from utils import parse_pdb_atoms, ATOM_DTYPE
+
+
+def parse_lines(content: str) -> np.ndarray:
+    """Reference parser reading the fixed-width columns of one ATOM line at a time"""
+    rows = []
+    for line in content.splitlines():
+        if not line.startswith("ATOM "):
+            continue
+        xyz = tuple(float(line[start : start + 8]) for start in (30, 38, 46))
+        rows.append(
+            (
+                line[12:16].strip(),
+                int(line[5:11]),
+                line[16],
+                line[17:21].strip(),
+                line[21],
+                int(line[22:26]),
+                line[26],
+                xyz,
+            )
+        )
+    return np.array(rows, dtype=ATOM_DTYPE)
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_parse_pdb_atoms_matches_line_parser(fragment_pdb, newline):
+    content = fragment_pdb.replace("\n", newline)
+    atoms = parse_pdb_atoms(content)
+    reference = parse_lines(content)
+    assert len(atoms) == len(reference)
+    for name in ATOM_DTYPE.names:
+        assert np.array_equal(atoms[name], reference[name]), name
+
+
+def test_parse_pdb_atoms_fields(fragment_pdb):
+    atoms = parse_pdb_atoms(fragment_pdb.encode())
+
+    # HETATM records are not read
+    assert len(atoms) == 41
+    assert not np.isin(atoms["resname"], ("HOH", "ZN")).any()
+
+    assert list(atoms["altloc"][atoms["aname"] == "NZ"]) == ["A", "B"]
+    inserted = atoms[atoms["icode"] == "A"]
+    assert set(inserted["resname"]) == {"ASP"} and set(inserted["resnumb"]) == {3}
+    assert atoms[0]["aname"] == "N" and atoms[0]["anumb"] == 1
+    assert atoms[0]["xyz"].tolist() == [-12.5, -1.2, 3.5]
+
+
+def test_parse_pdb_atoms_rejects_malformed_numbers(fragment_pdb):
+    line = next(line for line in fragment_pdb.splitlines() if line.startswith("ATOM "))
+    malformed = line[:30] + "  12.x45" + line[38:]
+    with pytest.raises(ValueError):
+        parse_pdb_atoms(malformed)
+    with pytest.raises(ValueError):
+        parse_lines(malformed)
@@ -0,0 +1,105 @@
+import os
+import random
+
+import pytest
+
+from extra_properties.sequence_index import SequenceIndex, fasta_sequences
+
+SEQID = 0.9
+
+
+def index_state(index: SequenceIndex) -> tuple:
+    """Contents of an index, independent of the order its entries were added in"""
+    return (
+        index.db_version,
+        {
+            digest: (index.sequences[entry], index.members[entry])
+            for digest, entry in index.entries.items()
+        },
+        {
+            kmer: {index.digests[entry] for entry in entries}
+            for kmer, entries in index.kmers.items()
+        },
+        index.proteins,
+        {seqid: dict(hits) for seqid, hits in index.hits.items() if hits},
+    )
+
+
+@pytest.fixture
+def proteins() -> list:
+    """pid, idcode and FASTA of proteins sharing some of their chains"""
+    rng = random.Random(0)
+    shared = ["".join(rng.choices("ACDEFGHIKLMNPQRSTVWY", k=60)) for _ in range(20)]
+    proteins = []
+    for pid in range(1, 121):
+        chains = rng.sample(shared, rng.randint(1, 3)) + ["MKV" * rng.randint(5, 40)]
+        fasta_file = "".join(
+            f">{pid:04x}_{n} mol:protein\n{chain[:40]}\n{chain[40:]}\n"
+            for n, chain in enumerate(chains, 1)
+        )
+        proteins.append((pid, f"{pid:04x}", fasta_file))
+    return proteins
+
+
+@pytest.fixture
+def reference(proteins) -> SequenceIndex:
+    """Index built in memory, with the hits an exact search would find"""
+    index = SequenceIndex(os.devnull)
+    index.apply({"db_version": "test"})
+    for pid, idcode, fasta_file in proteins:
+        index.apply(
+            {"pid": pid, "idcode": idcode, "sequences": fasta_sequences(fasta_file)}
+        )
+    hits = {
+        index.digests[entry]: sorted(idcodes)
+        for entry, idcodes in enumerate(index.members)
+    }
+    index.apply({"seqid": SEQID, "hits": hits})
+    return index
+
+
+def test_shared_index_matches_index_in_memory(tmp_path, proteins, reference):
+    fname = str(tmp_path / "sequence_index.pkl")
+    nworkers = 4
+    workers = [SequenceIndex(fname) for _ in range(nworkers)]
+    workers[0].set_db_version("test")
+
+    for n, worker in enumerate(workers):
+        worker.add_proteins(proteins[n::nworkers])
+        if n == nworkers // 2:
+            worker.compact()
+    # Proteins indexed by another worker are not added again
+    assert workers[-1].add_proteins(proteins) == 0
+
+    hits = reference.hits[SEQID]
+    digests = list(hits)
+    for n, worker in enumerate(workers):
+        worker.add_hits(
+            SEQID, {digest: hits[digest] for digest in digests[n::nworkers]}
+        )
+
+    loaded = SequenceIndex(fname)
+    compacted = SequenceIndex(fname)
+    workers[0].compact()
+    expected = index_state(reference)
+    for index in workers + [loaded, compacted]:
+        index.refresh()
+        assert index_state(index) == expected
+
+    for pid, idcode, _ in proteins:
+        cluster = loaded.cluster(pid, SEQID)
+        assert idcode not in cluster and cluster == reference.cluster(pid, SEQID)
+
+
+def test_new_database_version_drops_hits(tmp_path, proteins, reference):
+    index = SequenceIndex(str(tmp_path / "sequence_index.pkl"))
+    index.set_db_version("test")
+    index.add_proteins(proteins)
+    index.add_hits(SEQID, reference.hits[SEQID])
+    index.set_db_version("rebuilt")
+
+    loaded = SequenceIndex(index.fname)
+    loaded.refresh()
+    assert not loaded.hits[SEQID]
+    assert loaded.cluster(proteins[0][0], SEQID) is None
+    assert len(loaded.proteins) == len(proteins)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from extra_properties.similarity_clusters import encode_idcodes, union, NCODES
+
+NNODES = 20000
+
+
+def same_partition(labels1: np.ndarray, labels2: np.ndarray) -> bool:
+    npairs = len(np.unique(np.column_stack((labels1, labels2)), axis=0))
+    return npairs == len(np.unique(labels1)) == len(np.unique(labels2))
+
+
+@pytest.fixture(params=[2000, 8000, 20000])
+def rows(request) -> tuple:
+    """Similarity rows linking a protein to 1 to 5 idcodes, half of them proteins
+
+    Returns:
+        tuple: protein nodes, and row, source and target of each edge
+    """
+    rng = np.random.default_rng(request.param)
+    proteins = rng.choice(NNODES, NNODES // 2, replace=False)
+    rows = np.repeat(np.arange(request.param), rng.integers(1, 6, request.param))
+    sources = rng.choice(proteins, request.param)[rows]
+    targets = rng.integers(0, NNODES, len(rows))
+    return proteins, rows, sources, targets
+
+
+def test_encode_idcodes():
+    assert encode_idcodes("0000zzzz1a2B").tolist() == [0, NCODES - 1, 59699]
+
+
+def test_union_matches_connected_components(rows):
+    _, _, sources, targets = rows
+    roots = union(np.arange(NNODES), sources, targets)
+
+    graph = coo_matrix((np.ones(len(sources)), (sources, targets)), (NNODES, NNODES))
+    _, labels = connected_components(graph, directed=False)
+    # The root of each component is its smallest node
+    smallest = np.full(labels.max() + 1, NNODES)
+    np.minimum.at(smallest, labels, np.arange(NNODES))
+    assert np.array_equal(roots, smallest[labels])
+
+
+@pytest.mark.parametrize("nbatches", [2, 5])
+def test_batches_match_rebuild(rows, nbatches):
+    """Rows merged in batches as update_clusters() does give the same clusters
+
+    Each batch only loads the earlier rows sharing idcodes with it, and
+    links the proteins of every stored cluster to its first protein.
+    """
+    proteins, rows, sources, targets = rows
+    nrows = rows[-1] + 1
+    state_nodes = state_roots = np.empty(0, dtype=np.int64)
+    for batch in np.array_split(np.arange(nrows), nbatches):
+        new = (rows >= batch[0]) & (rows <= batch[-1])
+        idcodes = np.unique(np.concatenate((sources[new], targets[new])))
+        related_rows = np.unique(rows[(rows < batch[0]) & np.isin(targets, idcodes)])
+        loaded = new | np.isin(rows, related_rows)
+
+        first = pd.Series(state_nodes).groupby(state_roots).transform("first")
+        batch_roots = union(
+            np.arange(NNODES),
+            np.concatenate((sources[loaded], state_nodes)),
+            np.concatenate((targets[loaded], first.to_numpy(dtype=np.int64))),
+        )
+        in_graph = np.concatenate((sources[loaded], targets[loaded], state_nodes))
+        state_nodes = np.intersect1d(proteins, in_graph)
+        state_roots = batch_roots[state_nodes]
+
+    roots = union(np.arange(NNODES), sources, targets)
+    expected_nodes = np.intersect1d(proteins, np.concatenate((sources, targets)))
+    assert np.array_equal(state_nodes, expected_nodes)
+    assert same_partition(state_roots, roots[state_nodes])
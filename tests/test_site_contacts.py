@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from utils import parse_pdb_atoms
+from extra_properties import site_contacts
+from extra_properties.contact_map import (
+    sparse_blocks,
+    dense_blocks,
+    mirror_pairs,
+    DTYPE,
+    PAIRS_DTYPE,
+    OFFSETS_DTYPE,
+)
+from extra_properties.site_contacts import read_elements, site_distances
+
+
+def large_object(conn, array: np.ndarray) -> int:
+    query = text("SELECT lo_from_bytea(0, :content)")
+    return conn.execute(query, {"content": array.tobytes()}).scalar()
+
+
+@pytest.fixture
+def coords(fragment_pdb) -> np.ndarray:
+    return parse_pdb_atoms(fragment_pdb)["xyz"]
+
+
+@pytest.fixture(params=["default", "small ranges"])
+def ranges(request, monkeypatch) -> None:
+    if request.param == "small ranges":
+        monkeypatch.setattr(site_contacts, "MAX_GAP", 2)
+        monkeypatch.setattr(site_contacts, "MAX_RANGE", 5)
+
+
+def test_read_elements_match_whole_array(conn, ranges):
+    array = np.arange(1000, dtype=DTYPE) / 7
+    oid = large_object(conn, array)
+    rng = np.random.default_rng(0)
+    for indices in (
+        rng.integers(0, len(array), 300),
+        np.arange(len(array))[::-1],
+        np.array([999, 0, 0, 500]),
+        np.empty(0, dtype=np.int64),
+    ):
+        assert np.array_equal(read_elements(conn, oid, DTYPE, indices), array[indices])
+
+
+def stored_map(conn, coords: np.ndarray, layout: str) -> dict:
+    cmap = {
+        "atoms": pd.DataFrame(index=range(len(coords))),
+        "layout": layout,
+        "dtype": DTYPE,
+        "pairs_oid": None,
+        "offsets": None,
+        "neighbours": None,
+        "loaded": None,
+    }
+    if layout == "dense":
+        dists = np.concatenate([dists for dists, _ in dense_blocks(coords)])
+    else:
+        blocks = list(sparse_blocks(coords, 6.0))
+        dists = np.concatenate([dists for dists, _ in blocks])
+        pairs = np.concatenate([pairs for _, pairs in blocks])
+        if layout == "csr":
+            # Maps stored every pair from both atoms before csr_triu
+            dists, pairs = mirror_pairs(dists, pairs)
+        neighbours = pairs[:, 1].astype(PAIRS_DTYPE)
+        cmap["pairs_oid"] = large_object(conn, neighbours)
+        nneighbours = np.bincount(pairs[:, 0], minlength=len(coords))
+        cmap["offsets"] = np.concatenate(([0], np.cumsum(nneighbours))).astype(
+            OFFSETS_DTYPE
+        )
+        if layout == "csr_triu":
+            cmap["neighbours"] = neighbours
+    cmap["distances_oid"] = large_object(conn, dists)
+    return cmap
+
+
+@pytest.mark.parametrize("layout", ["dense", "csr", "csr_triu"])
+def test_site_distances_match_whole_map(conn, coords, ranges, layout):
+    cmap = stored_map(conn, coords, layout)
+    distances = np.sqrt(((coords[:, None] - coords[None]) ** 2).sum(axis=-1))
+    for atoms in (np.array([3]), np.array([0, 17, 18, 40]), np.arange(len(coords))):
+        site, other, dists = site_distances(conn, cmap, atoms)
+
+        expected = np.isin(np.arange(len(coords)), atoms)[:, None] & ~np.eye(
+            len(coords), dtype=bool
+        )
+        if layout != "dense":
+            expected &= distances <= 6.0
+        expected_site, expected_other = np.nonzero(expected)
+        order = np.lexsort((other, site))
+        assert np.array_equal(site[order], expected_site)
+        assert np.array_equal(other[order], expected_other)
+        np.testing.assert_allclose(
+            dists[order], distances[expected_site, expected_other], rtol=1e-6
+        )